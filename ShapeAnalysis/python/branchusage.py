@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import re
+import logging
+
+#  ___                  _    _   _
+# | _ )_ _ __ _ _ _  __| |_ | | | |___ __ _ __ _ ___
+# | _ \ '_/ _` | ' \/ _| ' \| |_| (_-</ _` / _` / -_)
+# |___/_| \__,_|_||_\__|_||_|\___//__/\__,_\__, \___|
+#                                          |___/
+#
+# The branches read by a set of TTreeFormula expressions (variables, cuts and
+# weights), aliases resolved, to switch off all the others before looping:
+# only the baskets of the enabled branches are read and decompressed.
+
+_log = logging.getLogger('branchusage')
+
+_names   = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*')
+_strings = re.compile(r'"[^"]*"')
+
+# _____________________________________________________________________________
+def identifiers(expr):
+    '''The names appearing in expr (functions included), string literals excluded'''
+    return set(_names.findall(_strings.sub('',expr)))
+
+# _____________________________________________________________________________
+def trees(tree):
+    '''The tree followed by its friends'''
+    trees = [tree]
+    if tree.GetListOfFriends():
+        trees += [ fe.GetTree() for fe in tree.GetListOfFriends() ]
+    return trees
+
+# _____________________________________________________________________________
+def aliases(tree, extra=None):
+    '''The aliases defined on the tree and its friends, and the extra ones'''
+    aliases = {}
+    for t in reversed(trees(tree)):
+        if t.GetListOfAliases():
+            aliases.update( [ (a.GetName(),a.GetTitle()) for a in t.GetListOfAliases() ] )
+    if extra:
+        aliases.update(extra)
+    return aliases
+
+# _____________________________________________________________________________
+def wwaliases():
+    '''The wwcuts selections, as set as aliases by the WW pruner'''
+    from hwwinfo import wwcuts
+    return dict([ (n,' && '.join(c)) for n,c in vars(wwcuts).iteritems() if isinstance(c,list) ])
+
+# _____________________________________________________________________________
+def expand(exprs, aliases={}):
+    '''The names used by the expressions, the aliases replaced by their own names'''
+    names = set()
+    todo  = list(exprs)
+    while todo:
+        for n in identifiers(todo.pop()):
+            if n in names: continue
+            names.add(n)
+            if n in aliases:
+                todo.append(aliases[n])
+    return names
+
+# _____________________________________________________________________________
+def _candidates(name, friend):
+    # name, branch.leaf or friend.branch[.leaf]
+    parts = name.split('.')
+    if len(parts) == 1:
+        return parts
+    if parts[0] == friend:
+        return ['.'.join(parts[1:]),parts[1]]
+    return [name,parts[0]]
+
+# _____________________________________________________________________________
+def branches(tree, exprs, extra=None):
+    '''
+    The branches of the tree and of its friends read by the expressions, as a
+    list of (tree, branch names) pairs, tree first
+    '''
+    names = expand(exprs,aliases(tree,extra))
+
+    usage = []
+    for i,t in enumerate(trees(tree)):
+        if not t.GetTree():
+            t.LoadTree(0)
+        available = set([ b.GetName() for b in t.GetListOfBranches() ]) if t.GetListOfBranches() else set()
+        friend = t.GetName() if i > 0 else None
+        used = set()
+        for n in names:
+            used.update( [ c for c in _candidates(n,friend) if c in available ] )
+        usage.append( (t,sorted(used)) )
+    return usage
+
+# _____________________________________________________________________________
+def restrict(tree, exprs, enabled=None, disable=True, cachesize=0, extra=None):
+    '''
+    Enable only the branches of tree (and friends) read by exprs, and add them
+    to the TTreeCache if cachesize (bytes) is set. enabled is the set of
+    (tree index, branch) already enabled by previous calls, which is updated
+    and returned: the branches are only ever added, so that the expressions
+    of the previous calls can still be evaluated.
+    '''
+    if enabled is None:
+        enabled = set()
+
+    for i,(t,used) in enumerate(branches(tree,exprs,extra)):
+        # (i,None) marks the trees already restricted
+        if (i,None) not in enabled:
+            enabled.add( (i,None) )
+            # friends are read entirely by GetEntry, even if not used
+            if disable:
+                t.SetBranchStatus('*',0)
+
+        new = [ b for b in used if (i,b) not in enabled ]
+        if not new: continue
+
+        if disable:
+            for b in new:
+                t.SetBranchStatus(b,1)
+
+        if cachesize:
+            if not [ k for k in enabled if k[0] == i and k[1] ]:
+                t.SetCacheSize(cachesize)
+            for b in new:
+                t.AddBranchToCache(b,True)
+            t.StopCacheLearningPhase()
+
+        enabled.update( [ (i,b) for b in new ] )
+        _log.debug('%s: %d branches enabled (+%s)', t.GetName(), len([ k for k in enabled if k[0] == i and k[1] ]), ','.join(new))
+
+    return enabled
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+import fnmatch
+import logging
+from HWWAnalysis.Misc.odict import OrderedDict
+
+#  ___       _                      _
+# |   \ __ _| |_ __ _ __ __ _ _ _ __| |
+# | |) / _` |  _/ _` / _/ _` | '_/ _` |
+# |___/\__,_|\__\__,_\__\__,_|_| \__,_|
+#
+# In-memory datacards: one column per (bin, process) with its rate, one row of
+# effects per nuisance, the shape references. Built from the yields and the
+# nuisance map, filtered, merged across bins, written in one go and parsed back.
+
+_coldef = 15
+_dashes = '-'*100+'\n'
+_shapetypes = ('shape','shapeN2')
+# the lines that are not rows of effects, kept as they are (name type arguments...)
+_directives = ('param','flatParam','rateParam','extArg','group','autoMCStats','discrete')
+_keywords   = ('imax','jmax','kmax','bin','observation','shapes','process','rate')
+
+class Datacard:
+    '''
+    A datacard as columns and rows:
+    + bins, observations: the bins and their observed events
+    + shapes: the shape lines, (process, bin, file, [histogram names])
+    + columns, rates: (bin, process, index) and the expected yield of each column
+    + nuisances: name -> (pdf, effects) with one effect per column, None if
+      the process is not affected (written as '-')
+    + directives: the other lines of combine (param, rateParam, group, ...),
+      as text after the nuisances
+    '''
+    _log = logging.getLogger('Datacard')
+
+    # _____________________________________________________________________________
+    def __init__(self):
+        self.header       = ['## Shape input card for H->WW analysis']
+        self.bins         = []
+        self.observations = []
+        self.shapes       = []
+        self.columns      = []
+        self.rates        = []
+        self.nuisances    = OrderedDict()
+        self.directives   = []
+
+    # _____________________________________________________________________________
+    def processes(self, bin=None):
+        '''The process names, of all the bins or of one'''
+        return [ p for b,p,i in self.columns if bin is None or b == bin ]
+
+    # _____________________________________________________________________________
+    def copy(self):
+        card = Datacard()
+        card.header       = self.header[:]
+        card.bins         = self.bins[:]
+        card.observations = self.observations[:]
+        card.shapes       = self.shapes[:]
+        card.columns      = self.columns[:]
+        card.rates        = self.rates[:]
+        card.nuisances    = OrderedDict([ (n,(pdf[:],effects[:])) for n,(pdf,effects) in self.nuisances.iteritems() ])
+        card.directives   = self.directives[:]
+        return card
+
+    # _____________________________________________________________________________
+    @classmethod
+    def build(cls, bin, yields, nuisances, shapes=None, signals=()):
+        '''
+        A single bin card from the yields (process -> rate, Data being the
+        observation) and the nuisances (name -> (pdf, {process: effect})).
+        The signals get the indices 0,-1,..., the backgrounds 1,2,...; the
+        nuisances affecting none of the processes are dropped. With shapes
+        (the shape file), all the processes are read from it.
+        '''
+        card = cls()
+        card.bins = [bin]
+        card.observations = [yields['Data']]
+
+        if shapes:
+            card.shapes.append( ('*',        '*', shapes, ['histo_$PROCESS','histo_$PROCESS_$SYSTEMATIC']) )
+            card.shapes.append( ('data_obs', '*', shapes, ['histo_Data']) )
+
+        sigs = [ name for name in yields if name in signals ]
+        bkgs = [ name for name in yields if name not in signals and name != 'Data']
+        card.columns = [ (bin,s,-i) for i,s in enumerate(sigs) ]+[ (bin,b,i+1) for i,b in enumerate(bkgs) ]
+        card.rates   = [ yields[p] for b,p,i in card.columns ]
+
+        for name,(pdf,effect) in nuisances.iteritems():
+            # if this nuisance has no effect on any sample, not even write it!
+            if not [ p for b,p,i in card.columns if p in effect ]:
+                continue
+
+            # even if split in jet bins
+            if 'WW' in signals and 'Gen_nlo_' in name:
+                continue
+
+            card.nuisances[name] = (list(pdf),[ effect.get(p) for b,p,i in card.columns ])
+        return card
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _select(names, flags):
+        # include/exclude (pattern,flag) applied in order, as mkDatacards
+        selected = set(names)
+        for exp,flag in flags:
+            subset = set(fnmatch.filter(names,exp))
+            if flag:
+                selected |= subset
+            else:
+                selected -= subset
+        return selected
+
+    # _____________________________________________________________________________
+    def filter(self, nuisFlags=[], shapeFlags=[]):
+        '''
+        A copy of the card with the nuisances selected by nuisFlags (all of them)
+        and shapeFlags (shape nuisances only), lists of (pattern, include)
+        '''
+        names  = self.nuisances.keys()
+        shapes = [ n for n in names if self.nuisances[n][0][0] in _shapetypes ]
+        keep   = self._select(names,nuisFlags) & (self._select(shapes,shapeFlags) | (set(names)-set(shapes)))
+
+        card = self.copy()
+        card.nuisances = OrderedDict([ (n,v) for n,v in card.nuisances.iteritems() if n in keep ])
+        return card
+
+    # _____________________________________________________________________________
+    @classmethod
+    def merge(cls, cards):
+        '''One card with the bins of all the cards, the nuisances matched by name'''
+        merged = cls()
+        merged.header = cards[0].header[:]
+        for card in cards:
+            clash = set(card.bins) & set(merged.bins)
+            if clash:
+                raise ValueError('Bins defined twice: '+', '.join(sorted(clash)))
+
+            before = len(merged.columns)
+            merged.bins.extend(card.bins)
+            merged.observations.extend(card.observations)
+            # the wildcard bins are resolved, they would match the other cards' bins
+            for p,b,f,names in card.shapes:
+                for bin in (card.bins if b == '*' else [b]):
+                    merged.shapes.append( (p,bin,f,names) )
+            merged.columns.extend(card.columns)
+            merged.rates.extend(card.rates)
+
+            for name,(pdf,effects) in card.nuisances.iteritems():
+                if name not in merged.nuisances:
+                    merged.nuisances[name] = (pdf[:],[None]*before)
+                elif merged.nuisances[name][0] != pdf:
+                    raise ValueError('Nuisance %s: pdf %s and %s' % (name,' '.join(map(str,merged.nuisances[name][0])),' '.join(map(str,pdf))))
+                merged.nuisances[name][1].extend(effects)
+
+            # pad the nuisances missing in this card
+            for name,(pdf,effects) in merged.nuisances.iteritems():
+                effects.extend( [None]*(len(merged.columns)-len(effects)) )
+            merged.directives.extend([ d for d in card.directives if d not in merged.directives ])
+        return merged
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _effect(pdf, e):
+        if e is None:                 return '-'.ljust(_coldef)
+        if pdf[0] == 'gmN':           return '%-10.5f' % e
+        if pdf[0] in _shapetypes:     return '%-10d' % e
+        if isinstance(e,tuple):       return '%.2f/%-5.2f' % e
+        return '%-10.3f' % e
+
+    # _____________________________________________________________________________
+    def lines(self):
+        '''The text of the card, line by line'''
+        lines = [ h+'\n' for h in self.header ]
+        lines.append('imax %d number of channels\n' % len(self.bins))
+        lines.append('jmax * number of background\n')
+        lines.append('kmax * number of nuisance parameters\n')
+        lines.append(_dashes)
+
+        lines.append('bin         %s\n' % ' '.join(self.bins))
+        lines.append('observation %s\n' % ' '.join([ '%.0f' % o for o in self.observations ]))
+        for p,b,f,names in self.shapes:
+            lines.append('shapes  '+p.ljust(12)+b+' '+f+'     '+' '.join(names)+'\n')
+        lines.append(_dashes)
+
+        lines.append('bin'.ljust(58)+''.join([ b.ljust(_coldef) for b,p,i in self.columns ])+'\n')
+        lines.append('process'.ljust(58)+''.join([ p.ljust(_coldef) for b,p,i in self.columns ])+'\n')
+        lines.append('process'.ljust(58)+''.join([ ('%d' % i).ljust(_coldef) for b,p,i in self.columns ])+'\n')
+        lines.append('rate'.ljust(58)+''.join([ ('%-.4f' % r).ljust(_coldef) for r in self.rates ])+'\n')
+        lines.append(_dashes)
+
+        for name,(pdf,effects) in self.nuisances.iteritems():
+            if len(pdf) == 1: row = '{0:<41} {1:<7}         '.format(name,pdf[0])
+            else:             row = '{0:<41} {1:<7} {2:<6}  '.format(name,pdf[0],pdf[1])
+            lines.append(row+''.join([ self._effect(pdf,e) for e in effects ])+'\n')
+        lines.extend([ d+'\n' for d in self.directives ])
+        return lines
+
+    # _____________________________________________________________________________
+    def write(self, path):
+        '''Write the card with a single write'''
+        with open(path,'w') as card:
+            card.write(''.join(self.lines()))
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _value(pdf, token):
+        if token == '-':
+            return None
+        if '/' in token:
+            return tuple([ float(x) for x in token.split('/') ])
+        if pdf[0] in _shapetypes:
+            return int(float(token))
+        return float(token)
+
+    # _____________________________________________________________________________
+    @classmethod
+    def parse(cls, path):
+        '''Read a card written by write, by mkDatacards or by combineCards'''
+        with open(path) as f:
+            return cls.loads(f.read())
+
+    # _____________________________________________________________________________
+    @classmethod
+    def loads(cls, text):
+        '''
+        The card from its text. The comments and the text before the first
+        keyword (e.g. the 'Combination of ...' of combineCards) go to the
+        header, the directives (param, rateParam, group, ...) are kept as text.
+        '''
+        card = cls()
+        card.header = []
+        processes, indices, colbins = [],[],[]
+        started = False
+        for line in text.splitlines():
+            tokens = line.split()
+            if not tokens:
+                continue
+            key = tokens[0]
+            if key.startswith('#') or not (started or key.startswith('---') or key in _keywords):
+                card.header.append(line.rstrip())
+                continue
+            started = True
+            if key.startswith('---') or key in ('imax','jmax','kmax'):
+                continue
+            elif key == 'nuisance' or (len(tokens) > 1 and tokens[1] in _directives):
+                card.directives.append(line.rstrip())
+            elif key == 'bin':
+                if not card.observations: card.bins = tokens[1:]
+                else:                     colbins = tokens[1:]
+            elif key == 'observation':
+                card.observations = [ float(o) for o in tokens[1:] ]
+            elif key == 'shapes':
+                card.shapes.append( (tokens[1],tokens[2],tokens[3],tokens[4:]) )
+            elif key == 'process':
+                try:
+                    indices = [ int(i) for i in tokens[1:] ]
+                except ValueError:
+                    processes = tokens[1:]
+            elif key == 'rate':
+                card.rates = [ float(r) for r in tokens[1:] ]
+            else:
+                pdf = tokens[1:3] if tokens[1] == 'gmN' else tokens[1:2]
+                if pdf[0] == 'gmN': pdf[1] = int(pdf[1])
+                values = tokens[1+len(pdf):]
+                if len(values) != len(card.rates):
+                    raise ValueError('Nuisance %s: %d effects for %d processes' % (key,len(values),len(card.rates)))
+                card.nuisances[key] = (pdf,[ cls._value(pdf,v) for v in values ])
+
+        if not (len(colbins) == len(processes) == len(indices) == len(card.rates)):
+            raise ValueError('Inconsistent bin, process and rate lines')
+        card.columns = zip(colbins,processes,indices)
+        return card
+
+    # _____________________________________________________________________________
+    # the views of HiggsAnalysis.CombinedLimit.DatacardParser
+
+    @property
+    def exp(self):
+        '''bin -> process -> rate'''
+        exp = OrderedDict([ (b,OrderedDict()) for b in self.bins ])
+        for (b,p,i),r in zip(self.columns,self.rates):
+            exp[b][p] = r
+        return exp
+
+    @property
+    def obs(self):
+        '''bin -> observation'''
+        return OrderedDict(zip(self.bins,self.observations))
+
+    @property
+    def systs(self):
+        '''(name, nofloat, pdf, pdf arguments, bin -> process -> effect), 0 where not affected'''
+        systs = []
+        for name,(pdf,effects) in self.nuisances.iteritems():
+            errline = OrderedDict([ (b,OrderedDict()) for b in self.bins ])
+            for (b,p,i),e in zip(self.columns,effects):
+                if e is None:             e = 0
+                elif isinstance(e,tuple): e = list(e)
+                errline[b][p] = e
+            systs.append( (name,False,pdf[0],pdf[1:],errline) )
+        return systs
@@ -3,6 +3,9 @@
 import hwwinfo
 import logging
 import os.path
+import json
+import copy
+import tempfile
 
 
 class AlienDict(dict):
@@ -35,7 +38,20 @@ class AlienDict(dict):
                 return value
 
 class DDCardReader:
+    '''
+    The data driven estimates of the {process}Card_{channel}_{cat}.txt files.
+
+    The estimates are compiled into an index in the cards directory
+    (.ddindex.json), loaded in one read as long as the cards are unchanged
+    (same files, sizes and modification times). The estimates of a directory
+    are read once per process and shared, read-only, by all its readers.
+    '''
     _logger = logging.getLogger("DDCardReader")
+    _indexName = '.ddindex.json'
+    _indexVersion = 1
+    # estimates by directory, shared by the readers
+    _stores = {}
+
     def __init__(self, path):
         self._path = path
 
@@ -51,8 +67,82 @@ class DDCardReader:
             self._iszombie = True
             return
 
-        print 'Reading data driven estimates from',self._path
+        path = os.path.abspath(self._path)
+        if path in self._stores:
+            self.estimates = self._stores[path]
+            return
+
+        readmap = self._readmap()
+        stamp = self._stamp(readmap)
+        ddcards = self._loadIndex(stamp)
+        if ddcards is None:
+            print 'Reading data driven estimates from',self._path
+            ddcards = self._parse(readmap)
+            self._saveIndex(stamp,ddcards)
+        else:
+            print 'Reading data driven estimates from the index of',self._path
+
+        ddcards.lock()
+        self.estimates = self._stores[path] = ddcards
+
+    def _filename(self, process, channel, cat):
+        return os.path.join( self._path,'{0}Card_{1}_{2}.txt'.format(process,channel,cat) )
+
+    def _stamp(self, readmap):
+        # size and modification time of each card file, None if missing
+        stamp = {}
+        for p,mapping in readmap.iteritems():
+            for ch,(cat,fls) in mapping.iteritems():
+                for fl in fls:
+                    filename = self._filename(p,fl,cat)
+                    try:
+                        st = os.stat(filename)
+                        stamp[os.path.basename(filename)] = [st.st_size,st.st_mtime]
+                    except OSError:
+                        stamp[os.path.basename(filename)] = None
+        return stamp
+
+    def _loadIndex(self, stamp):
+        try:
+            with open(os.path.join(self._path,self._indexName)) as f:
+                index = json.load(f)
+        except (IOError,ValueError):
+            return None
+        if index.get('version') != self._indexVersion or index.get('files') != stamp:
+            self._logger.info('Data driven index outdated')
+            return None
 
+        ddcards = AlienDict()
+        for mass,ch,p,Nctr,alpha,delta,deltaCorr,deltaUnCorr in index['estimates']:
+            ddcards[mass][str(ch)][str(p)] = DDEntry(Nctr,alpha,delta,deltaCorr,deltaUnCorr)
+        return ddcards
+
+    def _saveIndex(self, stamp, ddcards):
+        estimates = []
+        for mass in sorted(ddcards):
+            for ch in sorted(ddcards[mass]):
+                for p in sorted(ddcards[mass][ch]):
+                    e = ddcards[mass][ch][p]
+                    estimates.append( (mass,ch,p,e.Nctr,e.alpha,e.delta,e.deltaCorr,e.deltaUnCorr) )
+        index = {'version':self._indexVersion, 'files':stamp, 'estimates':estimates}
+        # written aside and renamed, so that a concurrent reader never sees a partial index
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=self._path, prefix=self._indexName+'.', delete=False) as f:
+                tmp = f.name
+                json.dump(index,f)
+            # readable as a plainly written file (the temporary one is private)
+            umask = os.umask(0); os.umask(umask)
+            os.chmod(tmp,0666 & ~umask)
+            os.rename(tmp,os.path.join(self._path,self._indexName))
+        except (IOError,OSError) as ioe:
+            self._logger.info('Data driven index not written: '+str(ioe))
+        finally:
+            # left only if not renamed
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _readmap(self):
         # data driven systematics
         basemapping  = {'of_0j'     : ('0j',['of']), 'sf_0j': ('0j',['sf']),
                        'of_1j'      : ('1j',['of']), 'sf_1j': ('1j',['sf']),
@@ -89,8 +179,9 @@ class DDCardReader:
         readmap['DYmm'] = lleemmmapping.copy()
         readmap['DYee05'] = lleemmmapping.copy()
         readmap['DYmm05'] = lleemmmapping.copy()
+        return readmap
 
-
+    def _parse(self, readmap):
         ddcards = AlienDict()
 
         for p,mapping in readmap.iteritems():
@@ -117,13 +208,12 @@ class DDCardReader:
 
                     ddcards[mass][ch][p] = value
 
-        ddcards.lock()
-        self.estimates = ddcards
+        return ddcards
 
     def _load(self,process, cat, channel):
         ''' Read the Data driven datacar for a given process, jet bin, channel at all masses'''
         
-        filename = os.path.join( self._path,'{0}Card_{1}_{2}.txt'.format(process,channel,cat) )
+        filename = self._filename(process,channel,cat)
         self._logger.debug('opening file: '+filename)
         cardFile = open(filename)
         card = {}
@@ -150,6 +240,13 @@ class DDCardReader:
         except KeyError as ke:
             raise KeyError('{0} {1}'.format(mass,channel))
 
+    def entry(self, mass, channel, process):
+        '''The estimate of a process'''
+        try:
+            return self.estimates[mass][channel][process]
+        except KeyError as ke:
+            raise KeyError('{0} {1} {2}'.format(mass,channel,process))
+
     def get(self, mass, channel):
         try:
             return (self.estimates[mass][channel],(mass,channel))
@@ -211,6 +308,7 @@ class DDWWFilter:
         #    print i,self.haswwdd(i)
 
     def haswwdd(self, mass, channel):
+        '''Whether the WW estimates are used at mass in channel, raises KeyError without estimates there'''
         if not self._reader.iszombie:
            procs = self._reader.processes(mass,channel)
 
@@ -229,19 +327,29 @@ class DDWWFilter:
            return False
 
 
-    def get(self, mass,channel):
-        import copy
-
-        estimates,y = self._reader.get(mass,channel)
-        # make a copy of the data driven
-        filtered = copy.deepcopy(estimates)
-
-        if not self.haswwdd(mass, channel):
-            for p in ['WW','ggWW']:
-              if p in filtered:
-                del filtered[p]
+    def entry(self, mass, channel, process):
+        '''
+        A copy of the estimate of process (free to be modified), None if there
+        is none or if it is filtered. Raises KeyError without estimates at mass
+        in channel.
+        '''
+        if self._reader.iszombie:
+            return None
+        if process in ['WW','ggWW'] and not self.haswwdd(mass, channel):
+            return None
+        try:
+            return copy.copy(self._reader.entry(mass, channel, process))
+        except KeyError:
+            # the estimates of the other processes are there
+            self._reader.processes(mass, channel)
+            return None
 
-        return filtered,y
+    def get(self, mass,channel):
+        # copies of the estimates, the filtered ones removed
+        procs = self._reader.processes(mass,channel)
+        filtered = dict([ (p,self.entry(mass,channel,p)) for p in procs ])
+        filtered = dict([ (p,e) for p,e in filtered.iteritems() if e is not None ])
+        return filtered,(mass,channel)
 
 
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import ROOT
+import os
+import re
+import hashlib
+import logging
+
+#  ___     _            _    _    _    ___         _
+# | __|_ _| |_ _ _ _  _| |  (_)__| |_ / __|__ _ __| |_  ___
+# | _|| ' \  _| '_| || | |__| (_-<  _| (__/ _` / _| ' \/ -_)
+# |___|_||_\__|_|  \_, |____|_/__/\__|\___\__,_\__|_||_\___|
+#                  |__/
+
+class EntryListCache:
+    '''
+    On-disk cache of the TEntryLists selected by a cut on a chain.
+
+    The lists are stored as <path>/<key>.root, where key is a hash of the
+    normalised cut and of the chain content (tree name, files, friends, and
+    the files sizes and modification times), so that any change of the
+    inputs invalidates the cached lists. The least recently used lists are
+    removed when the cache exceeds maxsize (in MB).
+    '''
+    _log = logging.getLogger('EntryListCache')
+
+    # ---
+    def __init__(self, path, maxsize=2000):
+        self._path    = path
+        self._maxsize = maxsize*1024*1024
+        self._lists   = {}
+
+        self.hits     = 0
+        self.misses   = 0
+        self.written  = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    # ---
+    @staticmethod
+    def normalize(cut):
+        '''Strip the formatting differences between equivalent cuts'''
+        cut = re.sub(r'\s+','',cut)
+        while cut.startswith('(') and cut.endswith(')') and EntryListCache._balanced(cut[1:-1]):
+            cut = cut[1:-1]
+        return cut
+
+    # ---
+    @staticmethod
+    def _balanced(expr):
+        depth = 0
+        for c in expr:
+            if c == '(': depth += 1
+            elif c == ')': depth -= 1
+            if depth < 0: return False
+        return depth == 0
+
+    # ---
+    @staticmethod
+    def _content(tree):
+        files = [ f.GetTitle() for f in tree.GetListOfFiles() ] if isinstance(tree,ROOT.TChain) else [tree.GetCurrentFile().GetName()]
+        stats = [ (f, os.path.getsize(f), int(os.path.getmtime(f))) if os.path.exists(f) else (f,) for f in files ]
+        friends = []
+        if tree.GetListOfFriends():
+            friends = [ EntryListCache._content(fe.GetTree()) for fe in tree.GetListOfFriends() ]
+        return (tree.GetName(), stats, friends)
+
+    # ---
+    def key(self, tree, cut):
+        return hashlib.sha1(repr( (self._content(tree), self.normalize(cut)) )).hexdigest()
+
+    # ---
+    def get(self, tree, cut, presel=None):
+        '''
+        Return the entrylist of the entries of tree passing cut.
+        When not cached, the cut is evaluated only on the entries passing
+        presel, a looser selection shared by several cuts (itself cached).
+        '''
+        key = self.key(tree,cut)
+
+        if key in self._lists:
+            self.hits += 1
+            return self._lists[key]
+
+        path = os.path.join(self._path,key+'.root')
+        elist = self._load(path) if os.path.exists(path) else None
+
+        if elist:
+            self.hits += 1
+            # touch the file to keep track of the last use; another job may
+            # have pruned it since, the list is loaded anyway
+            try:
+                os.utime(path,None)
+            except OSError:
+                pass
+        else:
+            self.misses += 1
+            base = self.get(tree,presel) if presel and self.normalize(presel) != self.normalize(cut) else None
+            elist = self._make(tree, cut, base, 'elist_'+key)
+            self._save(path, elist)
+            self.prune()
+
+        self._lists[key] = elist
+        return elist
+
+    # ---
+    def _make(self, tree, cut, base, name):
+        # keep the current directory, where the shapes are being filled
+        current = ROOT.gDirectory.GetDirectory('')
+        ROOT.gROOT.cd()
+
+        old = tree.GetEntryList()
+        tree.SetEntryList(base if base else 0x0)
+        tree.Draw('>>'+name, cut, 'entrylist goff')
+        tree.SetEntryList(old if old.__nonzero__() else 0x0)
+
+        elist = ROOT.gDirectory.Get(name)
+        # detach the list
+        elist.SetDirectory(0x0)
+        # ensure the ownership
+        ROOT.SetOwnership(elist,True)
+
+        current.cd()
+        self._log.debug('%s: %d entries selected by %s', tree.GetName(), elist.GetN(), cut)
+        return elist
+
+    # ---
+    def _load(self, path):
+        # a file corrupted, or removed by another job since, is a miss
+        f = ROOT.TFile.Open(path)
+        if not f or f.IsZombie():
+            self._log.warning('Cannot read the cache file %s', path)
+            return None
+        elist = f.Get('elist')
+        if elist:
+            elist.SetDirectory(0x0)
+            ROOT.SetOwnership(elist,True)
+        f.Close()
+        return elist
+
+    # ---
+    def _save(self, path, elist):
+        current = ROOT.gDirectory.GetDirectory('')
+        # write to a temporary file first, concurrent jobs may share the cache
+        tmp = path+'.%d.tmp' % os.getpid()
+        f = ROOT.TFile.Open(tmp,'recreate')
+        elist.Write('elist')
+        f.Close()
+        os.rename(tmp,path)
+        current.cd()
+        self.written += 1
+
+    # ---
+    def size(self):
+        return sum([ os.path.getsize(os.path.join(self._path,f)) for f in os.listdir(self._path) if f.endswith('.root') ])
+
+    # ---
+    def prune(self):
+        '''Remove the least recently used lists in excess of maxsize'''
+        files = []
+        for f in os.listdir(self._path):
+            if not f.endswith('.root'): continue
+            f = os.path.join(self._path,f)
+            # the other jobs sharing the cache may be pruning it too
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            files.append( (st.st_mtime,st.st_size,f) )
+        files.sort()
+        total = sum([ s for t,s,f in files ])
+
+        removed = 0
+        while files and total > self._maxsize:
+            t,s,f = files.pop(0)
+            try:
+                os.remove(f)
+                removed += 1
+            except OSError:
+                pass
+            total -= s
+
+        if removed:
+            self._log.info('%d lists removed from the cache', removed)
+        return removed
+
+    # ---
+    def report(self):
+        print 'Entry list cache {0}: {1} hits, {2} misses, {3} lists written, {4} lists in memory, {5:.1f}/{6:.0f} MB on disk'.format(
+            self._path, self.hits, self.misses, self.written, len(self._lists), self.size()/1024./1024., self._maxsize/1024./1024.)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+from HWWAnalysis.Misc.odict import OrderedDict
+
+#    ____     _                 ______
+#   / __/____(_)__ ___  ___/ / /_  __/______ ___ ___
+#  / _// __/ / -_) _ \/ _  /   / / / __/ -_) -_|_-<
+# /_/ /_/ /_/\__/_//_/\_,_/   /_/ /_/  \__/\__/___/
+#
+# The gardener can write the new branches to a small tree aligned with the
+# input tree (a friend) instead of a full copy. Each friend file comes with a
+# sidecar <friend file>.friend.json recording the input it belongs to, which
+# is used to build the index of the friends of the master files.
+
+_suffix = '.friend.json'
+
+# _____________________________________________________________________________
+def _normpath(path):
+    return path if '://' in path else os.path.abspath(path)
+
+# _____________________________________________________________________________
+def record(input, output, tree, entries, module=None):
+    '''Write the sidecar of the friend tree stored in output'''
+    info = {
+        'input'   : _normpath(input),
+        'file'    : os.path.basename(output),
+        'tree'    : tree,
+        'entries' : entries,
+        'module'  : module,
+    }
+    with open(output+_suffix,'w') as f:
+        json.dump(info,f,indent=1)
+
+# _____________________________________________________________________________
+class FriendIndex:
+    '''
+    Index of the friend trees found in a set of directories, by master file.
+    '''
+    _log = logging.getLogger('FriendIndex')
+
+    # _____________________________________________________________________________
+    def __init__(self, dirs=[]):
+        self._friends = {}
+        for d in dirs:
+            self.scan(d)
+
+    # _____________________________________________________________________________
+    def __len__(self):
+        return sum([ len(f) for f in self._friends.itervalues() ])
+
+    # _____________________________________________________________________________
+    def scan(self, path):
+        '''Add the friends described by the sidecars found under path'''
+        n = 0
+        for root,dirs,files in os.walk(path):
+            for name in sorted(files):
+                if not name.endswith(_suffix): continue
+                info = json.load(open(os.path.join(root,name)))
+                friend = os.path.join(root,info['file'])
+                if not os.path.exists(friend):
+                    self._log.warning('Friend file %s missing, skipped', friend)
+                    continue
+                # json strings are unicode, ROOT wants str
+                self._friends.setdefault(str(info['input']),OrderedDict())[str(info['tree'])] = str(friend)
+                n += 1
+        self._log.info('%d friend files found in %s', n, path)
+        return n
+
+    # _____________________________________________________________________________
+    def friends(self, files):
+        '''
+        The friend trees of the chain of files, as a tree name -> files dict
+        (aligned with files). Only the trees available for all the files are
+        returned.
+        '''
+        available = [ self._friends.get(_normpath(f),{}) for f in files ]
+        if not available: return OrderedDict()
+
+        friends = OrderedDict()
+        for tree in available[0]:
+            if [ a for a in available if tree not in a ]: continue
+            friends[tree] = [ a[tree] for a in available ]
+
+        partial = set(sum([ a.keys() for a in available ],[])) - set(friends.keys())
+        for tree in partial:
+            self._log.warning('Friend tree %s not available for all files, not attached', tree)
+
+        return friends
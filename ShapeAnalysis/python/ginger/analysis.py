@@ -275,7 +275,8 @@ class TreeAnalyser(object):
 
     def __build(self, samples):
         # build the
-        self._worker = ChainWorker.fromsamples(*samples) if samples else None
+        # the analyser only draws from the chains: only the branches used are read
+        self._worker = ChainWorker.fromsamples(*samples, restrictbranches=True) if samples else None
         self._cview  = ChainView(self._worker)
 
         self._aview  = AnalysisView(self._cview, filters=self._filters)
@@ -13,6 +13,7 @@ import numpy
 import array
 import ROOT
 import copy
+import HWWAnalysis.ShapeAnalysis.branchusage as branchusage
 from .base import Labelled
 from .core import AbsWorker,AbsView,Chained,Yield
 
@@ -153,8 +154,19 @@ class TreeWorker(AbsWorker):
     t.selection = 'x < 1'
 
     t = TreeWorker.fromSample( sample )
+
+    If friendindex is set (a friendtrees.FriendIndex), the gardener friend
+    trees of the files are attached automatically.
+
+    If restrictbranches is set (off by default, see fromsample), only the
+    branches read by the expressions drawn so far (wwcuts and tree aliases
+    resolved) are enabled, see branchusage. Direct loops on the chain
+    (GetEntry) only see those.
     '''
     _log = logging.getLogger('TreeWorker')
+    friendindex = None
+    restrictbranches = False
+    _wwaliases = None
     #---
 
     # ---
@@ -166,18 +178,24 @@ class TreeWorker(AbsWorker):
 
         self._elist     = None
         self._friends   = []
+        self._enabled   = set()
+
+        # the friends first, the selection may use their branches
+        if friends: self._link(friends)
+        if self.friendindex: self._link(self.friendindex.friends(files).items())
 
         self.weight    = weight
         self.selection = selection
         self.scale     = 1.
-        if friends: self._link(friends)
 
     # ---
     @staticmethod
-    def fromsample( sample ):
+    def fromsample( sample, restrictbranches=False ):
         if not isinstance( sample, Sample):
             raise ValueError('sample must inherit from %s (found %s)' % (Sample.__name__, sample.__class__.__name__) )
-        t = TreeWorker( sample.name, sample.files )
+        t = TreeWorker( sample.name, sample.files, friends=sample.friends )
+        # before the selection, to restrict its entry list loop too
+        t.restrictbranches = restrictbranches
         t.selection = sample.preselection
         t.weight    = sample.weight
         return t
@@ -192,7 +210,15 @@ class TreeWorker(AbsWorker):
     #---
     def _link(self,friends):
         for ftree,ffilenames in friends:
-            self.addfriend(free,ffilenames)
+            self.addfriend(ftree,ffilenames)
+
+    #---
+    def _use(self,*exprs):
+        '''Enable the branches read by the expressions before looping'''
+        if not self.restrictbranches: return
+        if TreeWorker._wwaliases is None:
+            TreeWorker._wwaliases = branchusage.wwaliases()
+        branchusage.restrict(self._chain, [ str(e) for e in exprs if e ], self._enabled, extra=self._wwaliases)
 
     #---
     def __del__(self):
@@ -244,8 +270,8 @@ class TreeWorker(AbsWorker):
 #             self._log.debug( 'obj after  %s', l.__repr__())
 
     #---
-    def addfriend(name,files):
-        fchain = _buildchain(ftree,ffilenames)
+    def addfriend(self,name,files):
+        fchain = _buildchain(name,files)
         if self._chain.GetEntriesFast() != fchain.GetEntries():
             raise RuntimeError('Mismatching number of entries: '
                                +self._chain.GetName()+'('+str(self._chain.GetEntriesFast())+'), '
@@ -292,6 +318,7 @@ class TreeWorker(AbsWorker):
         if not self._selection: return
         self._log.debug( 'applying worker selection %s', self._selection )
 
+        self._use(self._selection)
         self._chain.Draw('>> '+name, self._selection, 'entrylist')
 
         elist = ROOT.gDirectory.Get(name)
@@ -308,6 +335,7 @@ class TreeWorker(AbsWorker):
     def getminmax(self,var,binsize=0):
         # check var is one of the branches, otherwise it doesn't work
         import math
+        self._use(var)
         xmin,xmax = self._chain.GetMinimum(var),self._chain.GetMaximum(var)
 
         if binsize > 0:
@@ -323,11 +351,13 @@ class TreeWorker(AbsWorker):
             else:                return self._chain.GetEntries()
         else:
             # super simple projection
+            self._use(cut)
             return self._chain.Draw('1.', cut,'goff')
 
     #---
     def rawdraw(self, *args):
         '''Direct access to the chain Draw. Is it really necessary?'''
+        self._use(*[ a.split('>>')[0] for a in args[:2] if isinstance(a,str) ])
         return self._chain.Draw(*args)
 
     #---
@@ -420,6 +450,7 @@ class TreeWorker(AbsWorker):
         self._log.debug('cut:     \'%s\'', cut)
         self._log.debug('options: \'%s\'', options)
 
+        self._use(varexp.split('>>')[0], cut)
         n = self._chain.Draw(varexp , cut, options, *args, **kwargs)
         h = self._chain.GetHistogram()
         if h.__nonzero__():
@@ -599,10 +630,10 @@ class ChainWorker(Chained,AbsWorker):
         return chainviews
 
     @staticmethod
-    def fromsamples( *samples ):
-        ''' build each sample into a TreeWorker and add them together'''
+    def fromsamples( *samples, **kwargs ):
+        ''' build each sample into a TreeWorker and add them together (restrictbranches as keyword)'''
 
-        trees = [TreeWorker.fromsample(s) for s in samples]
+        trees = [TreeWorker.fromsample(s, kwargs.get('restrictbranches',False)) for s in samples]
         return ChainWorker(*trees)
 
 
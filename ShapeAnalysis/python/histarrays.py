@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import ROOT
+import numpy
+import array
+
+#  _  _ _    _      _
+# | || (_)__| |_   /_\  _ _ _ _ __ _ _  _ ___
+# | __ | (_-<  _| / _ \| '_| '_/ _` | || (_-<
+# |_||_|_/__/\__|/_/ \_\_| |_| \__,_|\_, /__/
+#                                    |__/
+#
+# numpy views on the contents and sumw2 buffers of the histograms, to work
+# on all the bins at once instead of bin by bin. The arrays are indexed in
+# numpy order, [z][y][x], with the under/overflows in the first/last slots.
+
+_dtypes = {
+    'C' : numpy.int8,
+    'S' : numpy.int16,
+    'I' : numpy.int32,
+    'F' : numpy.float32,
+    'D' : numpy.float64,
+}
+
+# _____________________________________________________________________________
+def shapeof(h):
+    '''numpy shape of the buffer of h, under/overflows included'''
+    dims = [h.GetNbinsX()+2, h.GetNbinsY()+2, h.GetNbinsZ()+2][:h.GetDimension()]
+    return tuple(reversed(dims))
+
+# _____________________________________________________________________________
+def _view(buf, shape, dtype):
+    n = int(numpy.prod(shape))
+    buf.SetSize(n)
+    return numpy.ndarray(shape, dtype=dtype, buffer=buf)
+
+# _____________________________________________________________________________
+def contents(h):
+    '''Writable view on the bin contents of h'''
+    cls = h.ClassName()
+    if not cls.startswith('TH') or cls[-1] not in _dtypes:
+        raise TypeError('No array view for '+cls)
+    return _view(h.GetArray(), shapeof(h), _dtypes[cls[-1]])
+
+# _____________________________________________________________________________
+def sumw2(h):
+    '''Writable view on the sum of the squared weights, None if not stored'''
+    if h.GetSumw2N() == 0:
+        return None
+    return _view(h.GetSumw2().GetArray(), shapeof(h), numpy.float64)
+
+# _____________________________________________________________________________
+def _edge(ndim, axis, i):
+    index = [slice(None)]*ndim
+    index[axis] = i
+    return tuple(index)
+
+# _____________________________________________________________________________
+def fold(h):
+    '''
+    Move the under/overflows to the first/last bins of each axis, in place.
+    The corners end up in the corner bins.
+    '''
+    for a in [contents(h), sumw2(h)]:
+        if a is None: continue
+        for axis in xrange(a.ndim):
+            a[_edge(a.ndim,axis,1)]  += a[_edge(a.ndim,axis,0)]
+            a[_edge(a.ndim,axis,0)]   = 0
+            a[_edge(a.ndim,axis,-2)] += a[_edge(a.ndim,axis,-1)]
+            a[_edge(a.ndim,axis,-1)]  = 0
+
+# _____________________________________________________________________________
+def _inner(a):
+    # the in-range bins, x first: the flattened order has x slowest
+    return a[(slice(1,-1),)*a.ndim].transpose().ravel()
+
+# _____________________________________________________________________________
+def unroll(h):
+    '''
+    The in-range bins of a 2d (or 3d) histogram as a TH1D with one bin per
+    cell. Bin (i,j[,k]) goes to ((i-1)*ny+(j-1))[*nz+(k-1)]+1.
+    '''
+    if h.GetDimension() < 2:
+        raise ValueError('Can flatten only 2d or 3d hists')
+
+    flat = _inner(contents(h)).astype(numpy.float64)
+    n = len(flat)
+
+    h_flat = ROOT.TH1D(h.GetName(),h.GetTitle(),n,0,n)
+    contents(h_flat)[1:-1] = flat
+
+    w2 = sumw2(h)
+    if w2 is not None:
+        if not h_flat.GetSumw2N(): h_flat.Sumw2()
+        sumw2(h_flat)[1:-1] = _inner(w2)
+    elif h_flat.GetSumw2N():
+        sumw2(h_flat)[1:-1] = numpy.abs(flat)
+
+    h_flat.SetEntries(h.GetEntries())
+
+    # sumw, sumw2, then sum(wx) and sum(wx^2) of each axis
+    nstats = { 2:7, 3:11 }[h.GetDimension()]
+    axes   = { 2:[(2,3),(4,5)], 3:[(2,3),(4,5),(7,8)] }[h.GetDimension()]
+    stats = array.array('d',[0]*nstats)
+    h.GetStats(stats)
+
+    stats1d = array.array('d',[0]*4)
+    stats1d[0] = stats[0]
+    stats1d[1] = stats[1]
+    stats1d[2] = sum([ stats[i] for i,j in axes ])
+    stats1d[3] = sum([ stats[j] for i,j in axes ])
+    h_flat.PutStats(stats1d)
+
+    return h_flat
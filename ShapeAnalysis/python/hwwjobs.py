@@ -0,0 +1,235 @@
+#       _     _
+#      | |___| |__ ___
+#   _  | / _ \ '_ (_-<
+#  |_|_/ \___/_.__/__/
+#
+# Process pool for independent jobs (shapes, trees, merging, cards)
+
+import os
+import sys
+import time
+import signal
+import logging
+import resource
+import traceback
+import multiprocessing
+from HWWAnalysis.Misc.odict import OrderedDict
+
+# the jobs are inherited by the workers when forking: only their index is
+# given to the worker, so that the jobs themselves need not be picklable
+_jobs = []
+
+#---
+class JobResult:
+    def __init__(self, label, ok, value=None, elapsed=0., error=None, log=None, maxrss=0):
+        self.label   = label
+        self.ok      = ok
+        self.value   = value
+        self.elapsed = elapsed
+        self.error   = error
+        self.log     = log
+        # peak resident memory of the worker, MB
+        self.maxrss  = maxrss
+
+#---
+def _redirect(path):
+    '''send stdout and stderr (ROOT's included) to path'''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    os.dup2(fd,1)
+    os.dup2(fd,2)
+    os.close(fd)
+
+#---
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+#---
+def _rss(pid):
+    '''current resident memory of process pid (MB), 0 if unknown (no /proc)'''
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])/1024.
+    except (IOError,ValueError):
+        pass
+    return 0.
+
+#---
+def _runjob(i, conn):
+    label,job,log = _jobs[i]
+    if log:
+        _redirect(log)
+
+    start = time.time()
+    try:
+        value = job()
+        result = JobResult(label, True, value, time.time()-start, log=log, maxrss=_maxrss())
+    except BaseException as e:
+        # the worker must report back in any case
+        msg = type(e).__name__+': '+str(e)+'\n'+traceback.format_exc()
+        print msg
+        result = JobResult(label, False, None, time.time()-start, msg, log, _maxrss())
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    try:
+        conn.send(result)
+    except Exception as e:
+        # e.g. a value that cannot be pickled
+        msg = 'Result not sent back: '+type(e).__name__+': '+str(e)
+        print msg
+        conn.send(JobResult(label, False, None, result.elapsed, msg, log, result.maxrss))
+    conn.close()
+
+#---
+class _Worker:
+    '''A forked process running job i, reporting its JobResult through a pipe'''
+    def __init__(self, i):
+        self.index = i
+        self.rss   = 0.
+        self.start = time.time()
+        self._conn,child = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(target=_runjob, args=(i,child))
+        self._process.start()
+        child.close()
+
+    def _failed(self, error):
+        label,job,log = _jobs[self.index]
+        return JobResult(label, False, None, time.time()-self.start, error, log, self.rss)
+
+    def poll(self, maxmem=0):
+        '''the result of the job, None while it is running'''
+        if self._conn.poll():
+            try:
+                return self._conn.recv()
+            except EOFError:
+                pass
+        if not self._process.is_alive():
+            # the result may have been sent just before the exit
+            if self._conn.poll():
+                try:
+                    return self._conn.recv()
+                except EOFError:
+                    pass
+            self._process.join()
+            code = self._process.exitcode
+            # e.g. ROOT aborting or segfaulting on a failed allocation
+            return self._failed('Worker died '+('by signal %d' % -code if code < 0 else 'with exit code %d' % code)+' without reporting')
+
+        self.rss = max(self.rss,_rss(self._process.pid))
+        if maxmem and self.rss > maxmem:
+            self.kill()
+            return self._failed('Killed: resident memory %.0fMB above the %dMB ceiling' % (self.rss,maxmem))
+        return None
+
+    def kill(self):
+        if self._process.is_alive():
+            os.kill(self._process.pid, signal.SIGKILL)
+        self._process.join()
+        self._conn.close()
+
+#---
+class JobPool:
+    '''
+    Runs a set of independent jobs on a pool of worker processes.
+
+    Each job runs in a freshly forked worker (no ROOT state leaks from one
+    job to the next) and, if logdir is defined, has its output redirected to
+    logdir/<label>.log. The results are returned in the order the jobs were
+    added, whatever the order of completion. A worker dying without
+    reporting (e.g. on a signal) makes its job fail.
+
+    If maxmem (MB) is set, the resident memory of each worker is polled and
+    a worker going beyond is killed: its job fails instead of bringing the
+    machine down.
+    '''
+    _log = logging.getLogger('JobPool')
+    # seconds between two polls of the workers
+    interval = 0.2
+
+    def __init__(self, njobs, logdir=None, maxmem=0):
+        self._njobs  = njobs
+        self._logdir = logdir
+        self._maxmem = maxmem
+        self._jobs   = OrderedDict()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def add(self, label, job, *args, **kwargs):
+        '''add a job: job(*args,**kwargs) will be run in a worker'''
+        if label in self._jobs:
+            raise KeyError('Job '+label+' already defined')
+        self._jobs[label] = lambda : job(*args,**kwargs)
+
+    def run(self, callback=None):
+        '''run the jobs, callback(result) is called as soon as each job completes'''
+        global _jobs
+        if self._logdir and not os.path.exists(self._logdir):
+            os.makedirs(self._logdir)
+
+        _jobs = [ (label,job,os.path.join(self._logdir,label+'.log') if self._logdir else None) for label,job in self._jobs.iteritems() ]
+        njobs = len(_jobs)
+        nproc = max(1,min(self._njobs,njobs))
+        print 'Running {0} jobs on {1} workers'.format(njobs,nproc)
+
+        results = [None]*njobs
+        pending = range(njobs)
+        running = []
+        n = 0
+        try:
+            while pending or running:
+                while pending and len(running) < nproc:
+                    running.append( _Worker(pending.pop(0)) )
+
+                for w in running[:]:
+                    r = w.poll(self._maxmem)
+                    if r is None: continue
+                    running.remove(w)
+                    n += 1
+                    results[w.index] = r
+                    if callback: callback(r)
+                    print '  [{0:>4}/{1:<4}] {2:<60} {3:<6} {4:>8.1f}s {5:>8.0f}MB'.format(n,njobs,r.label,'done' if r.ok else 'FAILED',r.elapsed,r.maxrss)
+                    sys.stdout.flush()
+
+                if running:
+                    time.sleep(self.interval)
+        finally:
+            # interrupted, or an exception from the callback: no worker left behind
+            for w in running:
+                w.kill()
+            _jobs = []
+
+        self._jobs.clear()
+        self.summary(results)
+        return results
+
+    @staticmethod
+    def summary(results):
+        failed = [ r for r in results if not r.ok ]
+        print '-'*80
+        print 'Jobs: {0} succeeded, {1} failed, {2:.1f}s summed job time'.format(len(results)-len(failed),len(failed),sum([r.elapsed for r in results]))
+        for r in failed:
+            print '  FAILED',r.label,('(log: '+r.log+')' if r.log else '')
+            print '    '+r.error.split('\n')[0]
+        print '-'*80
+        return failed
+
+    @staticmethod
+    def consolidate(results, path):
+        '''Concatenate the logs of the jobs in path, in the jobs order'''
+        with open(path,'w') as out:
+            for r in results:
+                out.write('='*80+'\n')
+                out.write('{0} : {1} in {2:.1f}s, {3:.0f}MB\n'.format(r.label,'done' if r.ok else 'FAILED',r.elapsed,r.maxrss))
+                out.write('='*80+'\n')
+                if r.log and os.path.exists(r.log):
+                    with open(r.log) as log:
+                        out.write(log.read())
+                elif r.error:
+                    out.write(r.error)
+        return path
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import zlib
+import numpy
+import histarrays
+
+#  ___                   _       ___       _
+# | _ \___ ___ _  _ __| |___  |   \ __ _| |_ __ _
+# |  _(_-</ -_) || / _` / _ \ | |) / _` |  _/ _` |
+# |_| /__/\___|\_,_\__,_\___/ |___/\__,_|\__\__,_|
+#
+# Asimov and Poisson pseudo-data on the numpy arrays of the expected yields,
+# all the bins at once. Each toy has its own random stream, seeded by the
+# campaign seed and the keys of the toy (channel, instance), so that a toy
+# is the same whatever the number of toys or channels generated with it.
+
+# _____________________________________________________________________________
+def _key(k):
+    if isinstance(k,str):
+        return zlib.crc32(k) & 0xffffffff
+    return int(k) & 0xffffffff
+
+# _____________________________________________________________________________
+def stream(seed, *keys):
+    '''The random stream of the toy identified by keys'''
+    return numpy.random.RandomState([_key(seed)]+[ _key(k) for k in keys ])
+
+# _____________________________________________________________________________
+def inrange(shape):
+    '''Mask of the in-range bins of a histogram array'''
+    mask = numpy.zeros(shape, dtype=bool)
+    mask[(slice(1,-1),)*len(shape)] = True
+    return mask
+
+# _____________________________________________________________________________
+def asimov(expected):
+    '''The expected yields rounded to counts (half to even, as TMath::Nint), negatives to 0'''
+    return numpy.maximum(numpy.rint(expected),0.)
+
+# _____________________________________________________________________________
+def poisson(expected, ntoys=1, seed=0, keys=()):
+    '''
+    ntoys Poisson fluctuations of the expected yields, as an array of shape
+    (ntoys,)+expected.shape. Toy k is drawn from stream(seed,*keys+(k,)).
+    '''
+    mean = numpy.maximum(numpy.asarray(expected,dtype=numpy.float64),0.)
+    toys = numpy.empty((ntoys,)+mean.shape)
+    for k in xrange(ntoys):
+        toys[k] = stream(seed,*(tuple(keys)+(k,))).poisson(mean)
+    return toys
+
+# _____________________________________________________________________________
+def tohist(template, counts, name, title=None):
+    '''
+    A histogram binned as template holding counts, with Poisson errors and the
+    statistics of a histogram filled at the bin centres
+    '''
+    h = template.Clone(name)
+    if title is not None:
+        h.SetTitle(title)
+    h.Reset()
+    if not h.GetSumw2N():
+        h.Sumw2()
+
+    histarrays.contents(h)[...] = counts
+    histarrays.sumw2(h)[...]    = counts
+    h.ResetStats()
+    h.SetEntries(counts.sum())
+    return h
+
+# _____________________________________________________________________________
+def tohists(template, toys, name, title=None):
+    '''One histogram per toy, named name.format(k)'''
+    return [ tohist(template,toy,name.format(k),title) for k,toy in enumerate(toys) ]
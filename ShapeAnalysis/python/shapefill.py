@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+import ROOT
+import re
+import os.path
+import time
+import logging
+import hwwtools
+import branchusage
+from HWWAnalysis.Misc.odict import OrderedDict
+
+#  ___ _ _ _ ___           _
+# | __(_) | | __|_ _  __ _(_)_ _  ___
+# | _|| | | | _|| ' \/ _` | | ' \/ -_)
+# |_| |_|_|_|___|_||_\__, |_|_||_\___|
+#                    |___/
+
+# _____________________________________________________________________________
+def chainkey(tree):
+    '''
+    Hashable description of a chain: tree name, files and friends.
+    Two chains with the same key read exactly the same entries.
+    '''
+    files = tuple([ f.GetTitle() for f in tree.GetListOfFiles() ]) if isinstance(tree,ROOT.TChain) else (tree.GetCurrentFile().GetName(),)
+
+    friends = []
+    if tree.GetListOfFriends():
+        for fe in tree.GetListOfFriends():
+            friends.append( chainkey(fe.GetTree()) )
+
+    return (tree.GetName(), files, tuple(friends))
+
+# _____________________________________________________________________________
+class Expr:
+    '''
+    A weight/selection expression as a product of factors, e.g.
+    'baseW*puW*effW*(mll>12 && zveto)' -> baseW, puW, effW, mll>12 && zveto
+
+    The factors are normalised (blanks and outer parentheses removed), so
+    that the same sub-expression is compiled once whatever the weight it
+    appears in. The selections come first, to stop the evaluation as soon as
+    a factor is null. Expressions that are not a plain product (top level
+    sums, comparisons, powers, modulos...) are kept as a single factor: a
+    modulo has the precedence of the product, a*b%c is (a*b)%c.
+    '''
+    _selection = re.compile(r'==|!=|<|>|&&|\|\|')
+    _binary    = re.compile(r'[+\-|&<>=?:!~%]')
+
+    # _____________________________________________________________________________
+    def __init__(self, expr):
+        self.expr    = expr
+        factors = self._split(self.normalize(expr))
+        # stable: selections first, then the weights
+        self.factors = tuple([ f for f in factors if self._selection.search(f) ]+[ f for f in factors if not self._selection.search(f) ])
+
+    # _____________________________________________________________________________
+    def __str__(self):
+        return '*'.join([ '('+f+')' for f in self.factors ]) if self.factors else '1'
+
+    def __repr__(self):
+        return 'Expr('+repr(str(self))+')'
+
+    def __eq__(self, other):
+        return isinstance(other,Expr) and sorted(self.factors) == sorted(other.factors)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.factors)))
+
+    # _____________________________________________________________________________
+    def __mul__(self, other):
+        return Expr(str(self)+'*'+str(other))
+
+    # _____________________________________________________________________________
+    def vector(self):
+        '''The factors as std::vector<std::string>, for MultiDraw.bookFactors'''
+        v = ROOT.std.vector('string')()
+        for f in self.factors:
+            v.push_back(f)
+        return v
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _depths(expr):
+        '''Parenthesis depth before each character, None if unbalanced'''
+        depth = 0
+        depths = []
+        for c in expr:
+            if c in ')]': depth -= 1
+            if depth < 0: return None
+            depths.append(depth)
+            if c in '([': depth += 1
+        return depths if depth == 0 else None
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def variables(var):
+        '''The variables of a draw expression, in the z:y:x order'''
+        depths = Expr._depths(var)
+        if depths is None: return [var]
+
+        cuts = [ i for i,(c,d) in enumerate(zip(var,depths)) if c == ':' and d == 0
+                 and var[i+1:i+2] != ':' and var[i-1:i] != ':' ]
+        return [ var[start+1:end] for start,end in zip([-1]+cuts,cuts+[len(var)]) ]
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def normalize(expr):
+        expr = re.sub(r'\s+','',expr)
+        while expr.startswith('(') and expr.endswith(')'):
+            depths = Expr._depths(expr[1:-1])
+            if depths is None: break
+            expr = expr[1:-1]
+        return expr
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _split(expr):
+        if not expr or expr == '1': return []
+        depths = Expr._depths(expr)
+        if depths is None: return [expr]
+
+        cuts = []
+        for i,(c,d) in enumerate(zip(expr,depths)):
+            if d > 0: continue
+            if c == '*':
+                # power operator
+                if expr[i+1:i+2] == '*' or expr[i-1:i] == '*': return [expr]
+                cuts.append(i)
+            elif Expr._binary.match(c):
+                # exponent of a number (1e-3)
+                if c in '+-' and re.search(r'[0-9.][eE]$',expr[:i]) and not re.search(r'[A-Za-z_][A-Za-z_0-9.]*[eE]$',expr[:i]): continue
+                return [expr]
+
+        if not cuts: return [expr]
+
+        factors = []
+        for start,end in zip([-1]+cuts,cuts+[len(expr)]):
+            f = Expr.normalize(expr[start+1:end])
+            if not f: return [expr]
+            # the factors in parentheses can be products themselves
+            factors += Expr._split(f) if f != expr else [f]
+        return factors
+
+# _____________________________________________________________________________
+class Booking:
+    '''One histogram to be filled with var, weighted by cut'''
+    def __init__(self, var, cut, shape, setup=()):
+        self.var      = var
+        self.cut      = cut
+        self.shape    = shape
+        self.setup    = tuple(setup)
+        self.entries  = None
+
+# _____________________________________________________________________________
+class FillEngine:
+    '''
+    Collects histogram bookings for any number of chains and fills all of
+    them reading each distinct chain only once.
+
+    Bookings are grouped by chain content (see chainkey) and by setup, the
+    list of ROOT commands that must be executed before the loop (e.g. the
+    initialisation of the compiled weight functions).
+
+    Identical bookings (same chain, setup, variable, equivalent cuts, see
+    Expr, and histogram) are filled once and shared, e.g. the backgrounds of
+    several signal models.
+
+    With restrict, only the branches read by the bookings of a chain are
+    enabled during its loop (see branchusage).
+    '''
+    _logger = logging.getLogger('FillEngine')
+    _macro  = 'HWWAnalysis/ShapeAnalysis/macros/MultiDraw.C'
+
+    # _____________________________________________________________________________
+    def __init__(self, restrict=True):
+        self._bookings = OrderedDict()
+        self._index    = {}
+        self._restrict = restrict
+        self.shared    = 0
+
+    # _____________________________________________________________________________
+    def __len__(self):
+        return sum([ len(b) for b in self._bookings.itervalues() ])
+
+    # _____________________________________________________________________________
+    @classmethod
+    def macro(cls):
+        '''Path of the compiled filler (MultiDraw)'''
+        return os.path.join(os.environ['CMSSW_BASE'],'src',cls._macro)
+
+    # _____________________________________________________________________________
+    @classmethod
+    def _load(cls):
+        if hasattr(ROOT,'MultiDraw'): return
+        hwwtools.loadAndCompile(cls.macro())
+
+    # _____________________________________________________________________________
+    def book(self, tree, var, cut, shape, setup=()):
+        '''
+        tree :  the chain to read from (only its content is retained)
+        var :   the expression to fill, 'y:x' for 2D
+        cut :   the weight/selection expression
+        shape : the histogram to fill
+        setup : commands to process before looping on the chain
+        '''
+        key = (chainkey(tree), tuple(setup))
+        ikey = key+(var, Expr(cut), self._binning(shape))
+        if ikey in self._index:
+            self.shared += 1
+            return self._index[ikey]
+
+        booking = Booking(var, cut, shape, setup)
+        self._bookings.setdefault(key,[]).append(booking)
+        self._index[ikey] = booking
+        return booking
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _binning(shape):
+        axes = [shape.GetXaxis(), shape.GetYaxis(), shape.GetZaxis()][:shape.GetDimension()]
+        edges = [ tuple([ a.GetBinLowEdge(i) for i in xrange(1,a.GetNbins()+2) ]) for a in axes ]
+        return (shape.ClassName(), shape.GetName(), tuple(edges))
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _buildchain(key):
+        name,files,friends = key
+        chain = ROOT.TChain(name)
+        for f in files:
+            chain.Add(f)
+        # keep the friends (and their own friends) alive with the chain
+        links = []
+        for k in friends:
+            friend,sublinks = FillEngine._buildchain(k)
+            chain.AddFriend(friend)
+            links.append( (friend,sublinks) )
+        return chain,links
+
+    # _____________________________________________________________________________
+    def run(self):
+        '''Loop once over each distinct chain and fill the booked histograms'''
+        self._load()
+
+        npass = len(self._bookings)
+        nbook = len(self)
+        self._logger.info('Filling %d histograms in %d passes', nbook, npass)
+        print '    FillEngine: {0} histograms ({1} shared bookings) from {2} chain passes'.format(nbook,self.shared,npass)
+
+        start = time.time()
+        for i,((key,setup),bookings) in enumerate(self._bookings.iteritems()):
+            for cmd in setup:
+                ROOT.gROOT.ProcessLineSync(cmd)
+
+            chain,links = self._buildchain(key)
+            if self._restrict:
+                branchusage.restrict(chain, sum([ [b.var,b.cut] for b in bookings ],[]))
+
+            mdraw = ROOT.MultiDraw(chain)
+            indexes = []
+            for b in bookings:
+                idx = mdraw.bookFactors(b.var, Expr(b.cut).vector(), b.shape)
+                if idx < 0:
+                    raise RuntimeError('Failed to book '+b.shape.GetName()+': '+b.var+' | '+b.cut)
+                indexes.append(idx)
+
+            t0 = time.time()
+            nread = mdraw.execute()
+            for b,idx in zip(bookings,indexes):
+                b.entries = mdraw.selected(idx)
+
+            print '    [{0:>4}/{1:<4}] {2:<40} {3:>9} entries {4:>5} histos {5:>4} formulas {6:>7.1f}s'.format(
+                i+1, npass, os.path.basename(key[1][0]) if key[1] else key[0],
+                nread, len(bookings), mdraw.nformulas(), time.time()-t0)
+
+            del mdraw
+            for friend,sublinks in links:
+                chain.RemoveFriend(friend)
+            del links
+            del chain
+
+        self._logger.info('Filled in %.1fs', time.time()-start)
+        self._bookings.clear()
+        self._index.clear()
+        self.shared = 0
+
+# _____________________________________________________________________________
+class ChainDrawer:
+    '''
+    TTree::Draw replacement keeping the chains open between calls, together
+    with their compiled formulas: the weights and the cuts are split in
+    factors (see Expr), each compiled once per chain, and reused by all the
+    following draws on the same chain content. At most maxchains chains are
+    kept, the least recently used are closed, except the ones still in use
+    (opened and not yet released, see open and release).
+
+    The chains can also be opened through the drawer (see open), to be
+    shared by all the loops reading the same files. With restrict, only the
+    branches referenced by the variables and cuts drawn so far are enabled
+    (see branchusage). With cachesize (MB) a TTreeCache is attached to each
+    chain (and friend), holding the same branches.
+    '''
+    _logger = logging.getLogger('ChainDrawer')
+
+    # _____________________________________________________________________________
+    def __init__(self, maxchains=20, cachesize=0, restrict=True):
+        self._maxchains = maxchains
+        self._cachesize = cachesize*1024*1024
+        self._restrict  = restrict
+        self._chains    = OrderedDict()
+        self._pins      = {}
+        self._caches    = []
+
+        self.draws      = 0
+        self.reused     = 0
+        self.opened     = 0
+
+    # _____________________________________________________________________________
+    def __len__(self):
+        return len(self._chains)
+
+    # _____________________________________________________________________________
+    def __contains__(self, tree):
+        return chainkey(tree) in self._chains
+
+    # _____________________________________________________________________________
+    def _get(self, key):
+        if key in self._chains:
+            self.reused += 1
+            entry = self._chains.pop(key)
+        else:
+            FillEngine._load()
+            chain,links = FillEngine._buildchain(key)
+            entry = (chain,links,ROOT.MultiDraw(chain),set())
+            self.opened += 1
+            # the chains in use are never closed, whatever the limit
+            while len(self._chains) >= self._maxchains:
+                unpinned = [ k for k in self._chains if not self._pins.get(k) ]
+                if not unpinned:
+                    self._logger.debug('%d chains in use, above the limit of %d', len(self._chains)+1, self._maxchains)
+                    break
+                self._close(unpinned[0],self._chains.pop(unpinned[0]))
+        # most recently used last
+        self._chains[key] = entry
+        return entry
+
+    # _____________________________________________________________________________
+    def _close(self, key, entry):
+        chain,links,mdraw,enabled = entry
+        self._logger.debug('Closing %s (%d formulas)', key[0], mdraw.nformulas())
+        self._caches += self._efficiencies(chain)
+        del mdraw
+        for friend,sublinks in links:
+            chain.RemoveFriend(friend)
+
+    # _____________________________________________________________________________
+    def open(self, key):
+        '''
+        The chain described by key (see chainkey), with its friends. The chain
+        is kept open and reused by the following open and draw calls, and is
+        not closed before being released as many times as it was opened.
+        '''
+        chain = self._get(key)[0]
+        self._pins[key] = self._pins.get(key,0)+1
+        return chain
+
+    # _____________________________________________________________________________
+    def release(self, tree):
+        '''Mark the chain of tree, got from open, as no longer used by the caller'''
+        key = chainkey(tree)
+        if not self._pins.get(key):
+            raise KeyError('Chain '+tree.GetName()+' released but not in use')
+        self._pins[key] -= 1
+        if not self._pins[key]:
+            del self._pins[key]
+
+    # _____________________________________________________________________________
+    def use(self, tree, exprs):
+        '''
+        Enable the branches read by exprs on the open chain of tree, to be
+        called before any other loop on the chain (e.g. to make entry lists)
+        '''
+        chain,links,mdraw,enabled = self._get(chainkey(tree))
+        if self._restrict or self._cachesize:
+            branchusage.restrict(chain, exprs, enabled, self._restrict, self._cachesize)
+
+    # _____________________________________________________________________________
+    @staticmethod
+    def _efficiencies(chain):
+        # (tree, cache hit ratio, read calls) of the cached trees
+        stats = []
+        for tree in branchusage.trees(chain):
+            f = tree.GetCurrentFile()
+            cache = f.GetCacheRead(tree) if f else None
+            if not cache: continue
+            stats.append( (tree.GetName(),cache.GetEfficiency(),f.GetReadCalls()) )
+        return stats
+
+    # _____________________________________________________________________________
+    def draw(self, tree, var, cut, shape, elist=None):
+        '''
+        Fill shape with var weighted by cut, as tree.Draw(var+'>>'+shape, cut),
+        restricted to the entries of elist if given. Returns the number of
+        selected entries.
+        '''
+        chain,links,mdraw,enabled = self._get(chainkey(tree))
+
+        if self._restrict or self._cachesize:
+            branchusage.restrict(chain, [var,cut], enabled, self._restrict, self._cachesize)
+
+        mdraw.clear()
+        idx = mdraw.bookFactors(var, Expr(cut).vector(), shape)
+        if idx < 0:
+            raise RuntimeError('Failed to book '+shape.GetName()+': '+var+' | '+cut)
+
+        chain.SetEntryList(elist if elist else 0x0)
+        try:
+            mdraw.execute()
+        finally:
+            chain.SetEntryList(0x0)
+            
+        self.draws += 1
+        return mdraw.selected(idx)
+
+    # _____________________________________________________________________________
+    def clear(self):
+        self._pins.clear()
+        while self._chains:
+            self._close(*self._chains.popitem(0))
+
+    # _____________________________________________________________________________
+    def report(self):
+        print 'ChainDrawer: {0} draws, {1} chains opened, {2} reused, {3} chains open'.format(self.draws, self.opened, self.reused, len(self._chains))
+        stats = self._caches+sum([ self._efficiencies(e[0]) for e in self._chains.itervalues() ],[])
+        if not stats: return
+        ratios = [ r for n,r,c in stats ]
+        print '    TTreeCache: {0} trees, hit ratio {1:.2f} (min {2:.2f}), {3} read calls'.format(len(stats),sum(ratios)/len(ratios),min(ratios),sum([ c for n,r,c in stats ]))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+from entrycache import EntryListCache
+from HWWAnalysis.Misc.odict import OrderedDict
+
+#  ___ _                  ___ _
+# / __| |_  __ _ _ __  __/ __| |_ __ _ _ __  _ __ ___
+# \__ \ ' \/ _` | '_ \/ -_)__ \  _/ _` | '  \| '_ (_-<
+# |___/_||_\__,_| .__/\___|___/\__\__,_|_|_|_| .__/__/
+#               |_|                          |_|
+
+def _digest(obj):
+    return hashlib.sha1(repr(obj)).hexdigest()
+
+class ShapeStamps:
+    '''
+    Fingerprints of the shape files, to rebuild only the outdated ones.
+
+    Each shape file comes with a sidecar <shape file>.stamp.json holding the
+    digests of what it was made of: the input chains of each process (files,
+    sizes and modification times, friends included), the selection and
+    weight of each process, the weight initialisations, the variable and
+    binning, and the code version (digest of the sources of the modules
+    producing the shapes). A shape is rebuilt when any of them changed, and
+    the components that differ are reported as the reason.
+    '''
+    _log = logging.getLogger('ShapeStamps')
+    _suffix = '.stamp.json'
+
+    # ---
+    def __init__(self, modules=[], force=False):
+        self._force   = force
+        self._code    = self.codeversion(modules)
+        self._pending = {}
+
+        self.skipped  = []
+        self.rebuilt  = []
+
+    # ---
+    @staticmethod
+    def codeversion(modules):
+        '''Digest of the sources of the modules (or paths)'''
+        sources = []
+        for m in modules:
+            path = m if isinstance(m,str) else m.__file__
+            if path.endswith('.pyc'): path = path[:-1]
+            sources.append( (os.path.basename(path), hashlib.sha1(open(path).read()).hexdigest()) )
+        return _digest(sorted(sources))
+
+    # ---
+    def fingerprint(self, var, rng, selections, inputs, setups=None, inits=(), options=None):
+        '''The component digests of a shape file'''
+        if setups is None:  setups = {}
+        if options is None: options = {}
+        return OrderedDict([
+            ('inputs',     dict([ (p,_digest(EntryListCache._content(t))) for p,t in inputs.iteritems() ])),
+            ('selections', dict([ (p,_digest(EntryListCache.normalize(selections[p]))) for p in inputs ])),
+            ('weights',    _digest( (sorted(setups.items()),list(inits)) )),
+            ('variable',   _digest( (var,rng,sorted(options.items())) )),
+            ('code',       self._code),
+        ])
+
+    # ---
+    @staticmethod
+    def _load(output):
+        try:
+            with open(output+ShapeStamps._suffix) as f:
+                return json.load(f)
+        except (IOError,ValueError):
+            return None
+
+    # ---
+    @staticmethod
+    def _differences(old, new):
+        reasons = []
+        for component,digest in new.iteritems():
+            before = old.get(component)
+            if digest == before: continue
+            if not isinstance(digest,dict) or not isinstance(before,dict):
+                reasons.append(component)
+                continue
+            changed = sorted([ p for p in digest if digest[p] != before.get(p) ])
+            removed = sorted([ p for p in before if p not in digest ])
+            if changed: reasons.append('%s of %s' % (component,','.join(changed)))
+            if removed: reasons.append('%s removed: %s' % (component,','.join(removed)))
+        return reasons
+
+    # ---
+    def check(self, output, stamp):
+        '''
+        True if output is up to date with stamp. Otherwise the old sidecar is
+        removed and stamp is kept until commit(output) is called, once the
+        output has been written.
+        '''
+        old = self._load(output)
+        if self._force:
+            reasons = ['forced']
+        elif not os.path.exists(output):
+            reasons = ['missing output']
+        elif old is None:
+            reasons = ['no fingerprint']
+        else:
+            reasons = self._differences(old,stamp)
+
+        if not reasons:
+            self.skipped.append(output)
+            self._log.info('%s up to date', output)
+            return True
+
+        if old is not None:
+            os.remove(output+self._suffix)
+        self._pending[output] = stamp
+        self.rebuilt.append( (output,reasons) )
+        self._log.info('%s to be rebuilt: %s', output, ', '.join(reasons))
+        return False
+
+    # ---
+    def commit(self, output):
+        '''Write the sidecar of an output once rebuilt'''
+        stamp = self._pending.pop(output,None)
+        if stamp is None: return
+        with open(output+self._suffix,'w') as f:
+            json.dump(stamp,f,indent=1)
+
+    # ---
+    def report(self):
+        print 'Shape files: {0} rebuilt, {1} up to date'.format(len(self.rebuilt),len(self.skipped))
+        for output,reasons in self.rebuilt:
+            print '    {0} : {1}'.format(os.path.basename(output),', '.join(reasons))
@@ -1,6 +1,7 @@
 import ROOT
 from array import array
 import os, re
+import yrtables
 from math import *
 
 def file2mapold(file):
@@ -13,17 +14,8 @@ def file2mapold(file):
     return map
 
 def file2map(x):
-        ret = {}; headers = []
-        for x in open(x,"r"):
-            cols = x.split()
-            if len(cols) < 2: continue
-            if "mH" in x:
-                headers = [i.strip() for i in cols[1:]]
-            else:
-                fields = [ float(i) for i in cols ]
-                #ret[fields[0]] = dict(zip(headers,fields[1:]))
-                ret[fields[0]] = [float(y) for y in fields[1:]]
-        return ret
+        # parsed once per process, the map is shared
+        return yrtables.rows(x)
 
 def juerg2map(file):
     map = {}
@@ -33,32 +25,6 @@ def juerg2map(file):
         map[fields[0]] = [float(y) for y in fields[1:]]
     return map
 
-YR_ggH         = {}
-YR_vbfH        = {}
-YR_wzttH       = {}
-YR_wH          = {}
-YR_zH          = {}
-YR_ttH         = {}
-
-ggH_pdfErrYR   = {}
-ggH_scaErrYR   = {}
-vbfH_pdfErrYR  = {}
-vbfH_scaErrYR  = {}
-wzttH_pdfErrYR = {}
-wzttH_scaErrYR = {}
-
-wH_pdfErrYR    = {}
-wH_scaErrYR    = {}
-
-zH_pdfErrYR    = {}
-zH_scaErrYR    = {}
-
-ttH_pdfErrYR   = {}
-ttH_scaErrYR   = {}
-
-HWW_BR         = {}
-HWW_BR_vals    = {}
-
 SYST_PATH      = os.getenv('CMSSW_BASE')+'/src/HWWAnalysis/ShapeAnalysis/data/nuisances/'
 ggH_jets = dict([(m, dict(zip(['f0','f1','f2','k1','k2'], vals))) for m,vals in file2map(SYST_PATH+"ggH_jetBins.txt").items()]) 
 ggH_jets2 = dict([(m, dict(zip(['0','1in0','1in1','2in1','2in2'], vals))) for m,vals in file2map(SYST_PATH+"ggH_jetBinNuisances.txt").items()]) 
@@ -71,33 +37,18 @@ ggH_intf = dict([(m, dict(zip(['intf'], vals))) for m,vals in file2map(SYST_PATH
 
 
 
-def loadYRSyst(YRVersion=3,Energy='8TeV') :
-
-    global YR_ggH   
-    global YR_vbfH  
-    global YR_wzttH  
-    global YR_wH      
-    global YR_zH       
-    global YR_ttH       
-
-    global HWW_BR
-    global HWW_BR_vals
+# the YR tables and the derived errors, by (YRVersion,Energy): read only once
+_YRSyst = {}
 
-    global ggH_pdfErrYR  
-    global ggH_scaErrYR   
-    global vbfH_pdfErrYR  
-    global vbfH_scaErrYR  
-    global wzttH_pdfErrYR 
-    global wzttH_scaErrYR 
-
-    global wH_pdfErrYR    
-    global wH_scaErrYR
+def loadYRSyst(YRVersion=3,Energy='8TeV') :
+    '''The YR tables and the derived errors of (YRVersion,Energy), by name (see _readYRSyst)'''
+    if (YRVersion,Energy) not in _YRSyst:
+        _YRSyst[(YRVersion,Energy)] = _readYRSyst(YRVersion,Energy)
+    return _YRSyst[(YRVersion,Energy)]
 
-    global zH_pdfErrYR 
-    global zH_scaErrYR  
+def _readYRSyst(YRVersion,Energy) :
 
-    global ttH_pdfErrYR  
-    global ttH_scaErrYR   
+    YR_wzttH       = {}
 
     if YRVersion == 1 :
       print '\033[0;31m FIXME:  Old Yellow Report in use, 7TeV only!!!!!  \033[m'
@@ -144,29 +95,39 @@ def loadYRSyst(YRVersion=3,Energy='8TeV') :
         vbfH_pdfErrYR[X] = 0.5*(vbfH_pdfErrYR[X-10]+vbfH_pdfErrYR[X+10])
         vbfH_scaErrYR[X] = 0.5*(vbfH_scaErrYR[X-10]+vbfH_scaErrYR[X+10])
 
+    return {
+        'YR_ggH'         : YR_ggH,
+        'YR_vbfH'        : YR_vbfH,
+        'YR_wzttH'       : YR_wzttH,
+        'YR_wH'          : YR_wH,
+        'YR_zH'          : YR_zH,
+        'YR_ttH'         : YR_ttH,
+        'HWW_BR'         : HWW_BR,
+        'HWW_BR_vals'    : HWW_BR_vals,
+        'ggH_pdfErrYR'   : ggH_pdfErrYR,
+        'ggH_scaErrYR'   : ggH_scaErrYR,
+        'vbfH_pdfErrYR'  : vbfH_pdfErrYR,
+        'vbfH_scaErrYR'  : vbfH_scaErrYR,
+        'wzttH_pdfErrYR' : wzttH_pdfErrYR,
+        'wzttH_scaErrYR' : wzttH_scaErrYR,
+        'wH_pdfErrYR'    : wH_pdfErrYR,
+        'wH_scaErrYR'    : wH_scaErrYR,
+        'zH_pdfErrYR'    : zH_pdfErrYR,
+        'zH_scaErrYR'    : zH_scaErrYR,
+        'ttH_pdfErrYR'   : ttH_pdfErrYR,
+        'ttH_scaErrYR'   : ttH_scaErrYR,
+    }
+
 # ----------------------------------------------------- Add point if needed to YR ------------------------
 
 def GetYRVal(YRDic,iMass):
-
-    if iMass in YRDic :
-       #print iMass,YRDic[iMass][Key]
-       return YRDic[iMass]
-    else:
-       n=len(YRDic.keys())
-       x=[]
-       y=[]
-       for jMass in sorted(YRDic.keys()):
-         x.append(jMass)
-         y.append(YRDic[jMass])
-       gr = ROOT.TGraph(n,array('f',x),array('f',y));
-       sp = ROOT.TSpline3("YR",gr);
-       #print iMass,sp.Eval(iMass)
-       return sp.Eval(iMass)
+    # the spline of each map is built once
+    return yrtables.value(YRDic,iMass)
 
 
 def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactive,Energy,newInterf=False,YRVersion=3,mh_SM=125.,mh_SM2=125.,ewksinglet=False ):
 
-    loadYRSyst(YRVersion,Energy)
+    yr = loadYRSyst(YRVersion,Energy)
 
     nuisances = {} 
     #MCPROC = ['ggH', 'vbfH', 'DTT', 'ggWW', 'VV', 'Vg' ]; 
@@ -185,9 +146,9 @@ def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactiv
     if '7TeV' in suffix: lumiunc = 1.022
     nuisances['lumi'+suffix] = [ ['lnN'], dict([(p,lumiunc) for p in MCPROC if p!='DYTT' and p!='Top'])]
     # -- PDF ---------------------
-    #nuisances['pdf_gg']    = [ ['lnN'], { 'ggH':ggH_pdfErrYR[mass], 'ggWW':(1.00 if qqWWfromData else 1.04) }]
-    nuisances['pdf_gg']    = [ ['lnN'], { 'ggH'    : GetYRVal(ggH_pdfErrYR,mass), 
-                                          'ggH_SM' : GetYRVal(ggH_pdfErrYR,mh_SM),
+    #nuisances['pdf_gg']    = [ ['lnN'], { 'ggH':yr['ggH_pdfErrYR'][mass], 'ggWW':(1.00 if qqWWfromData else 1.04) }]
+    nuisances['pdf_gg']    = [ ['lnN'], { 'ggH'    : GetYRVal(yr['ggH_pdfErrYR'],mass), 
+                                          'ggH_SM' : GetYRVal(yr['ggH_pdfErrYR'],mh_SM),
                                           'ggWW'   : 1.04 ,  # 4% uncertainty by Xavier and Guillelmo studies
                                           # for Higgsw width
                                           'ggH_sbi'   : 1.04 ,
@@ -195,16 +156,16 @@ def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactiv
                                           'ggH_s'     : 1.04 ,
                                         }]
 
-    nuisances['pdf_qqbar'] = [ ['lnN'], { #'wzttH' :(1.0 if mass>300 else wzttH_pdfErrYR[mass]),  
-                                          'WH'    :(1.0 if mass>300 else GetYRVal(wH_pdfErrYR,mass)),  
-                                          'ZH'    :(1.0 if mass>300 else GetYRVal(zH_pdfErrYR,mass)), 
-                                          'ttH'   :(1.0 if mass>300 else GetYRVal(ttH_pdfErrYR,mass)), 
-                                          'qqH'   :GetYRVal(vbfH_pdfErrYR,mass), 
-                                          #'wzttH_SM' :(1.0 if mh_SM>300 else wzttH_pdfErrYR[mh_SM]),  
-                                          'WH_SM'    :(1.0 if mh_SM>300 else GetYRVal(wH_pdfErrYR,mh_SM)),  
-                                          'ZH_SM'    :(1.0 if mh_SM>300 else GetYRVal(zH_pdfErrYR,mh_SM)), 
-                                          'ttH_SM'   :(1.0 if mh_SM>300 else GetYRVal(ttH_pdfErrYR,mh_SM)), 
-                                          'qqH_SM'   :GetYRVal(vbfH_pdfErrYR,mh_SM), 
+    nuisances['pdf_qqbar'] = [ ['lnN'], { #'wzttH' :(1.0 if mass>300 else yr['wzttH_pdfErrYR'][mass]),  
+                                          'WH'    :(1.0 if mass>300 else GetYRVal(yr['wH_pdfErrYR'],mass)),  
+                                          'ZH'    :(1.0 if mass>300 else GetYRVal(yr['zH_pdfErrYR'],mass)), 
+                                          'ttH'   :(1.0 if mass>300 else GetYRVal(yr['ttH_pdfErrYR'],mass)), 
+                                          'qqH'   :GetYRVal(yr['vbfH_pdfErrYR'],mass), 
+                                          #'wzttH_SM' :(1.0 if mh_SM>300 else yr['wzttH_pdfErrYR'][mh_SM]),  
+                                          'WH_SM'    :(1.0 if mh_SM>300 else GetYRVal(yr['wH_pdfErrYR'],mh_SM)),  
+                                          'ZH_SM'    :(1.0 if mh_SM>300 else GetYRVal(yr['zH_pdfErrYR'],mh_SM)), 
+                                          'ttH_SM'   :(1.0 if mh_SM>300 else GetYRVal(yr['ttH_pdfErrYR'],mh_SM)), 
+                                          'qqH_SM'   :GetYRVal(yr['vbfH_pdfErrYR'],mh_SM), 
                                           'VV':1.04, 
                                           'WW':(1.0 if qqWWfromData else 1.04),  # 4% uncertainty by Xavier and Guillelmo studies
                                           # for Higgsw width
@@ -258,10 +219,10 @@ def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactiv
 
     if jets == 0:
         # appendix D of https://indico.cern.ch/getFile.py/access?contribId=0&resId=0&materialId=0&confId=135333
-        k0 = pow(GetYRVal(ggH_scaErrYR,mass),     1/ggH_jets[mass]['f0'])
+        k0 = pow(GetYRVal(yr['ggH_scaErrYR'],mass),     1/ggH_jets[mass]['f0'])
         k1 = pow(ggH_jets[mass]['k1'], 1-1/ggH_jets[mass]['f0']) # -f1-f2=f0-1
         # ... and _SM:
-        k0_SM = pow(GetYRVal(ggH_scaErrYR,mh_SM),    1/ggH_jets[mh_SM2]['f0'])
+        k0_SM = pow(GetYRVal(yr['ggH_scaErrYR'],mh_SM),    1/ggH_jets[mh_SM2]['f0'])
         k1_SM = pow(ggH_jets[mh_SM2]['k1'], 1-1/ggH_jets[mh_SM2]['f0']) # -f1-f2=f0-1
         #nuisances['QCDscale_ggH']    = [  ['lnN'], { 'ggH':k0, 'ggH_SM':k0_SM }]
         #nuisances['QCDscale_ggH1in'] = [  ['lnN'], { 'ggH':k1, 'ggH_SM':k1_SM }]
@@ -303,21 +264,21 @@ def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactiv
                nuisances['QCDscale_WWewk']     = [ ['lnN'], {'WWewk':1.20 }]
 
     nuisances['QCDscale_ggWW'] = [ ['lnN'], {'ggWW': 1.30}]
-    nuisances['QCDscale_qqH']  = [ ['lnN'], { 'qqH':GetYRVal(vbfH_scaErrYR,mass) , 'qqH_SM':GetYRVal(vbfH_scaErrYR,mh_SM) }]
+    nuisances['QCDscale_qqH']  = [ ['lnN'], { 'qqH':GetYRVal(yr['vbfH_scaErrYR'],mass) , 'qqH_SM':GetYRVal(yr['vbfH_scaErrYR'],mh_SM) }]
 
     nuisances['QCDscale_VH']  = [ ['lnN'] , {} ]
     nuisances['QCDscale_wH']  = [ ['lnN'] , {} ]
     nuisances['QCDscale_zH']  = [ ['lnN'] , {} ]
     nuisances['QCDscale_ttH'] = [ ['lnN'] , {} ]
-    if mass in wzttH_scaErrYR: nuisances['QCDscale_VH']  = [ ['lnN'], { 'wzttH':wzttH_scaErrYR[mass]}]
-    if mass in wH_scaErrYR :   nuisances['QCDscale_wH']  = [ ['lnN'], { 'WH'   :wH_scaErrYR[mass]}]
-    if mass in zH_scaErrYR :   nuisances['QCDscale_zH']  = [ ['lnN'], { 'ZH'   :wH_scaErrYR[mass]}]
-    if mass in ttH_scaErrYR:   nuisances['QCDscale_ttH'] = [ ['lnN'], {'ttH'   :wH_scaErrYR[mass]}]
+    if mass in yr['wzttH_scaErrYR']: nuisances['QCDscale_VH']  = [ ['lnN'], { 'wzttH':yr['wzttH_scaErrYR'][mass]}]
+    if mass in yr['wH_scaErrYR'] :   nuisances['QCDscale_wH']  = [ ['lnN'], { 'WH'   :yr['wH_scaErrYR'][mass]}]
+    if mass in yr['zH_scaErrYR'] :   nuisances['QCDscale_zH']  = [ ['lnN'], { 'ZH'   :yr['wH_scaErrYR'][mass]}]
+    if mass in yr['ttH_scaErrYR']:   nuisances['QCDscale_ttH'] = [ ['lnN'], {'ttH'   :yr['wH_scaErrYR'][mass]}]
     # ... and _SM:
-    if mh_SM in wzttH_scaErrYR: nuisances['QCDscale_VH'][1] ['wzttH_SM']= wzttH_scaErrYR[mh_SM]
-    if mh_SM in wH_scaErrYR :   nuisances['QCDscale_wH'][1] ['WH_SM']   = wH_scaErrYR[mh_SM]
-    if mh_SM in zH_scaErrYR :   nuisances['QCDscale_zH'][1] ['ZH_SM']   = wH_scaErrYR[mh_SM]
-    if mh_SM in ttH_scaErrYR:   nuisances['QCDscale_ttH'][1]['ttH_SM']  = wH_scaErrYR[mh_SM]
+    if mh_SM in yr['wzttH_scaErrYR']: nuisances['QCDscale_VH'][1] ['wzttH_SM']= yr['wzttH_scaErrYR'][mh_SM]
+    if mh_SM in yr['wH_scaErrYR'] :   nuisances['QCDscale_wH'][1] ['WH_SM']   = yr['wH_scaErrYR'][mh_SM]
+    if mh_SM in yr['zH_scaErrYR'] :   nuisances['QCDscale_zH'][1] ['ZH_SM']   = yr['wH_scaErrYR'][mh_SM]
+    if mh_SM in yr['ttH_scaErrYR']:   nuisances['QCDscale_ttH'][1]['ttH_SM']  = yr['wH_scaErrYR'][mh_SM]
     if nuisances['QCDscale_VH'][1]  == {} : nuisances.pop('QCDscale_VH')
     if nuisances['QCDscale_wH'][1]  == {} : nuisances.pop('QCDscale_wH')
     if nuisances['QCDscale_zH'][1]  == {} : nuisances.pop('QCDscale_zH')
@@ -390,8 +351,8 @@ def getCommonSysts(mass,channel,jets,qqWWfromData,shape,options,suffix,isssactiv
          nuisances['interf_ggH125'] = [ ['lnN'], {'ggH':1.00}]
 
     # BR H > VV uncertainty
-    BRunc    = 1.+GetYRVal(HWW_BR_vals,mass)/100.
-    BRunc_SM = 1.+GetYRVal(HWW_BR_vals,mh_SM)/100.
+    BRunc    = 1.+GetYRVal(yr['HWW_BR_vals'],mass)/100.
+    BRunc_SM = 1.+GetYRVal(yr['HWW_BR_vals'],mh_SM)/100.
     print "BR UNCERTAINIES: ",BRunc,BRunc_SM
     nuisances['BRhiggs_hvv'] = [ ['lnN'], {'ggH':BRunc, 'qqH':BRunc, 'ZH':BRunc , 'WH':BRunc , 'ggH_sbi':BRunc, 'ggH_b':BRunc, 'ggH_s':BRunc, 'qqH_sbi':BRunc, 'qqH_b':BRunc, 'qqH_s':BRunc , 'ggH_SM':BRunc_SM , 'qqH_SM':BRunc_SM , 'ZH_SM':BRunc_SM , 'WH_SM':BRunc_SM }]
 
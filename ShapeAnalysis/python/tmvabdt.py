@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import os
+import numpy
+import logging
+import xml.etree.cElementTree as ElementTree
+
+#  ____  ___  _____
+# | __ )|   \|_   _|
+# |  _ \| |) | | |
+# |____/|___/  |_|
+#
+# Batched evaluation of the TMVA BDTs: the forest is read from the weights xml
+# and all the trees are evaluated at once on numpy blocks of events, instead of
+# calling TMVA::Reader::EvaluateMVA event by event.
+
+# _____________________________________________________________________________
+class BDT:
+    '''
+    A TMVA BDT (AdaBoost, Bagging or Grad) stored as flat arrays of nodes.
+
+    Node i of the forest cuts on variable ivar[i] at cut[i]; an event goes to
+    right[i] if (x >= cut) == ctype[i], to left[i] otherwise. Leaves point to
+    themselves, so that all the trees can be walked in lockstep for depth steps.
+    '''
+    _log = logging.getLogger('BDT')
+
+    # events x trees processed at the same time
+    blocksize = 2**22
+    # the boostings whose response is reproduced: the boost-weighted average
+    # of the leaves (AdaBoost, Bagging) or the sum of the residuals (Grad)
+    boosts = ('AdaBoost','Bagging','Grad')
+
+    # _____________________________________________________________________________
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+
+        root = ElementTree.parse(path).getroot()
+
+        self.method = root.get('Method')
+        options = dict([ (o.get('name'),o.text) for o in root.iter('Option') ])
+        self.boost    = options.get('BoostType','AdaBoost')
+        if self.boost not in self.boosts:
+            raise ValueError('BoostType %s not supported: %s' % (self.boost,path))
+        self.yesnoleaf = options.get('UseYesNoLeaf','True') in ('True','T','true','1')
+
+        self.variables = [ v.get('Expression') for v in root.find('Variables').findall('Variable') ]
+
+        transformations = root.find('Transformations')
+        if transformations is not None and int(transformations.get('NTransformations','0')) > 0:
+            raise ValueError('Input variable transformations not supported: '+path)
+
+        self._build(root.find('Weights').findall('BinaryTree'))
+        self._log.info('%s: %d trees, %d nodes, depth %d (%s)', os.path.basename(path), self.ntrees, len(self.ivar), self.depth, self.boost)
+
+    # _____________________________________________________________________________
+    def _build(self, trees):
+        ivar, cut, ctype, left, right, value = [],[],[],[],[],[]
+        roots, weights = [],[]
+        depth = 0
+
+        for tree in trees:
+            weights.append( float(tree.get('boostWeight','1')) )
+            stack = [ (tree.find('Node'),None,0) ]
+            while stack:
+                node,parent,d = stack.pop()
+                i = len(ivar)
+                if parent is None:
+                    roots.append(i)
+                else:
+                    p,pos = parent
+                    if pos == 'l': left[p] = i
+                    else:          right[p] = i
+
+                depth = max(depth,d)
+                children = node.findall('Node')
+                leaf = int(node.get('nType')) != 0 or not children
+
+                ivar.append( max(int(node.get('IVar')),0) )
+                cut.append( float(node.get('Cut')) )
+                ctype.append( bool(int(node.get('cType'))) )
+                left.append(i)
+                right.append(i)
+                if self.boost == 'Grad':
+                    value.append( float(node.get('res')) )
+                elif self.yesnoleaf:
+                    value.append( float(node.get('nType')) )
+                else:
+                    value.append( float(node.get('purity')) )
+
+                if not leaf:
+                    for child in children:
+                        stack.append( (child,(i,child.get('pos')),d+1) )
+
+        # TMVA stores the cuts and the event values in single precision
+        self.ivar    = numpy.array(ivar,  dtype=numpy.int32)
+        self.cut     = numpy.array(cut,   dtype=numpy.float32)
+        self.ctype   = numpy.array(ctype, dtype=bool)
+        self.left    = numpy.array(left,  dtype=numpy.int32)
+        self.right   = numpy.array(right, dtype=numpy.int32)
+        self.value   = numpy.array(value, dtype=numpy.float64)
+        self.roots   = numpy.array(roots, dtype=numpy.int32)
+        self.weights = numpy.array(weights, dtype=numpy.float64)
+        self.ntrees  = len(roots)
+        self.depth   = depth
+
+    # _____________________________________________________________________________
+    def _matrix(self, columns):
+        '''columns: dict by variable expression, or sequence of arrays in the variables order'''
+        if isinstance(columns,dict):
+            columns = [ columns[v] for v in self.variables ]
+        if len(columns) != len(self.variables):
+            raise ValueError('%d variables expected, %d given' % (len(self.variables),len(columns)))
+        return numpy.vstack([ numpy.asarray(c,dtype=numpy.float32) for c in columns ])
+
+    # _____________________________________________________________________________
+    def evaluate(self, columns):
+        '''The BDT response for each event of the columns'''
+        x = self._matrix(columns)
+        n = x.shape[1]
+
+        response = numpy.empty(n, dtype=numpy.float64)
+        step = max(1,self.blocksize/max(1,self.ntrees))
+        for first in xrange(0,n,step):
+            last = min(n,first+step)
+            response[first:last] = self._evaluate(x[:,first:last])
+        return response
+
+    # _____________________________________________________________________________
+    def _evaluate(self, x):
+        n = x.shape[1]
+        events = numpy.arange(n)[numpy.newaxis,:]
+
+        # one row per tree, one column per event
+        node = numpy.repeat(self.roots[:,numpy.newaxis],n,axis=1)
+        for d in xrange(self.depth):
+            goright = (x[self.ivar[node],events] >= self.cut[node]) == self.ctype[node]
+            node = numpy.where(goright, self.right[node], self.left[node])
+
+        leaves = self.value[node]
+        if self.boost == 'Grad':
+            return 2./(1.+numpy.exp(-2.*leaves.sum(axis=0)))-1.
+
+        norm = self.weights.sum()
+        if norm <= numpy.finfo(float).eps:
+            return numpy.zeros(n)
+        return numpy.dot(self.weights,leaves)/norm
+
+    # _____________________________________________________________________________
+    def crosscheck(self, columns, nmax=1000, tolerance=1e-5):
+        '''
+        Compare the batched response with TMVA::Reader::EvaluateMVA on the
+        first nmax events. Returns the largest difference, raises if larger
+        than tolerance.
+        '''
+        import ROOT
+
+        x = self._matrix(columns)[:,:nmax]
+        batched = self.evaluate(x)
+
+        method = self.method.split('::')[-1]
+        if not self._reader:
+            buffers = [ numpy.zeros(1, dtype=numpy.float32) for v in self.variables ]
+            reader = ROOT.TMVA.Reader('Silent')
+            for v,b in zip(self.variables,buffers):
+                reader.AddVariable(v,b)
+            reader.BookMVA(method,self.path)
+            self._reader = (reader,buffers)
+        reader,buffers = self._reader
+
+        worst = 0.
+        for i in xrange(x.shape[1]):
+            for j,b in enumerate(buffers):
+                b[0] = x[j,i]
+            worst = max(worst,abs(reader.EvaluateMVA(method)-batched[i]))
+
+        self._log.info('%s: max difference with EvaluateMVA %g on %d events', os.path.basename(self.path), worst, x.shape[1])
+        if worst > tolerance:
+            raise RuntimeError('Batched evaluation of %s differs from EvaluateMVA by %g' % (self.path,worst))
+        return worst
+
+#  ___ __   ____  ____   ___
+# |   \\ \ / /  \/  \ \ / /_\
+# | |) |\ V /| |\/| |\ V / _ \
+# |___/  |_| |_|  |_| \_/_/ \_\
+#
+
+# _____________________________________________________________________________
+class DYMVA:
+    '''
+    The DY MVAs, by version and jet bin, with their inputs as latino branches.
+    dymva0 uses the BDTB trainings, dymva1 the metshift BDTG ones.
+    '''
+    _weights = {
+        (0,0) : 'TMVA_0j_BDTB.weights.xml',
+        (0,1) : 'TMVA_1j_BDTB.weights.xml',
+        (1,0) : 'TMVA_0j_metshift_BDTG.weights.xml',
+        (1,1) : 'TMVA_1j_metshift_BDTG.weights.xml',
+    }
+
+    inputs = {
+        0 : ['pfmet','chmet','jetpt1','pfmetSignificance','dphilljet1','dphimetjet1','mth'],
+        1 : ['ppfmet','pchmet','nvtx','ptll','jetpt1','pfmetMEtSig','dphilljet1','dphillmet','dphimetjet1','recoil','mth'],
+    }
+
+    # _____________________________________________________________________________
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.getenv('CMSSW_BASE'),'src/DYMvaInCMSSW/GetDYMVA/data')
+        self._bdts = dict([ (k,BDT(os.path.join(path,f))) for k,f in self._weights.iteritems() ])
+
+    # _____________________________________________________________________________
+    def evaluate(self, version, columns, crosscheck=0):
+        '''
+        The DY MVA of the given version for each event, -999 beyond 1 jet.
+        columns must contain njet and the inputs of the version.
+        '''
+        njet = numpy.asarray(columns['njet'])
+        mva = numpy.empty(len(njet), dtype=numpy.float64)
+        mva.fill(-999.)
+
+        for nj in [0,1]:
+            selected = (njet == nj)
+            if not selected.any(): continue
+            bdt = self._bdts[(version,nj)]
+            inputs = [ numpy.asarray(columns[b])[selected] for b in self.inputs[version] ]
+            mva[selected] = bdt.evaluate(inputs)
+            if crosscheck:
+                bdt.crosscheck(inputs,crosscheck)
+        return mva
@@ -1,4 +1,5 @@
 from tree.gardening import TreeCloner
+from HWWAnalysis.ShapeAnalysis.tmvabdt import DYMVA
 
 
 import optparse
@@ -22,10 +23,16 @@ import math
 #
 #
 
+def _dphi(phi1,phi2):
+    '''|phi1-phi2| in [0,pi], on numpy arrays'''
+    return numpy.abs( numpy.mod(phi1-phi2+numpy.pi,2*numpy.pi)-numpy.pi )
+
 class DymvaVarFiller(TreeCloner):
 
     def __init__(self):
-        pass
+        self.getDYMVAV0j0 = None
+        self.dymva = None
+        self.crosscheck = 0
 
 
     def createDYMVA(self):
@@ -106,23 +113,47 @@ class DymvaVarFiller(TreeCloner):
 
 
     def addOptions(self,parser):
-        #description = self.help()
-        #group = optparse.OptionGroup(parser,self.label, description)
-        #group.add_option('-b', '--branch',   dest='branch', help='Name of something that is not used ... ', default='boh')
-        #parser.add_option_group(group)
-        #return group
-        pass
+        description = self.help()
+        group = optparse.OptionGroup(parser,self.label, description)
+        group.add_option('--crosscheck', dest='crosscheck', type='int', help='Columnar mode: compare the first N events of each block with EvaluateMVA', default=0)
+        parser.add_option_group(group)
+        return group
 
 
     def checkOptions(self,opts):
-        pass
+        self.crosscheck = opts.crosscheck
 
-    def process(self,**kwargs):
+    def inputs(self):
+        return ['pt1','phi1','pt2','phi2','pfmet','pfmetphi','chmet','jetpt1','jetphi1','njet',
+                'pfmetSignificance','mth','ppfmet','pchmet','nvtx','ptll','pfmetMEtSig','dphillmet']
 
-        self.getDYMVAV0j0 = None
-        self.getDYMVAV0j1 = None
-        self.getDYMVAV0j0 = None
-        self.getDYMVAV1j1 = None
+    def outputs(self):
+        return [ (b,'F') for b in ['dymva0new', 'dymva1new', 'dphilljet1', 'dphimetjet1', 'recoil'] ]
+
+    def compute(self,columns):
+        # the forests are read once and evaluated on the whole block
+        if not self.dymva: self.dymva = DYMVA()
+
+        c = dict([ (k,numpy.asarray(v,dtype=numpy.float64)) for k,v in columns.iteritems() ])
+
+        pxll = c['pt1']*numpy.cos(c['phi1']) + c['pt2']*numpy.cos(c['phi2'])
+        pyll = c['pt1']*numpy.sin(c['phi1']) + c['pt2']*numpy.sin(c['phi2'])
+        pxmet = c['pfmet']*numpy.cos(c['pfmetphi'])
+        pymet = c['pfmet']*numpy.sin(c['pfmetphi'])
+
+        hasjet = c['jetpt1'] >= 15
+        new = {}
+        new['dphilljet1']  = numpy.where(hasjet, _dphi(numpy.arctan2(pyll,pxll),c['jetphi1']), -0.1)
+        new['dphimetjet1'] = numpy.where(hasjet, _dphi(numpy.arctan2(pymet,pxmet),c['jetphi1']), -0.1)
+        new['recoil']      = numpy.sqrt( (pxmet+pxll)**2 + (pymet+pyll)**2 )
+
+        # the mva inputs are single precision in the event loop as well
+        c.update( [ (k,v.astype(numpy.float32)) for k,v in new.iteritems() ] )
+        new['dymva0new'] = self.dymva.evaluate(0, c, self.crosscheck)
+        new['dymva1new'] = self.dymva.evaluate(1, c, self.crosscheck)
+        return new
+
+    def createBuffers(self):
         self.var1 = numpy.ones(1, dtype=numpy.float32)
         self.var2 = numpy.ones(1, dtype=numpy.float32)
         self.var3 = numpy.ones(1, dtype=numpy.float32)
@@ -134,17 +165,13 @@ class DymvaVarFiller(TreeCloner):
         self.var9 = numpy.ones(1, dtype=numpy.float32)
         self.var10 = numpy.ones(1, dtype=numpy.float32)
         self.var11 = numpy.ones(1, dtype=numpy.float32)
-        self.var12 = numpy.ones(1, dtype=numpy.float32)
-        self.var13 = numpy.ones(1, dtype=numpy.float32)
-        self.var14 = numpy.ones(1, dtype=numpy.float32)
-        self.var15 = numpy.ones(1, dtype=numpy.float32)
-        self.var16 = numpy.ones(1, dtype=numpy.float32)
-        self.var17 = numpy.ones(1, dtype=numpy.float32)
-        self.var18 = numpy.ones(1, dtype=numpy.float32)
-        self.var19 = numpy.ones(1, dtype=numpy.float32)
-        self.var20 = numpy.ones(1, dtype=numpy.float32)
-        self.var21 = numpy.ones(1, dtype=numpy.float32)
-        self.var22 = numpy.ones(1, dtype=numpy.float32)
+
+    def process(self,**kwargs):
+
+        # the readers are bound to the var buffers: both are created once
+        if not self.getDYMVAV0j0:
+            self.createBuffers()
+            self.createDYMVA()
 
         tree  = kwargs['tree']
         input = kwargs['input']
@@ -168,9 +195,6 @@ class DymvaVarFiller(TreeCloner):
         self.otree.Branch('dphimetjet1',  dphimetjet1, 'dphimetjet1/F')
         self.otree.Branch('recoil',       recoil,      'recoil/F')
 
-
-        self.createDYMVA()
-
         nentries = self.itree.GetEntries()
         print 'Total number of entries: ',nentries 
 
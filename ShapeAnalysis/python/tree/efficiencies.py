@@ -3,6 +3,34 @@ import numpy
 from tree.gardening import TreeCloner
 from HWWAnalysis.ShapeAnalysis.triggerEffCombiner import TriggerEff
 
+class H2Lookup:
+    '''Vectorized version of EffLepFiller._getWeight: same clamping, bin lookup on arrays'''
+    def __init__(self,bounds):
+        self._bounds = bounds
+        eta_lo, eta_hi, pt_lo, pt_hi, hW = bounds
+
+        nx = hW.GetNbinsX()
+        ny = hW.GetNbinsY()
+        self._xedges = numpy.array([ hW.GetXaxis().GetBinLowEdge(i) for i in xrange(1,nx+2) ])
+        self._yedges = numpy.array([ hW.GetYaxis().GetBinLowEdge(j) for j in xrange(1,ny+2) ])
+        # including under and overflows, as FindBin
+        self._values = numpy.array([ [ hW.GetBinContent(i,j) for j in xrange(ny+2) ] for i in xrange(nx+2) ])
+        self._errors = numpy.array([ [ hW.GetBinError(i,j)   for j in xrange(ny+2) ] for i in xrange(nx+2) ])
+
+    def __call__(self,eta,pt):
+        eta_lo, eta_hi, pt_lo, pt_hi, hW = self._bounds
+
+        eta = numpy.abs(numpy.asarray(eta,dtype=numpy.float64))
+        pt  = numpy.asarray(pt,dtype=numpy.float64)
+
+        eta = numpy.where(eta < eta_hi, eta, eta_hi-0.01)
+        pt  = numpy.where(pt  < pt_hi,  pt,  pt_hi-0.01)
+        pt  = numpy.where(pt  > pt_lo,  pt,  pt_lo+0.01)
+
+        ix = numpy.searchsorted(self._xedges, eta, side='right')
+        iy = numpy.searchsorted(self._yedges, pt,  side='right')
+        return self._values[ix,iy],self._errors[ix,iy]
+
 #    ____________            _____ ____       
 #   / __/ _/ _/ /  ___ ___  / __(_) / /__ ____
 #  / _// _/ _/ /__/ -_) _ \/ _// / / / -_) __/
@@ -74,6 +102,43 @@ class EffLepFiller(TreeCloner):
         self.elBounds = self._getBoundaries(elhist)
         self.muBounds = self._getBoundaries(muhist)
 
+    def inputs(self):
+        return ['channel','eta1','pt1','eta2','pt2']
+
+    def outputs(self):
+        br = self.branch
+        return [ (br,'F'), (br+'Up','F'), (br+'Down','F') ]
+
+    def compute(self,columns):
+        if not hasattr(self,'_lookups'):
+            self._lookups = (H2Lookup(self.elBounds),H2Lookup(self.muBounds))
+        elLookup,muLookup = self._lookups
+
+        channel = columns['channel']
+        unknown = ~numpy.in1d(channel,[0,1,2,3])
+        if unknown.any():
+            raise ValueError('channel=={0} What is that?!?!'.format(channel[unknown][0]))
+
+        # mm: 0, ee: 1, em: 2, me: 3
+        mu1 = (channel == 0) | (channel == 3)
+        mu2 = (channel == 0) | (channel == 2)
+
+        w1,e1 = [ numpy.where(mu1,m,e) for m,e in zip(muLookup(columns['eta1'],columns['pt1']),elLookup(columns['eta1'],columns['pt1'])) ]
+        w2,e2 = [ numpy.where(mu2,m,e) for m,e in zip(muLookup(columns['eta2'],columns['pt2']),elLookup(columns['eta2'],columns['pt2'])) ]
+
+        w1 = numpy.where(w1 >= 0.5, w1, 1.)
+        w2 = numpy.where(w2 >= 0.5, w2, 1.)
+
+        e1 = numpy.clip(e1, 0.01, 0.05)
+        e2 = numpy.clip(e2, 0.01, 0.05)
+
+        br = self.branch
+        return {
+            br        : w1*w2,
+            br+'Up'   : (w1+e1)*(w2+e2),
+            br+'Down' : (w1-e1)*(w2-e2),
+        }
+
     def process(self,**kwargs):
         tree  = kwargs['tree']
         input = kwargs['input']
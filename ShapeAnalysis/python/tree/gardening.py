@@ -7,12 +7,15 @@ import numpy
 import re
 import warnings
 import os.path
+import time
 import traceback
 
 import HWWAnalysis.Misc.odict as odict
 
 # for trigger efficiency fits
-from HWWAnalysis.ShapeAnalysis.hwwtools import confirm
+from HWWAnalysis.ShapeAnalysis.hwwtools import confirm, loadAndCompile
+from HWWAnalysis.ShapeAnalysis.hwwjobs import JobPool
+import HWWAnalysis.ShapeAnalysis.friendtrees as friendtrees
 
 #   _______                 
 #  / ___/ /__  ___  ___ ____
@@ -21,12 +24,40 @@ from HWWAnalysis.ShapeAnalysis.hwwtools import confirm
 #                           
 
 class TreeCloner(object):
+    # columnar mode: modules declaring their input branches (inputs), the
+    # branches they add (outputs) and implementing compute() on numpy arrays
+    # can be run on blocks of entries instead of looping on the events
+    columnar  = False
+    chunksize = 100000
+    # friend mode: only the new branches are written, to a tree aligned with
+    # the input one (see friendtrees)
+    friend    = False
+
     def __init__(self):
         self.ifile = None
         self.itree = None
         self.ofile = None
         self.otree = None
         self.label = None
+
+    def inputs(self):
+        '''branches (or expressions) needed by compute'''
+        return []
+
+    def outputs(self):
+        '''branches added by compute, as a list of (name, type) with type in F,D,I'''
+        return []
+
+    def compute(self, columns):
+        '''
+        columns: dict of numpy arrays (one per input) for a block of entries
+        returns: dict of numpy arrays, one per output
+        '''
+        raise NotImplementedError('Columnar mode not supported by '+self.__class__.__name__)
+
+    @classmethod
+    def hascolumns(cls):
+        return cls.compute.im_func is not TreeCloner.compute.im_func
     
     def _openRootFile(self,path, option=''):
         f =  ROOT.TFile.Open(path,option)
@@ -44,21 +75,37 @@ class TreeCloner(object):
         self.ifile = self._openRootFile(input)
         self.itree = self._getRootObj(self.ifile,tree)
 
-    def clone(self,output,branches=[]):
+    def friendname(self):
+        return self.itree.GetName()+'_'+self.label
+
+    def clone(self,output,branches=[],fast=False):
 
         self.ofile = self._openRootFile(output, 'recreate')
 
+        if self.friend:
+            # an empty tree, to which the module adds its branches
+            existing = [ b for b in branches if self.itree.GetBranch(b) ]
+            if existing:
+                print 'Warning: the input tree already has',', '.join(existing)+', which will hide the friend\'s'
+            self.otree = ROOT.TTree(self.friendname(), self.itree.GetTitle())
+            return
+
         for b in self.itree.GetListOfBranches():
             if b.GetName() not in branches: continue
             b.SetStatus(0)
 
-        self.otree = self.itree.CloneTree(0)
+        # fast: copy all the entries of the active branches at once (baskets are not unzipped)
+        self.otree = self.itree.CloneTree(0) if not fast else self.itree.CloneTree(-1,'fast')
 
         ## BUT keep all branches "active" in the old tree
         self.itree.SetBranchStatus('*'  ,1)
 
 
     def disconnect(self):
+        if self.friend:
+            if self.otree.GetEntries() != self.itree.GetEntries():
+                raise RuntimeError('Friend tree %s not aligned: %d entries instead of %d' % (self.otree.GetName(),self.otree.GetEntries(),self.itree.GetEntries()))
+            friendtrees.record(self.ifile.GetName(), self.ofile.GetName(), self.otree.GetName(), self.otree.GetEntries(), self.label)
         self.otree.Write()
         self.ofile.Close()
         self.ifile.Close()
@@ -68,6 +115,104 @@ class TreeCloner(object):
         self.ofile = None
         self.otree = None
 
+    def processColumns(self, **kwargs):
+        '''Columnar version of process: compute is called on blocks of chunksize entries'''
+        tree  = kwargs['tree']
+        input = kwargs['input']
+        output = kwargs['output']
+
+        self.connect(tree,input)
+
+        outputs = self.outputs()
+        self.clone(output,[ name for name,type in outputs ],fast=True)
+        writer = ColumnWriter(self.otree, outputs)
+
+        nentries = self.itree.GetEntries()
+        print 'Total number of entries: ',nentries
+        print 'Inputs: ',', '.join(self.inputs())
+        print 'Outputs:',', '.join([ name+'/'+type for name,type in outputs ])
+
+        print '- Starting columnar loop'
+        for first in xrange(0,nentries,self.chunksize):
+            n = min(self.chunksize,nentries-first)
+            columns = readColumns(self.itree, self.inputs(), first, n)
+            writer.fill( self.compute(columns), n )
+            print first+n,'events processed.'
+
+        # the branches were filled one by one
+        if self.friend: self.otree.SetEntries(-1)
+
+        self.disconnect()
+        print '- Columnar loop completed'
+
+#   _____     __                    
+#  / ___/__  / /_ ____ _  ___  ___
+# / /__/ _ \/ / // /  ' \/ _ \(_-<
+# \___/\___/_/\_,_/_/_/_/_//_/___/
+#
+
+try:
+    from root_numpy import tree2array
+except ImportError:
+    tree2array = None
+
+_numtypes = { 'F':numpy.float32, 'D':numpy.float64, 'I':numpy.int32 }
+
+def readColumns(tree, names, first, n):
+    '''Read n entries of the branches (or expressions) names as numpy arrays'''
+    names = list(names)
+    if tree2array and not [ x for x in names if not tree.GetBranch(x) ]:
+        array = tree2array(tree, branches=names, start=first, stop=first+n)
+        return dict([ (x,array[x]) for x in names ])
+
+    # fallback on TTree::Draw, 4 expressions at the time
+    columns = {}
+    if tree.GetEstimate() < n: tree.SetEstimate(n)
+    for i in xrange(0,len(names),4):
+        group = names[i:i+4]
+        m = tree.Draw(':'.join(group), '', 'goff', n, first)
+        if m != n:
+            raise RuntimeError('Read %d entries instead of %d for %s' % (m,n,', '.join(group)))
+        for j,x in enumerate(group):
+            buf = getattr(tree,'GetV%d' % (j+1))()
+            buf.SetSize(n)
+            columns[x] = numpy.frombuffer(buf, dtype=numpy.float64, count=n).copy()
+    return columns
+
+class ColumnWriter:
+    '''
+    Fills new branches of a tree from numpy arrays, leaving the other branches
+    untouched. Each column is written in a single call to the compiled filler
+    (macros/FillColumns.C), which takes the array buffer as it is.
+    '''
+    _macro = 'HWWAnalysis/ShapeAnalysis/macros/FillColumns.C'
+
+    def __init__(self, tree, outputs):
+        self._load()
+        self._buffers = []
+        for name,type in outputs:
+            value = numpy.zeros(1, dtype=_numtypes[type])
+            branch = tree.Branch(name, value, name+'/'+type)
+            self._buffers.append( (name,value,branch,getattr(ROOT,'fillColumn'+type)) )
+
+    @classmethod
+    def _load(cls):
+        if hasattr(ROOT,'fillColumnF'): return
+        loadAndCompile(os.path.join(os.environ['CMSSW_BASE'],'src',cls._macro))
+
+    def fill(self, columns, n):
+        arrays = []
+        for name,value,branch,filler in self._buffers:
+            if name not in columns:
+                raise KeyError('Column '+name+' not computed')
+            if len(columns[name]) != n:
+                raise ValueError('Column %s has %d entries instead of %d' % (name,len(columns[name]),n))
+            arrays.append( (name,numpy.ascontiguousarray(columns[name],dtype=value.dtype),value,branch,filler) )
+
+        for name,array,value,branch,filler in arrays:
+            if filler(branch,value,array,n) < 0:
+                raise IOError('Failed to fill the branch '+name)
+
 #    ___                       
 #   / _ \______ _____  ___ ____
 #  / ___/ __/ // / _ \/ -_) __/
@@ -435,6 +580,87 @@ class RootWeighter(TreeCloner):
 
 
 
+#    ___  _          ___          
+#   / _ \(_)__  ___ / (_)__  ___ 
+#  / ___/ / _ \/ -_) / / _ \/ -_)
+# /_/  /_/ .__/\__/_/_/_//_/\__/ 
+#       /_/                      
+
+class Pipeline(TreeCloner):
+    '''
+    Chains several columnar modules in a single pass: the input tree is read
+    once and one output tree is written with the branches of all the modules.
+    The options of each module are namespaced as --<module>.<option>
+    '''
+    columnar = True
+
+    def __init__(self, modules):
+        TreeCloner.__init__(self)
+        self.modules = modules
+        self._dests  = {}
+
+        unsupported = [ m.label for m in modules if not m.hascolumns() ]
+        if unsupported:
+            raise ValueError('Modules not supporting the columnar mode can\'t be chained: '+', '.join(unsupported))
+
+    def help(self):
+        return '''Run '''+', '.join([ m.label for m in self.modules ])+''' in a single pass'''
+
+    def addOptions(self,parser):
+        for m in self.modules:
+            # let the module define its options on a scratch parser and copy them
+            scratch = optparse.OptionParser(add_help_option=False)
+            mgroup  = m.addOptions(scratch)
+            options = mgroup.option_list if mgroup else scratch.option_list
+            group   = optparse.OptionGroup(parser, m.label, m.help())
+
+            self._dests[m.label] = []
+            for o in options:
+                names = [ '--'+m.label+'.'+l[2:] for l in o._long_opts ] or [ '--'+m.label+'.'+o.dest ]
+                dest  = m.label+'_'+o.dest
+                attrs = dict([ (a,getattr(o,a)) for a in ['action','type','nargs','const','choices','callback','callback_args','callback_kwargs','help','metavar'] if getattr(o,a) is not None ])
+                group.add_option(*names, dest=dest, **attrs)
+                parser.defaults[dest] = scratch.defaults.get(o.dest)
+                self._dests[m.label].append( (o.dest,dest) )
+            parser.add_option_group(group)
+
+    def checkOptions(self,opts):
+        for m in self.modules:
+            mopts = optparse.Values(dict([ (dest,getattr(opts,nsdest)) for dest,nsdest in self._dests[m.label] ]))
+            m.checkOptions(mopts)
+
+        outputs = [ name for name,type in self.outputs() ]
+        duplicates = set([ name for name in outputs if outputs.count(name) > 1 ])
+        if duplicates:
+            raise ValueError('Branches filled by more than one module: '+', '.join(duplicates))
+
+    def inputs(self):
+        inputs = []
+        produced = set()
+        for m in self.modules:
+            inputs += [ x for x in m.inputs() if x not in produced and x not in inputs ]
+            produced |= set([ name for name,type in m.outputs() ])
+        return inputs
+
+    def outputs(self):
+        return sum([ m.outputs() for m in self.modules ],[])
+
+    def compute(self,columns):
+        # the columns computed by a module are available to the following ones
+        columns = dict(columns)
+        results = {}
+        for m in self.modules:
+            new = m.compute(columns)
+            columns.update(new)
+            results.update(new)
+        return results
+
+    def friendname(self):
+        return self.itree.GetName()+'_'+'_'.join([ m.label for m in self.modules ])
+
+    def process(self,**kwargs):
+        return self.processColumns(**kwargs)
+
 #    _____                              __  ___         
 #   / ___/__  __ _  __ _  ___ ____  ___/ / / (_)__  ___ 
 #  / /__/ _ \/  ' \/  ' \/ _ `/ _ \/ _  / / / / _ \/ -_)
@@ -447,7 +673,69 @@ class ModuleManager(odict.OrderedDict):
         super(ModuleManager, self).__setitem__(key, value)
         value.label = key
 
-def execute(module,tree,iofiles):
+def _journaled(journal):
+    '''the (input,output) pairs recorded as completed in the journal'''
+    done = set()
+    if not journal or not os.path.exists(journal): return done
+    for line in open(journal):
+        tokens = line.rstrip('\n').split('\t')
+        if len(tokens) < 2: continue
+        done.add( (tokens[0],tokens[1]) )
+    return done
+
+def _record(journal,ifile,ofile,elapsed):
+    if not journal: return
+    with open(journal,'a') as j:
+        j.write('{0}\t{1}\t{2:.1f}\n'.format(ifile,ofile,elapsed))
+
+def executeParallel(module,tree,iofiles,jobs,retries=0,journal=None,logdir=None):
+    '''
+    Process the files on jobs worker processes, each forked with its own copy
+    of the configured module. The failed files are resubmitted up to retries
+    times. Returns the list of files still failing.
+    '''
+    process = module.processColumns if module.columnar else module.process
+
+    # create the output directories upfront, the workers would race
+    for odir in set([ os.path.dirname(ofile) for ifile,ofile in iofiles ]):
+        if odir and not os.path.exists(odir):
+            os.makedirs(odir)
+
+    pending = list(iofiles)
+    for attempt in xrange(retries+1):
+        pool = JobPool(jobs,logdir)
+        files = {}
+        for i,(ifile,ofile) in enumerate(pending):
+            label = '{0:04d}_{1}'.format(i,os.path.splitext(os.path.basename(ofile))[0])
+            files[label] = (ifile,ofile)
+            pool.add(label, process, input=ifile, output=ofile, tree=tree)
+
+        def done(r):
+            if r.ok: _record(journal, files[r.label][0], files[r.label][1], r.elapsed)
+
+        results = pool.run(done)
+        pending = [ files[r.label] for r in results if not r.ok ]
+        if not pending: break
+
+        if attempt < retries:
+            print 'Retrying',len(pending),'failed files (attempt {0}/{1})'.format(attempt+1,retries)
+
+    return pending
+
+def execute(module,tree,iofiles,jobs=1,retries=0,journal=None,logdir=None):
+    if journal:
+        done = _journaled(journal)
+        # files listed in the journal are only skipped if the output is still there
+        skipped = [ (ifile,ofile) for ifile,ofile in iofiles if (ifile,ofile) in done and os.path.exists(ofile) ]
+        if skipped:
+            print len(skipped),'of',len(iofiles),'files already processed according to',journal
+        iofiles = [ io for io in iofiles if io not in skipped ]
+        if not iofiles: return []
+
+    if jobs > 1:
+        return executeParallel(module,tree,iofiles,jobs,retries,journal,logdir)
+
+    process = module.processColumns if module.columnar else module.process
     nfiles=len(iofiles)
     for i,(ifile,ofile) in enumerate(iofiles):
         print '-'*80
@@ -462,8 +750,13 @@ def execute(module,tree,iofiles):
         print 'Output:',ofile
         print '-'*80
     
-        module.process( input=ifile, output=ofile, tree=tree )
+        start = time.time()
+        process( input=ifile, output=ofile, tree=tree )
+        elapsed = time.time()-start
+        print 'Processed in {0:.1f}s'.format(elapsed)
+        _record(journal,ifile,ofile,elapsed)
 
+    return []
 
 def gardener_cli( modules ):
     usage = '''
@@ -475,7 +768,11 @@ def gardener_cli( modules ):
     In the latter case the directory tree in dirin is rebuilt in dirout
 
     Valid commands:
-        '''+', '.join(modules.keys()+['help'])+'''
+        '''+', '.join(modules.keys()+['help','chain'])+'''
+
+    Several columnar modules can be run in a single pass with
+        %prog chain <command1> <command2> ... <options> filein.root fileout.root
+    where the options of each command are prefixed by its name (--<command>.<option>)
 
     Type %prog <command> -h for the command specific help
     '''
@@ -484,6 +781,12 @@ def gardener_cli( modules ):
     parser.add_option('-t','--tree',        dest='tree',                                default='latino',   help='Name of the tree to operate on (default = %default)')
     parser.add_option('-r','--recursive',   dest='recursive',   action='store_true',    default=False,      help='Recurse subdirectories (default = %default)')
     parser.add_option('-F','--force',       dest='force',       action='store_true',    default=False,      help='Don\'t ask for confirmation when recursing (default = %default)')
+    parser.add_option('-j','--jobs',        dest='jobs',        type='int',             default=1,          help='Number of files processed in parallel (default = %default)')
+    parser.add_option('--retries',          dest='retries',     type='int',             default=0,          help='Number of times failed files are resubmitted, with -j (default = %default)')
+    parser.add_option('--journal',          dest='journal',                             default=None,       help='Record the completed files in this file and skip them when rerunning (default = %default)')
+    parser.add_option('--logdir',           dest='logdir',                              default=None,       help='Directory for the output of each file, with -j (default = %default)')
+    parser.add_option('--friend',           dest='friend',      action='store_true',    default=False,      help='Write only the new branches, to a friend tree (default = %default)')
+    parser.add_option('-C','--columnar',    dest='columnar',    action='store_true',    default=False,      help='Compute the new branches on numpy blocks, if supported by the module (default = %default)')
 
     # some boring argument handling
     if len(sys.argv) == 1:
@@ -513,12 +816,32 @@ def gardener_cli( modules ):
         sys.exit(0)
 
 
-    if modname not in modules:
+    if modname == 'chain':
+        names = []
+        for a in sys.argv[2:]:
+            if a not in modules: break
+            names.append(a)
+
+        if not names:
+            print 'Chain: no command given'
+            print 'The available commands are',modules.keys()
+            sys.exit(0)
+
+        try:
+            module = Pipeline([ modules[n] for n in names ])
+        except ValueError as e:
+            print e
+            sys.exit(1)
+        module.label = modname
+        for n in names: sys.argv.remove(n)
+
+    elif modname not in modules:
         print 'Command',modname,'unknown'
         print 'The available commands are',modules.keys()
         sys.exit(0)
+    else:
+        module = modules[modname]
 
-    module = modules[modname]
     group = module.addOptions(parser)
 
     sys.argv.remove(modname)
@@ -542,6 +865,17 @@ def gardener_cli( modules ):
         print e
         sys.exit(1)
 
+    if opt.columnar:
+        if not module.hascolumns():
+            print 'Module',module.label,'does not support the columnar mode'
+            sys.exit(1)
+        module.columnar = True
+
+    if opt.friend and isinstance(module,(Pruner,AliasGrafter)):
+        print 'Module',module.label,'does not add branches, the friend mode is not supported'
+        sys.exit(1)
+    module.friend = opt.friend
+
     tree = opt.tree
 
     nargs = len(args)
@@ -560,7 +894,7 @@ def gardener_cli( modules ):
         output = output if output[-1]=='/' else output+'/'
         iofiles = [ (f,os.path.join(output,os.path.basename(f))) for f in inputs ]
 
-        execute( module, tree, iofiles )
+        failed = execute( module, tree, iofiles, opt.jobs, opt.retries, opt.journal, opt.logdir )
     
     elif nargs == 2:
         input  = args[0]
@@ -595,14 +929,19 @@ def gardener_cli( modules ):
 
             iofiles = [ (f,f.replace(input,output)) for f in fileList ]
 
-            execute( module, tree, iofiles )
+            failed = execute( module, tree, iofiles, opt.jobs, opt.retries, opt.journal, opt.logdir )
 
         else:
             if os.path.exists(output) and os.path.isdir(output):
                 # sanitise output
                 output = output if output[-1]=='/' else output+'/'
                 output = os.path.join( output , os.path.basename(input) )
-            execute(module,tree,[(input,output)])
+            failed = execute(module,tree,[(input,output)])
+
+    if failed:
+        print 'The following files failed:'
+        print '\n'.join([ ifile for ifile,ofile in failed ])
+        sys.exit(1)
 
 
 if __name__ == '__main__':
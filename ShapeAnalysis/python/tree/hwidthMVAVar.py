@@ -1,4 +1,5 @@
 from tree.gardening import TreeCloner
+from HWWAnalysis.ShapeAnalysis.tmvabdt import BDT
 
 
 import optparse
@@ -25,7 +26,20 @@ import math
 class HwidthMVAVarFiller(TreeCloner):
 
     def __init__(self):
-        pass
+        self.getHwidthMVA = None
+        self.bdt = None
+
+
+    def weightsFile(self):
+        baseCMSSW = os.getenv('CMSSW_BASE')
+        if self.kindOfMVA == 0 :
+          return baseCMSSW+"/src/HwidthMvaInCMSSW/GetHwidthMVA/data/TMVA_Hwidth_ggH_BDTG.weights.xml"
+        else :
+          return baseCMSSW+"/src/HwidthMvaInCMSSW/GetHwidthMVA/data/TMVA_Hwidth_bkg_BDTG.weights.xml"
+
+
+    def branchName(self):
+        return 'HwidthMVAggH' if self.kindOfMVA == 0 else 'HwidthMVAbkg'
 
 
     def createHwidthMVA(self):
@@ -40,12 +54,7 @@ class HwidthMVAVarFiller(TreeCloner):
         self.getHwidthMVA.AddVariable("dphill",      (self.var6))
         self.getHwidthMVA.AddVariable("pfmet",       (self.var7))
 
-        baseCMSSW = os.getenv('CMSSW_BASE')
-
-        if self.kindOfMVA == 0 :
-          self.getHwidthMVA.BookMVA("BDTG",baseCMSSW+"/src/HwidthMvaInCMSSW/GetHwidthMVA/data/TMVA_Hwidth_ggH_BDTG.weights.xml")
-        else :
-          self.getHwidthMVA.BookMVA("BDTG",baseCMSSW+"/src/HwidthMvaInCMSSW/GetHwidthMVA/data/TMVA_Hwidth_bkg_BDTG.weights.xml")
+        self.getHwidthMVA.BookMVA("BDTG",self.weightsFile())
 
 
     def help(self):
@@ -56,25 +65,47 @@ class HwidthMVAVarFiller(TreeCloner):
         description = self.help()
         group = optparse.OptionGroup(parser,self.label, description)
         group.add_option('-k', '--kindOfMVA',   dest='kindOfMVA', type='int', help='kind of sample: 0 = off-shell vs on-shell, 1 = off-shell vs background', default=0)
+        group.add_option('--crosscheck', dest='crosscheck', type='int', help='Columnar mode: compare the first N events of each block with EvaluateMVA', default=0)
         parser.add_option_group(group)
         return group
 
 
     def checkOptions(self,opts):
         self.kindOfMVA     = opts.kindOfMVA
+        self.crosscheck    = opts.crosscheck
         print "it's all ok ..."
 
 
+    def inputs(self):
+        return ['mll','mth','ptll','pt1','pt2','dphill','pfmet']
+
+
+    def outputs(self):
+        return [(self.branchName(),'F')]
+
+
+    def compute(self,columns):
+        # the forest is read once and evaluated on the whole block
+        if not self.bdt: self.bdt = BDT(self.weightsFile())
+
+        inputs = [ columns[b] for b in self.inputs() ]
+        if self.crosscheck:
+            self.bdt.crosscheck(inputs,self.crosscheck)
+        return { self.branchName() : self.bdt.evaluate(inputs) }
+
+
     def process(self,**kwargs):
 
-        self.getHwidthMVA = None
-        self.var1  = numpy.ones(1, dtype=numpy.float32)
-        self.var2  = numpy.ones(1, dtype=numpy.float32)
-        self.var3  = numpy.ones(1, dtype=numpy.float32)
-        self.var4  = numpy.ones(1, dtype=numpy.float32)
-        self.var5  = numpy.ones(1, dtype=numpy.float32)
-        self.var6  = numpy.ones(1, dtype=numpy.float32)
-        self.var7  = numpy.ones(1, dtype=numpy.float32)
+        # the reader is bound to the var buffers: both are created once
+        if not self.getHwidthMVA:
+            self.var1  = numpy.ones(1, dtype=numpy.float32)
+            self.var2  = numpy.ones(1, dtype=numpy.float32)
+            self.var3  = numpy.ones(1, dtype=numpy.float32)
+            self.var4  = numpy.ones(1, dtype=numpy.float32)
+            self.var5  = numpy.ones(1, dtype=numpy.float32)
+            self.var6  = numpy.ones(1, dtype=numpy.float32)
+            self.var7  = numpy.ones(1, dtype=numpy.float32)
+            self.createHwidthMVA()
 
         tree  = kwargs['tree']
         input = kwargs['input']
@@ -98,8 +129,6 @@ class HwidthMVAVarFiller(TreeCloner):
         else :
           self.otree.Branch('HwidthMVAbkg',  HwidthMVA,  'HwidthMVAbkg/F')
 
-        self.createHwidthMVA()
-
         nentries = self.itree.GetEntries()
         print 'Total number of entries: ',nentries 
 
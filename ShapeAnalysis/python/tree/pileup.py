@@ -54,18 +54,7 @@ class PUpper(TreeCloner):
         self.mcdist     = self._getRootObj(self.mcfile, opts.histname)
 
     # ----
-    def process(self,**kwargs):
-        tree  = kwargs['tree']
-        input = kwargs['input']
-        output = kwargs['output']
-
-        self.connect(tree,input)
-        self.clone(output,[self.branch])
-
-        weight = numpy.ones(1, dtype=numpy.float32)
-        self.otree.Branch(self.branch,weight,self.branch+'/F')
-
-
+    def _makeScales(self):
         data_nBin     = self.datadist.GetNbinsX()
         data_minValue = self.datadist.GetXaxis().GetXmin()
         data_maxValue = self.datadist.GetXaxis().GetXmax()
@@ -108,7 +97,49 @@ class PUpper(TreeCloner):
  
         for iBin in xrange(nBin):
             puScaleMC[iBin] =  puScaleMCtemp[iBin] * integralDATA / integralMC
- 
+
+        return puScaleDATA,puScaleMC,dValue
+
+    # ----
+    def inputs(self):
+        return [self.kind]
+
+    # ----
+    def outputs(self):
+        return [(self.branch,'F')]
+
+    # ----
+    def compute(self,columns):
+        if not hasattr(self,'_scales'):
+            self._scales = self._makeScales()
+        puScaleDATA,puScaleMC,dValue = self._scales
+
+        # same arithmetics as the event loop (double precision, truncation)
+        ibin = (columns[self.kind].astype(numpy.float64) / dValue).astype(numpy.int64)
+        ibin[ibin >= len(puScaleDATA)] = len(puScaleDATA)-1
+
+        data = puScaleDATA[ibin].astype(numpy.float64)
+        mc   = puScaleMC[ibin].astype(numpy.float64)
+        weight = numpy.ones(len(ibin), dtype=numpy.float32)
+        nonzero = mc != 0
+        weight[nonzero] = data[nonzero] / mc[nonzero]
+
+        return { self.branch:weight }
+
+    # ----
+    def process(self,**kwargs):
+        tree  = kwargs['tree']
+        input = kwargs['input']
+        output = kwargs['output']
+
+        self.connect(tree,input)
+        self.clone(output,[self.branch])
+
+        weight = numpy.ones(1, dtype=numpy.float32)
+        self.otree.Branch(self.branch,weight,self.branch+'/F')
+
+        puScaleDATA,puScaleMC,dValue = self._makeScales()
+
         nentries = self.itree.GetEntries()
         print 'Total number of entries: ',nentries
         
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os
+import numpy
+from array import array
+
+#  __   _____   _____     _    _
+#  \ \ / / _ \ |_   _|_ _| |__| |___ ___
+#   \ V /|   /   | |/ _` | '_ \ / -_|_-<
+#    |_| |_|_\   |_|\__,_|_.__/_\___/__/
+#
+# The Yellow Report tables (cross sections, branching ratios and their
+# uncertainties versus mH), parsed once per process, and the splines used to
+# interpolate them off the mass grid, built once per table and column.
+
+_tables   = {}
+_records  = {}
+_splines  = {}
+
+# _____________________________________________________________________________
+def datapath(*parts):
+    '''Path of a file in the ShapeAnalysis data directory'''
+    return os.path.join(os.getenv('CMSSW_BASE'),'src/HWWAnalysis/ShapeAnalysis/data',*parts)
+
+# _____________________________________________________________________________
+def xspath(version, energy, process):
+    '''Path of the cross section table of a production process (ggH, vbfH, WH, ...)'''
+    return datapath('lhc-hxswg-YR'+str(version),'sm/xs',energy,energy+'-'+process+'.txt')
+
+# _____________________________________________________________________________
+def brpath(version, table):
+    '''Path of a branching ratio table (BR, BR1, BR2bosons, ...)'''
+    return datapath('lhc-hxswg-YR'+str(version),'sm/br',table+'.txt')
+
+# _____________________________________________________________________________
+def _parse(path):
+    headers = []
+    rows = {}
+    for line in open(path,'r'):
+        cols = line.split()
+        if len(cols) < 2: continue
+        if 'mH' in line:
+            headers = [ c.strip() for c in cols[1:] ]
+        else:
+            fields = [ float(c) for c in cols ]
+            rows[fields[0]] = fields[1:]
+    return headers,rows
+
+# _____________________________________________________________________________
+def table(path):
+    '''(column names, {mass: [values]}) of a table, read only the first time'''
+    path = os.path.abspath(path)
+    if path not in _tables:
+        _tables[path] = _parse(path)
+    return _tables[path]
+
+# _____________________________________________________________________________
+def rows(path):
+    '''The values of the table by mass, as lists in the columns order (shared, not to be modified)'''
+    return table(path)[1]
+
+# _____________________________________________________________________________
+def records(path):
+    '''The values of the table by mass, as dicts by column name (shared, not to be modified)'''
+    path = os.path.abspath(path)
+    if path not in _records:
+        headers,values = table(path)
+        _records[path] = dict([ (m,dict(zip(headers,v))) for m,v in values.iteritems() ])
+    return _records[path]
+
+# _____________________________________________________________________________
+class Interpolator:
+    '''
+    The values of a table column versus mass: the tabulated value on the grid,
+    a TSpline3 through the (single precision) points off the grid.
+    '''
+    def __init__(self, points):
+        import ROOT
+        self._points = dict(points)
+        masses = sorted(self._points)
+        self._graph  = ROOT.TGraph(len(masses),array('f',masses),array('f',[ self._points[m] for m in masses ]))
+        self._spline = ROOT.TSpline3('YR',self._graph)
+
+    def __call__(self, mass):
+        '''The value at mass, a number or an array of masses'''
+        if numpy.isscalar(mass):
+            return self._eval(mass)
+        masses,inverse = numpy.unique(numpy.asarray(mass,dtype=numpy.float64),return_inverse=True)
+        values = numpy.array([ self._eval(m) for m in masses ])
+        return values[inverse].reshape(numpy.shape(mass))
+
+    def _eval(self, mass):
+        if mass in self._points:
+            return self._points[mass]
+        return self._spline.Eval(mass)
+
+# _____________________________________________________________________________
+def interpolator(values, column=None):
+    '''
+    The interpolator of values ({mass: value}, or {mass: record} with column
+    the key in the records), built the first time it is asked for
+    '''
+    key = (id(values),column)
+    cached = _splines.get(key)
+    if cached is None or cached[0] is not values:
+        points = values if column is None else dict([ (m,v[column]) for m,v in values.iteritems() ])
+        cached = _splines[key] = (values,Interpolator(points))
+    return cached[1]
+
+# _____________________________________________________________________________
+def value(values, mass, column=None):
+    '''The (interpolated) value at mass'''
+    if numpy.isscalar(mass) and mass in values:
+        return values[mass] if column is None else values[mass][column]
+    return interpolator(values,column)(mass)
@@ -20,6 +20,7 @@ import ROOT
 
 from subprocess import Popen, PIPE, STDOUT
 import HWWAnalysis.Misc.odict as odict
+import datacard
 
 
 
@@ -485,42 +486,12 @@ def mlfitnormstotext(file,out,tag):
 
 
 def readdatacard(file):
-##    a_values = odict.OrderedDict()
-    dict_values = {}
-
-    f = open(file)
-            
-    process = []
-    rate = []
-    bin = []
-    for line in f:
-        if not line.startswith('process') and not line.startswith('rate') and not line.startswith('bin'):
-            continue
-        elif line.startswith('process') and line.split()[1]=='0'  or line.split()[1].startswith('-'):
-            continue
-        elif line.startswith('process'):
-            process = line.split()
-        elif line.startswith('rate'):
-            rate = line.split()
-        elif line.startswith('bin'):
-            bin = line.split()
-                    
-    process.remove('process')
-    rate.remove('rate')
-    bin.remove('bin')
-    
-##             print process
-##             print rate
-                    
-    if len(process) != len(rate):
-        sys.exit('Something is wrong reading the lines... exiting!')
+    card = datacard.Datacard.parse(file)
 
     values = {}
-    for p in range(len(process)):
-        values[bin[p]+'_'+process[p]] = rate[p]
+    for (bin,process,index),rate in zip(card.columns,card.rates):
+        values[bin+'_'+process] = rate
 
-##     mass = file.split('.')[-3].replace('mH','')
-##     dict_values[mass] = values
     print 'datacard', values
     return values
 
@@ -673,7 +644,7 @@ def main():
          
             
             #            print >> text, proc.ljust(15)+norms[mass][proc].ljust(15)+(fits[mass][proc][0]+' '+str(float(fits[mass][proc][0])/float(norms[mass][proc])).ljust(15)+fits[mass][proc][1].ljust(15)
-            print >> text, proc.ljust(15)+n.ljust(15)+(sb+' ('+str('%.2f' % r_sb)+')').ljust(20)+(b+' ('+str('%.2f' % r_b)+')').ljust(20)
+            print >> text, proc.ljust(15)+('%g' % n).ljust(15)+(sb+' ('+str('%.2f' % r_sb)+')').ljust(20)+(b+' ('+str('%.2f' % r_b)+')').ljust(20)
 
 
     for ptag in plottag:
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import os
 import optparse
-import HiggsAnalysis.CombinedLimit.DatacardParser as cardparser
+import datacard
 from math import sqrt,fabs
 import glob
 
@@ -41,12 +41,8 @@ labels = dict(zip(order,labelsTemp))
 
 def getSummary( filename, mass, blind ):
 
-    # get the defaults from 
-    dummyp = optparse.OptionParser('dummy')
-    cardparser.addDatacardParserOptions(dummyp)
-    (options, dumbargs) = dummyp.parse_args([])
-
-    DC = cardparser.parseCard(file(filename), options)
+    # same exp, obs and systs views as the combine DatacardParser
+    DC = datacard.Datacard.parse(filename)
     nuisToConsider = [ y for y in DC.systs if 'CMS' in y[0] or y[0] == 'FakeRate']
 
     errors = {}
@@ -7,13 +7,17 @@ import re
 import os.path
 import logging
 import pdb
+import json
 import fnmatch
 
 import hwwinfo
 import hwwtools
 import hwwsamples
+import hwwjobs
+import systematicUncertainties
 
 import datadriven
+import datacard
 from HWWAnalysis.Misc.odict import OrderedDict
 from systematicUncertainties import getCommonSysts,addFakeBackgroundSysts,floatNorm
 
@@ -48,76 +52,16 @@ class ShapeDatacardWriter:
 
         cardPath = path.format(mass = self._mass, bin = self._bin)
         print 'Writing to '+cardPath 
-        card = open( cardPath ,"w")
-        card.write('## Shape input card for H->WW analysis\n')
-        
-        card.write('imax 1 number of channels\n')
-        card.write('jmax * number of background\n')
-        card.write('kmax * number of nuisance parameters\n') 
-
-        card.write('-'*100+'\n')
-        card.write('bin         %s' % self._bin+'\n')
         if 'Data' not in yields:
             self._log.warning( 'Yields: '+','.join(yields.keys()) )
             raise RuntimeError('No Data found!')
-        card.write('observation %.0f\n' % yields['Data']._N)
-        # replace the second * with the bin?
 
-        if self._shape:
-            card.write('shapes  *           * '+
-                       fileFmt.format(mass=self._mass, bin=self._bin)+
-                       '     histo_$PROCESS histo_$PROCESS_$SYSTEMATIC'+'\n')
-            card.write('shapes  data_obs    * '+
-                       fileFmt.format(mass=self._mass, bin=self._bin)+
-                       '     histo_Data'+'\n')
-
-        card.write('-'*100+'\n')
-        
-        bkgs = [ name for name in yields if name not in signals and name != 'Data']
-        sigs = [ name for name in yields if name in signals ]
-        keyline = []
-        keyline.extend([ (-i,s,yields[s]._N) for i,s in enumerate(sigs) ])
-        keyline.extend([ (i+1,b,yields[b]._N) for i,b in enumerate(bkgs) ])
-
-        coldef = 15
-
-        card.write('bin'.ljust(58)+''.join([self._bin.ljust(coldef)*len(keyline)])+'\n')
-        card.write('process'.ljust(58)+''.join([n.ljust(coldef) for (i,n,N) in keyline])+'\n' )
-        card.write('process'.ljust(58)+''.join([('%d' % i).ljust(coldef) for (i,n,N) in keyline])+'\n' )
-        card.write('rate'.ljust(58)+''.join([('%-.4f' % N).ljust(coldef) for (i,n,N) in keyline])+'\n' )
-        card.write('-'*100+'\n')
-
-#         nmax = max([len(n) for n in nuisances]
-
-        for name in nuisances:
-            (pdf,effect) = nuisances[name]
-            # if this nuisance has no effect on any sample, not even write it!  --> "isAgoodNuisance"
-            isAgoodNuisance = False
-            for i,p,y in keyline:
-                if p in effect:
-                  isAgoodNuisance = True
-
-            if 'WW' in signals and 'Gen_nlo_WW' in name:
-                isAgoodNuisance = False
-
-            # even if split in jet bins
-            if 'WW' in signals and 'Gen_nlo_' in name:
-                isAgoodNuisance = False
-
-            if (isAgoodNuisance) :
-               if len(pdf) == 1: card.write('{0:<41} {1:<7}         '.format(name,pdf[0]))
-               else:             card.write('{0:<41} {1:<7} {2:<6}  '.format(name,pdf[0],pdf[1]))
-               for i,p,y in keyline:
-                   if p in effect:
-                       #if 'FakeRate' in name:
-                       if   (pdf[0]=='gmN'):                        card.write('%-10.5f'      % effect[p])
-                       elif (pdf[0]=='shape' or pdf[0]=='shapeN2'): card.write('%-10d'        % effect[p])
-                       elif (isinstance(effect[p], tuple)):         card.write('%.2f/%-5.2f' % (effect[p][0],effect[p][1]))
-                       else:                                        card.write('%-10.3f'      % effect[p])
-                   else: card.write('-'.ljust(coldef))
-               card.write('\n')
-
-        card.close()
+        # the card is built in memory and written at once
+        shapes = fileFmt.format(mass=self._mass, bin=self._bin) if self._shape else None
+        rates  = OrderedDict([ (p,y._N) for p,y in yields.iteritems() ])
+        card = datacard.Datacard.build(self._bin, rates, nuisances, shapes, signals)
+        card.write(cardPath)
+        return card
 
 class Yield:
     def __init__(self,*args,**kwargs):
@@ -133,27 +77,92 @@ class Yield:
 class ShapeLoader:
     '''Load the histogram data from the shape file
     + Yields
-    + Nuisance shapes and parameters'''
+    + Nuisance shapes and parameters
+
+    The histogram names are indexed in a single pass over the keys, the yields
+    are read only when asked for. With summary, the yields, effects and the
+    index of the names are saved next to the shape file (<shape file>.summary.json)
+    and read from there as long as the shape file is unchanged, without
+    opening it.'''
     _log = logging.getLogger('ShapeLoader')
+    _suffix = '.summary.json'
 
-    def __init__(self, path):
-        self._src = ROOT.TFile.Open(path)
-        self._yields = OrderedDict()
+    def __init__(self, path, summary=False):
+        self._path    = path
+        self._summary = summary
+        self._src     = None
+        self._yields  = None
 
     def __del__(self):
-        del self._src
+        self._close()
+
+    def _open(self):
+        if not self._src:
+            self._src = ROOT.TFile.Open(self._path)
+            if not self._src or self._src.IsZombie():
+                raise IOError('Failed to open '+self._path)
+        return self._src
+
+    def _close(self):
+        if self._src:
+            self._src.Close()
+        self._src = None
 
     def yields(self):
+        if self._yields is None:
+            self._loadYields()
         return self._yields.copy()
 
     def effects(self):
         return self._effects.copy()
 
+    def index(self):
+        '''process -> (nominal name, {effect: {'Up': name, 'Down': name}})'''
+        return self._index
+
+    def _stamp(self):
+        # the shape file the summary refers to
+        st = os.stat(self._path)
+        return [os.path.basename(self._path), st.st_size, st.st_mtime]
+
+    def _readSummary(self):
+        try:
+            with open(self._path+self._suffix) as f:
+                summary = json.load(f)
+        except (IOError,ValueError):
+            return False
+        # the summaries written without the index are rebuilt
+        if summary.get('stamp') != self._stamp() or 'index' not in summary:
+            return False
+
+        self._yields = OrderedDict([ (str(p),Yield(N, name=str(p), entries=entries)) for p,N,entries in summary['yields'] ])
+        self._effects = dict([ (str(e),[ str(p) for p in ps ]) for e,ps in summary['effects'] ])
+        self._index = OrderedDict([ (str(p),(str(n),dict([ (str(e),dict([ (str(v),str(h)) for v,h in vs.iteritems() ])) for e,vs in effects.iteritems() ]))) for p,n,effects in summary['index'] ])
+        self._log.debug('Yields and effects of %s read from the summary', self._path)
+        return True
+
+    def _writeSummary(self):
+        summary = {
+            'stamp'   : self._stamp(),
+            'yields'  : [ (p,y._N,y._entries) for p,y in self._yields.iteritems() ],
+            'effects' : sorted(self._effects.iteritems()),
+            'index'   : [ (p,n,effects) for p,(n,effects) in self._index.iteritems() ],
+        }
+        try:
+            with open(self._path+self._suffix,'w') as f:
+                json.dump(summary,f,indent=1)
+        except IOError as e:
+            self._log.warning('Cannot write the summary of %s: %s', self._path, e)
+
     def load(self):
+        if self._summary and self._readSummary():
+            return
+
+        src = self._open()
         # load the list of processes
-        processes = sorted([ p.GetName() for p in self._src.Get('processes') ])
+        processes = sorted([ p.GetName() for p in src.Get('processes') ])
         # load the histograms and calculate the yields
-        names = sorted([ k.GetName() for k in self._src.GetListOfKeys() ])
+        names = sorted([ k.GetName() for k in src.GetListOfKeys() ])
         names.remove('processes')
 
 
@@ -164,38 +173,30 @@ class ShapeLoader:
         if len(self._nominals) != len(processes):
             raise RuntimeError('Not all process shapes have been found')
 
-        for p in processes:
-            systre = re.compile('^histo_%s_(.+)(Up|Down)$' % p)
-            systp = []
-            for name in names:
-                m = systre.match(name)
-                if not m: continue
-                systp.append( (name,p,m.group(1),m.group(2)) )
-#             systs = [ (name,p, for name in names if systre.match(name) ]
-#               print 'xxx',p,systp
-#                print 'xxx',p,m.group(1),m.group(2)
-            self._systematics += systp
+        # one pass on the names: histo_<process>_<effect>(Up|Down), every
+        # process prefix of the name being a match (as ggH and ggH_ALT)
+        known = set(processes)
+        for name in names:
+            if not name.startswith('histo_'): continue
+            var = 'Up' if name.endswith('Up') else 'Down' if name.endswith('Down') else None
+            if not var: continue
+            body = name[len('histo_'):-len(var)]
+            tokens = body.split('_')
+            for i in xrange(1,len(tokens)):
+                p = '_'.join(tokens[:i])
+                effect = body[len(p)+1:]
+                if p in known and effect:
+                    self._systematics.append( (name,p,effect,var) )
 
         self._systematics = sorted(self._systematics)
 
-        for name,process in self._nominals:
-#             process = self._nomRegex.match(name).group(1)
-            h = self._src.Get(name)
-            N =  h.Integral(0,h.GetNbinsX())
-            entries = h.GetEntries()
-
-            # TODO: DYTT cleanup
-#             if entries < 5: continue
-
-            self._yields[process] = Yield( N, name=process, entries=entries ) 
-#             self._yields[process] = Yield( N, name=process, entries=entries, shape=h ) 
-        
+        self._index = OrderedDict([ (p,(n,{})) for n,p in self._nominals ])
         ups = {}
         downs = {}
         for name,process,effect,var in self._systematics:
             # check for Up/Down
-#             (process,effect,var) = self._systRegex.match(name).group(1,2,3)
-            print "process,effect,var = ", process,effect,var
+            self._log.debug('process,effect,var = %s,%s,%s', process,effect,var)
+            self._index[process][1].setdefault(effect,{})[var] = name
             if var == 'Up': 
                 if effect not in ups: ups[effect]= []
                 ups[effect].append(process)
@@ -203,18 +204,37 @@ class ShapeLoader:
                 if effect not in downs: downs[effect]= []
                 downs[effect].append(process)
         # check 
-        print " ups = ", ups
-        print " downs = ", downs
+        self._log.debug('ups = %s', ups)
+        self._log.debug('downs = %s', downs)
 
         for effect in ups:
-            if set(ups[effect]) != set(downs[effect]):
+            if set(ups[effect]) != set(downs.get(effect,[])):
                 sUp = set(ups[effect])
-                sDown = set(downs[effect])
+                sDown = set(downs.get(effect,[]))
                 raise RuntimeError('Some systematics shapes for '+effect+' not found in up and down variation: \n '+', '.join( (sUp | sDown) - ( sUp & sDown ) ))
 
         # all checks out, save only one
         self._effects = ups
 
+        if self._summary:
+            self._loadYields()
+            self._writeSummary()
+
+    def _loadYields(self):
+        src = self._open()
+        self._yields = OrderedDict()
+        for name,process in self._nominals:
+            h = src.Get(name)
+            N =  h.Integral(0,h.GetNbinsX())
+            entries = h.GetEntries()
+
+            # TODO: DYTT cleanup
+#             if entries < 5: continue
+
+            self._yields[process] = Yield( N, name=process, entries=entries ) 
+#             self._yields[process] = Yield( N, name=process, entries=entries, shape=h ) 
+        self._close()
+
 class NuisanceMapBuilder:
     _log = logging.getLogger('NuisanceMapBuilder')
 
@@ -294,7 +314,6 @@ class NuisanceMapBuilder:
     def _addDataDrivenNuisances(self, nuisances, yields, mass, channel, jetcat, suffix, opts):
 
         if self._ddreader.iszombie: return
-        (estimates,dummy) = self._wwddfilter.get(mass, channel)
 
         pdf = 'lnN'
 
@@ -341,7 +360,9 @@ class NuisanceMapBuilder:
             eff_extr_corr   = 'CMS{0}_hww_{1}_{2}_extr_corr'.format(suffix,tag,context)
             eff_extr_uncorr = 'CMS{0}_hww_{1}_{2}_extr_uncorr'.format(suffix,tag,channel)
 
-            available = [ p for p in processes if p in estimates ]
+            # copies, the MC extrapolation below sets their alphaPrime
+            estimates = dict([ (p,self._wwddfilter.entry(mass, channel, p)) for p in processes ])
+            available = [ p for p in processes if estimates[p] is not None ]
             if not available: continue
 
             # check the dd to have the same events in the ctr region before associating them
@@ -650,6 +671,8 @@ if __name__ == '__main__':
     usage = 'usage: %prog [options]'
     parser = optparse.OptionParser(usage)
     parser.add_option('-p', '--prefix'  , dest='prefix'      , help='Datacard directory prefix'           , default=None)
+    parser.add_option('-j', '--jobs'    , dest='jobs'        , help='Number of parallel jobs (model, mass, channel units)', type='int', default=1)
+    parser.add_option('--max-memory'    , dest='maxMemory'   , help='Resident memory ceiling of each parallel job in MB, a job going beyond is killed (default = %default, no limit)', type='int', default=0)
     parser.add_option('--cutbased'      , dest='shape'       , help='Make cutbased datacards (no shapes)' , default=True , action='store_false' )
     parser.add_option('--no_wwdd_above' , dest='noWWddAbove' , help='No WW dd above this mass'            , default=None   , type='int'     )
     parser.add_option('--dataset'       , dest='dataset'     , help='Dataset to process'                  , default=None)
@@ -665,6 +688,7 @@ if __name__ == '__main__':
     parser.add_option('-S','--SpecialSettings', dest='SpecialSettings'   , help='Special settings',        default=''  ,            action='callback', type='string', callback=incexc)
     parser.add_option('--path_dd'           ,   dest='path_dd'           , help='Data driven path'                 , default=None)
     parser.add_option('--path_shape_merged' ,   dest='path_shape_merged' , help='Destination directory for merged' , default='merged')
+    parser.add_option('--summary'           ,   dest='summary'           , help='Use and write the yields summaries next to the shape files', default=False, action='store_true')
 #     parser.add_option('--floatN',               dest='floatN'            , help='float normalisation of particular processes, separate by space ', default=' ')
     parser.add_option('--isssactive',           dest='isssactive'        , help='Is samesign datacard available'                           , default=False)
     parser.add_option('--floatN',               dest='floatN'            , help='float normalisation of particular processes, separate by space',  default=[] , type='string' , action='callback' , callback=hwwtools.list_maker('floatN'))
@@ -737,78 +761,125 @@ if __name__ == '__main__':
     lumistr = '{0:.2f}'.format(opt.lumi)
 
 
+    #mask = ['Vg','DYLL','DYTT']
+    mask = ['DYLL']
+
+    maskVeto = {
+       'CMS_8TeV_p_scale_j':['DYTT'],
+       'CMS_8TeV_puModel'  :['DYTT'],
+       }
+
+    # the read-only inputs, data driven estimates and YR tables, are loaded
+    # once here: the parallel jobs inherit them
+    builder = NuisanceMapBuilder( opt.path_dd, opt.noWWddAbove, opt.shape, opt.isssactive, opt.statmode)
+    builder.statShapeVeto = mask
+    builder.expShapeVeto  = maskVeto
+    systematicUncertainties.loadYRSyst(opt.YRSysVer,opt.energy)
+
+    def modelTag(iCP2, iBRn):
+        return 'EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')
+
+    def unitLabel(iCP2, iBRn, mass, ch):
+        label = 'mH{0}_{1}'.format(mass,ch)
+        if opt.ewksinglet:
+            label += '_'+modelTag(iCP2,iBRn)
+        return label
+
+    def writeUnit(iCP2, iBRn, mass, ch, jcat, fl):
+        if opt.ewksinglet:
+          shapeTmpl = os.path.join(mergedPath,'hww-'+lumistr+'fb.mH{mass}.{channel}.'+modelTag(iCP2,iBRn)+'_shape.root')
+        else:
+          shapeTmpl = os.path.join(mergedPath,'hww-'+lumistr+'fb.mH{mass}.{channel}_shape.root')
+
+#         for jets in jetBins:
+#             for flavor in flavors:
+        print '- Processing',mass, ch
+        loader = ShapeLoader(shapeTmpl.format(mass = mass, channel=ch), opt.summary ) 
+        loader.load()
+
+        writer = ShapeDatacardWriter( mass, ch, opt.shape, opt.dataset )
+        print '   + loading yields'
+        yields = loader.yields()
+
+        # reshuffle the order
+        #order = [ 'vbfH', 'ggH', 'wzttH', 'ggWW', 'Vg', 'WJet', 'Top', 'WW', 'DYLL', 'VV', 'DYTT', 'Data']
+        order = [ 'ggH','ggH_ALT','qqH','qqH_ALT', 'wzttH','wzttH_ALT', 'WH', 'ZH', 'ttH', 'ggWW', 'VgS', 'Vg', 'WJet', 'Top', 'TopPt0', 'TopPt1', 'TopPt2', 'TopPt3', 'TopPt4', 'TopPt5', 'TopPt6', 'TopPt7', 'TopPt8', 'WW', 'WWlow', 'WWhigh', 'WW1', 'WW2', 'WW3', 'WW4', 'WW5', 'WW6',  'WWewk', 'DYLL', 'VV', 'DYTT', 'DYee', 'DYmm', 'DYee05', 'DYmm05', 'Other', 'VVV', 'Data','ggH_SM', 'qqH_SM', 'WH_SM','ZH_SM' , 'wzttH_SM', 'ggH_sbi', 'ggH_s', 'ggH_b', 'qqH_sbi', 'qqH_s', 'qqH_b' ]
+
+
+        oldYields = yields.copy()
+        yields = OrderedDict([ (k,oldYields[k]) for k in order if k in oldYields])
+        
+        # lista systematiche sperimentali (dal file. root)
+        effects = loader.effects()
+
+        print '   + making nuisance map'
+        nuisances = builder.nuisances( yields, effects , mass, ch, jcat, fl, optsNuis)
+
+        for n,(pdf, eff) in nuisances.iteritems():
+            if 'ggH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
+                eff['ggH_ALT'] =  eff['ggH']
+            if 'qqH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
+                eff['qqH_ALT'] =  eff['qqH']
+            if 'wzttH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
+                eff['wzttH_ALT'] =  eff['wzttH']
+
+        #basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}_shape'
+        if opt.ewksinglet:
+          basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}.'+modelTag(iCP2,iBRn)
+        else:
+          basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}'
+        if opt.shape :
+             basename  = basename + '_shape'
+        print '   + dumping all to file'
+        if opt.listSignals==[] :
+             writer.write(yields,nuisances,outPath+basename+'.txt',shapeSubDir+basename+'.root')
+        else :
+             writer.write(yields,nuisances,outPath+basename+'.txt',shapeSubDir+basename+'.root',opt.listSignals)
+
+        # entry of the cards index
+        return OrderedDict([
+            ('mass',      mass),
+            ('channel',   ch),
+            ('model',     modelTag(iCP2,iBRn) if opt.ewksinglet else None),
+            ('card',      (outPath+basename+'.txt').format(mass = mass, bin = ch)),
+            ('shapes',    (shapeSubDir+basename+'.root').format(mass = mass, bin = ch)),
+            ('processes', yields.keys()),
+            ('nuisances', len(nuisances)),
+        ])
+
+    # parallel mode: each (model, mass, channel) unit is written in its own
+    # worker, logging to <datacards>/logs/<unit>.log
+    logDir = os.path.join(outPath,'logs')
+    pool = hwwjobs.JobPool(opt.jobs, logDir, opt.maxMemory) if opt.jobs > 1 else None
+
+    cards = []
     nModel = 1
     if opt.ewksinglet : nModel = len(opt.cprimesq)*len(opt.brnew)
     for iModel in xrange(0,nModel):
         iCP2 = iModel%len(opt.cprimesq)
         iBRn = (int(iModel/len(opt.cprimesq)))
-
-        if opt.ewksinglet:
-          shapeTmpl = os.path.join(mergedPath,'hww-'+lumistr+'fb.mH{mass}.{channel}.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'_shape.root')
-        else:
-          shapeTmpl = os.path.join(mergedPath,'hww-'+lumistr+'fb.mH{mass}.{channel}_shape.root')
-        #mask = ['Vg','DYLL','DYTT']
-        mask = ['DYLL']
-    
-        maskVeto = {
-           'CMS_8TeV_p_scale_j':['DYTT'],
-           'CMS_8TeV_puModel'  :['DYTT'],
-           }
-    
-    
-    
-        builder = NuisanceMapBuilder( opt.path_dd, opt.noWWddAbove, opt.shape, opt.isssactive, opt.statmode)
-        builder.statShapeVeto = mask
-        builder.expShapeVeto  = maskVeto
     
         for mass in masses:
             if '2011' in opt.dataset and (mass==145 or mass==155): continue
             for ch,(jcat,fl) in channels.iteritems():
-    
-    #         for jets in jetBins:
-    #             for flavor in flavors:
-                print '- Processing',mass, ch
-                loader = ShapeLoader(shapeTmpl.format(mass = mass, channel=ch) ) 
-                loader.load()
-    
-                writer = ShapeDatacardWriter( mass, ch, opt.shape, opt.dataset )
-                print '   + loading yields'
-                yields = loader.yields()
-    
-                # reshuffle the order
-                #order = [ 'vbfH', 'ggH', 'wzttH', 'ggWW', 'Vg', 'WJet', 'Top', 'WW', 'DYLL', 'VV', 'DYTT', 'Data']
-                order = [ 'ggH','ggH_ALT','qqH','qqH_ALT', 'wzttH','wzttH_ALT', 'WH', 'ZH', 'ttH', 'ggWW', 'VgS', 'Vg', 'WJet', 'Top', 'TopPt0', 'TopPt1', 'TopPt2', 'TopPt3', 'TopPt4', 'TopPt5', 'TopPt6', 'TopPt7', 'TopPt8', 'WW', 'WWlow', 'WWhigh', 'WW1', 'WW2', 'WW3', 'WW4', 'WW5', 'WW6',  'WWewk', 'DYLL', 'VV', 'DYTT', 'DYee', 'DYmm', 'DYee05', 'DYmm05', 'Other', 'VVV', 'Data','ggH_SM', 'qqH_SM', 'WH_SM','ZH_SM' , 'wzttH_SM', 'ggH_sbi', 'ggH_s', 'ggH_b', 'qqH_sbi', 'qqH_s', 'qqH_b' ]
-    
-   
-                oldYields = yields.copy()
-                yields = OrderedDict([ (k,oldYields[k]) for k in order if k in oldYields])
-                
-                # lista systematiche sperimentali (dal file. root)
-                effects = loader.effects()
-
-                print '   + making nuisance map'
-                nuisances = builder.nuisances( yields, effects , mass, ch, jcat, fl, optsNuis)
-    
-                for n,(pdf, eff) in nuisances.iteritems():
-                    if 'ggH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
-                        eff['ggH_ALT'] =  eff['ggH']
-                    if 'qqH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
-                        eff['qqH_ALT'] =  eff['qqH']
-                    if 'wzttH' in eff and 'shape' not in pdf[0] and 'stat_bin' not in n :
-                        eff['wzttH_ALT'] =  eff['wzttH']
-    
-                #basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}_shape'
-                if opt.ewksinglet:
-                  basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')
+                if pool:
+                    pool.add(unitLabel(iCP2,iBRn,mass,ch), writeUnit, iCP2, iBRn, mass, ch, jcat, fl)
                 else:
-                  basename = 'hww-'+lumistr+'fb.mH{mass}.{bin}'
-                if opt.shape :
-                     basename  = basename + '_shape'
-                print '   + dumping all to file'
-                if opt.listSignals==[] :
-                     writer.write(yields,nuisances,outPath+basename+'.txt',shapeSubDir+basename+'.root')
-                else :
-                     writer.write(yields,nuisances,outPath+basename+'.txt',shapeSubDir+basename+'.root',opt.listSignals)
-
-
+                    cards.append( writeUnit(iCP2, iBRn, mass, ch, jcat, fl) )
+
+    if pool:
+        results = pool.run()
+        print 'Logs consolidated in',hwwjobs.JobPool.consolidate(results,os.path.join(logDir,'mkDatacards.log'))
+        cards = [ r.value for r in results if r.ok ]
+
+    # index of the cards produced, in the production order
+    indexPath = os.path.join(outPath,'index.json')
+    with open(indexPath,'w') as index:
+        json.dump(cards,index,indent=1)
+    print 'Cards index written to',indexPath,'({0} cards)'.format(len(cards))
+
+    if pool:
+        failed = [ r.label for r in results if not r.ok ]
+        if failed:
+            raise RuntimeError('%d datacard jobs failed: %s' % (len(failed),', '.join(failed)))
 
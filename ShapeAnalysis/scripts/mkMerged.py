@@ -9,11 +9,16 @@ import optparse
 import hwwinfo
 import hwwsamples
 import hwwtools
+import hwwjobs
 import numpy
 import array
 import bisect
 import datadriven
+import histarrays
+import pseudodata
 import logging
+from HWWAnalysis.Misc.odict import OrderedDict
+from HWWAnalysis.Misc.ROOTAndUtils import TH1AddDirSentry
 
 #  __  __                      
 # |  \/  |___ _ _ __ _ ___ _ _ 
@@ -24,12 +29,15 @@ import logging
 
 class ShapeMerger:
     _logger = logging.getLogger('ShapeMerger')
-    def __init__(self, simask = None, fillEmptyBins = False):
+    # where the CHI scale factors are appended
+    scaleFactorsPath = 'ScaleFactors.py'
+    def __init__(self, simask = None, fillEmptyBins = False, pruneThreshold = 0.):
         self.sets = []
         self.histograms = {}
         self.processes = []
         self._simask = simask
         self.fillEmptyBins = fillEmptyBins
+        self.pruneThreshold = pruneThreshold
 
     def add(self,s):
         # add a collection to be summed
@@ -49,33 +57,69 @@ class ShapeMerger:
 
         self.processes = list(procs)
 
-        # build an histogram template
-        shapes = {}
-        
-        # loop over all the sets
+        # the first histogram of each name is the template
+        templates = OrderedDict()
         for s in self.sets:
             for n,h in s.histograms.iteritems():
-                if n in shapes:
-                    continue
-                # ->> ninja
-                dummy = h.Clone()
-
-                dummy.Reset()
-                shapes[n] = dummy
+                if n not in templates:
+                    templates[n] = h
 
-        for n,h in shapes.iteritems():
+        # the bin-by-bin variations stay descriptions, summed as such
+        for n,h in templates.iteritems():
+            if not isinstance(h,BinVariation): continue
+            variations = []
             for s in self.sets:
                 if n not in s.histograms:
                     self._logger.info('Warning: '+n+' is not available in set '+s.label)
                     continue
-                dummy = s.histograms[n]
-                h2add = dummy.Clone()
-                h.Add(h2add)
-
-            # remove the negative bins before storing it
-            self._removeNegativeBins(h)
-            if self.fillEmptyBins and "Data" not in n: self._fillEmptyBins(h)
-            self.histograms[n] = h
+                variations.append(s.histograms[n])
+            self.histograms[n] = BinVariation.merge(variations, self.fillEmptyBins and "Data" not in n)
+
+        # the histograms with the same number of bins are summed in the rows
+        # of the same arrays: contents, sumw2, entries and stats
+        groups = OrderedDict()
+        for n,h in templates.iteritems():
+            if isinstance(h,BinVariation): continue
+            groups.setdefault(histarrays.shapeof(h),[]).append(n)
+
+        for shape,names in groups.iteritems():
+            contents = numpy.zeros( (len(names),)+shape )
+            sumw2    = numpy.zeros( (len(names),)+shape )
+            entries  = numpy.zeros( len(names) )
+            stats    = numpy.zeros( (len(names),13) )
+            buf = array.array('d',[0.]*13)
+
+            for i,n in enumerate(names):
+                for s in self.sets:
+                    if n not in s.histograms:
+                        self._logger.info('Warning: '+n+' is not available in set '+s.label)
+                        continue
+                    h = s.histograms[n]
+                    c = histarrays.contents(h)
+                    w = histarrays.sumw2(h)
+                    contents[i] += c
+                    sumw2[i]    += w if w is not None else c
+                    entries[i]  += h.GetEntries()
+                    h.GetStats(buf)
+                    stats[i]    += numpy.frombuffer(buf)
+
+            # remove the negative bins before storing them
+            self._removeNegativeBins(contents, sumw2, stats)
+            if self.fillEmptyBins:
+                rows = numpy.array([ "Data" not in n for n in names ])
+                if rows.any():
+                    c,w,st = contents[rows],sumw2[rows],stats[rows]
+                    self._fillEmptyBins(c, w, st)
+                    contents[rows],sumw2[rows],stats[rows] = c,w,st
+
+            for i,n in enumerate(names):
+                h = templates[n].Clone()
+                if not h.GetSumw2N(): h.Sumw2()
+                histarrays.contents(h)[:] = contents[i]
+                histarrays.sumw2(h)[:]    = sumw2[i]
+                h.SetEntries(entries[i])
+                h.PutStats(array.array('d',stats[i]))
+                self.histograms[n] = h
 
 
     def injectSignal(self):
@@ -116,50 +160,49 @@ class ShapeMerger:
         map(self.histograms.pop,   sisignals)
         map(self.processes.remove, sisignals)
 
-        nBins = pseudo.GetNbinsX()
-        xax = pseudo.GetXaxis()
-
-        data = pseudo.Clone('histo_Data')
-        data.SetTitle('Data')
-        data.Reset()
-
-        for i in xrange(1,nBins+1):
-            entries = ROOT.TMath.Nint(pseudo.GetAt(i)) 
-            for j in xrange(entries):
-                data.Fill(xax.GetBinCenter(i))
+        # asimov counts in the in-range bins, as if filled at the bin centres
+        expected = histarrays.contents(pseudo)
+        counts = numpy.where(pseudodata.inrange(expected.shape),pseudodata.asimov(expected),0.)
+        data = pseudodata.tohist(pseudo,counts,'histo_Data','Data')
 
         self.histograms['Data'] = data
         self.processes.append('Data')
 
     
-    def _removeNegativeBins(self,h):
-        # move it in the merger as last step
-        # TODO
+    @staticmethod
+    def _scale(contents, sumw2, stats, integral):
+        # as TH1::Scale, row by row, to restore the integrals
+        after = contents[:,1:-1].sum(axis=1)
+        factor = numpy.where(after > 0, integral/numpy.where(after > 0, after, 1.), 1.)
+        contents *= factor[:,numpy.newaxis]
+        sumw2    *= (factor**2)[:,numpy.newaxis]
+        stats    *= factor[:,numpy.newaxis]
+        stats[:,1] *= factor
 
-        integral = h.Integral() if h.Integral() >=0 else 0.001 
-        for i in xrange(1,h.GetNbinsX()+1):
-            c = h.GetBinContent(i)
-            if c < 0.:
-                h.SetAt(0.,i)
-        if 'WJet' in h.GetName():
-            self._logger.debug('Neg Bins removal %-50s : %.3f %.3f',h.GetName(),integral,h.Integral())
+    @staticmethod
+    def _removeNegativeBins(contents, sumw2, stats):
+        # one histogram per row, only the in-range bins are checked
+        inner = contents[:,1:-1]
+        integral = inner.sum(axis=1)
+        integral = numpy.where(integral >= 0, integral, 0.001)
 
-        if h.Integral() > 0:
-            h.Scale(integral/h.Integral())
+        inner[inner < 0.] = 0.
 
+        ShapeMerger._scale(contents, sumw2, stats, integral)
 
-    def _fillEmptyBins(self,h):
-        
-        integral = h.Integral() if h.Integral() >=0 else 0.001
-        for i in xrange(1,h.GetNbinsX()+1):
-            c = h.GetBinContent(i)
-            if c < 0.00001:
-                filling = 0.001 if integral>1 else 0.001*integral
-                h.SetAt(filling,i)
-                h.SetBinError(i,filling)
+
+    @staticmethod
+    def _fillEmptyBins(contents, sumw2, stats):
+        inner = contents[:,1:-1]
+        integral = inner.sum(axis=1)
+        integral = numpy.where(integral >= 0, integral, 0.001)
+
+        filling = numpy.where(integral > 1, 0.001, 0.001*integral)[:,numpy.newaxis]*numpy.ones_like(inner)
+        empty = inner < 0.00001
+        inner[empty] = filling[empty]
+        sumw2[:,1:-1][empty] = filling[empty]**2
             
-        if h.Integral() > 0:
-            h.Scale(integral/h.Integral())
+        ShapeMerger._scale(contents, sumw2, stats, integral)
 
 
     def applyDataDriven(self, mass,estimates):
@@ -179,7 +222,8 @@ class ShapeMerger:
                 if shape.Integral() == 0.: 
                     self._logger.warning('Empty histogram: '+p)
                     continue
-                self._logger.debug('DD to %-50s : %.3f -> %.3f',shape.GetName(), shape.Integral(), e.Nsig())
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug('DD to %-50s : %.3f -> %.3f',shape.GetName(), shape.Integral(), e.Nsig())
 
                 # - check if there are "CHI" regions (CHI samples), where datadriven estimations have been performed
                 # p = "Top"
@@ -202,7 +246,7 @@ class ShapeMerger:
                     print "ScaleFactor[",reducedName,",",shape.GetName(),"] = ",scaleFactor
 
                     if reducedNameInHisto == 'CHITOP-'+p : # the nominal!
-                        card = open( "ScaleFactors.py" ,"a")
+                        card = open( self.scaleFactorsPath ,"a")
                         card.write('scaleFactor.update({%d' % mass + ': {\'%s' % reducedNameInHisto + '\': %-.5f' % scaleFactorToScaleAlpha + '}})\n')
                         card.close()
 
@@ -273,10 +317,31 @@ class ShapeMerger:
             for shape in shapes:
                 shape.Scale(factor)
 
+    def _prune(self):
+        # the bin-by-bin variations moving less than pruneThreshold of the
+        # nominal, Up and Down together
+        if not self.pruneThreshold:
+            return set()
+
+        effects = {}
+        for n,h in self.histograms.iteritems():
+            if not isinstance(h,BinVariation) or n.split()[0] not in self.histograms:
+                continue
+            key = n.rsplit(' ',1)[0]
+            effects[key] = max(effects.get(key,0.),h.effect(self.histograms[n.split()[0]]))
+
+        pruned = set([ n for n,h in self.histograms.iteritems() if isinstance(h,BinVariation) and effects.get(n.rsplit(' ',1)[0],1.) < self.pruneThreshold ])
+        print ' '*4+' - pruned {0} of {1} bin-by-bin variations (effect < {2})'.format(len(pruned)/2,len(effects),self.pruneThreshold)
+        return pruned
+
     def save(self, path):
         # save the final output file
+        pruned = self._prune()
         outFile = ROOT.TFile.Open(path,'recreate')
         for n,h in self.histograms.iteritems():
+            if n in pruned:
+                continue
+            # the bin-by-bin variations are made one at a time
             h.Write()
 
         names = ROOT.TObjArray()
@@ -289,6 +354,179 @@ class ShapeMerger:
 
 
 
+#  ___ _     __   __        _      _   _          
+# | _ |_)_ _ \ \ / /_ _ _ _(_)__ _| |_(_)___ _ _  
+# | _ \ | ' \ \ V / _` | '_| / _` |  _| / _ \ ' \ 
+# |___/_|_||_| \_/\__,_|_| |_\__,_|\__|_\___/_||_|
+
+
+class BinVariation:
+    '''
+    A bin-by-bin statistical variation, kept as a description: the nominal
+    it is made of (a snapshot of its arrays, shared by all its variations),
+    the bin and the shift in sigmas, and the scale factor. The merged ones
+    are sums of such parts, with the negative and empty bins fixed once
+    summed. The histogram is only made when written. The varied parts and
+    their sum are computed once, the sum again only when the factors change.
+
+    Implements the bits of the TH1 interface used by the mixer and merger.
+    '''
+    def __init__(self, name, title, template, snapshot, bin, alpha):
+        self._name     = name
+        self._title    = title
+        self._template = template
+        # [snapshot, bin, alpha, factor, varied arrays (None until computed)]
+        self._parts    = [ [snapshot, bin, alpha, 1., None] ]
+        # None before summing, then whether the empty bins are filled
+        self._fill     = None
+        self._scale    = 1.
+        # the sum of the parts, fixed, before the scale
+        self._summed   = None
+
+    @staticmethod
+    def snapshot(h):
+        '''The arrays of the nominal h (contents, sumw2, stats, entries)'''
+        buf = array.array('d',[0.]*13)
+        h.GetStats(buf)
+        contents = histarrays.contents(h).astype(numpy.float64)
+        sumw2    = histarrays.sumw2(h)
+        sumw2    = sumw2.copy() if sumw2 is not None else numpy.abs(contents)
+        return (contents, sumw2, numpy.frombuffer(buf).copy(), h.GetEntries())
+
+    @staticmethod
+    def merge(variations, fillEmptyBins):
+        '''The sum of the variations of the same name, as done by ShapeMerger'''
+        merged = BinVariation(variations[0]._name,variations[0]._title,variations[0]._template,None,0,0.)
+        merged._parts = [ list(p) for v in variations for p in v._parts ]
+        merged._fill  = fillEmptyBins
+        return merged
+
+    @staticmethod
+    def _vary(snapshot, bin, alpha):
+        # as ShapeMixer._pushbin on bin (and the edges) and rescale to the nominal
+        contents, sumw2, stats, entries = [ a.copy() if isinstance(a,numpy.ndarray) else a for a in snapshot ]
+        integral = contents[1:-1].sum()
+        if entries == 0. and integral == 0.:
+            return contents, sumw2, stats, entries
+
+        nx = len(contents)-2
+        errors = numpy.sqrt(sumw2)
+        pushes = [bin]+([0] if bin == 1 else [nx] if bin == nx else [])
+        for b in pushes:
+            x = contents[b]+alpha*errors[b]
+            contents[b] = x if x > 0. else contents[b]*0.001
+
+        after = contents[1:-1].sum()
+        if after != 0.:
+            f = integral/after
+            contents *= f
+            sumw2    *= f*f
+            stats    *= f
+            stats[1] *= f
+        return contents, sumw2, stats, entries
+
+    def _sum(self):
+        if self._summed is not None:
+            return self._summed
+
+        shape = histarrays.shapeof(self._template)
+        contents = numpy.zeros(shape)
+        sumw2    = numpy.zeros(shape)
+        stats    = numpy.zeros(13)
+        entries  = 0.
+        for part in self._parts:
+            snapshot,bin,alpha,factor,varied = part
+            if varied is None:
+                # independent of the factor, computed once
+                varied = part[4] = self._vary(snapshot,bin,alpha)
+            c,w,st,e = varied
+            contents += c*factor
+            sumw2    += w*factor*factor
+            st = st*factor
+            st[1] *= factor
+            stats    += st
+            entries  += e
+
+        if self._fill is not None:
+            rows = [ a[numpy.newaxis] for a in (contents,sumw2,stats) ]
+            ShapeMerger._removeNegativeBins(*rows)
+            if self._fill:
+                ShapeMerger._fillEmptyBins(*rows)
+            contents,sumw2,stats = [ r[0] for r in rows ]
+
+        self._summed = (contents, sumw2, stats, entries)
+        return self._summed
+
+    def arrays(self):
+        '''contents, sumw2, stats and entries of the variation'''
+        contents, sumw2, stats, entries = self._sum()
+        stats = stats*self._scale
+        stats[1] *= self._scale
+        return contents*self._scale, sumw2*self._scale**2, stats, entries
+
+    def effect(self, nominal):
+        '''Fraction of the nominal yield moved by the variation'''
+        varied = self.arrays()[0][1:-1]
+        nom = histarrays.contents(nominal)[1:-1]
+        total = numpy.abs(nom).sum()
+        return numpy.abs(varied-nom).sum()/total if total > 0 else 0.
+
+    def histogram(self):
+        '''The variation as a histogram, not attached to any directory'''
+        sentry = TH1AddDirSentry()
+        h = self._template.Clone(self._name)
+        h.SetTitle(self._title)
+        if not h.GetSumw2N(): h.Sumw2()
+        contents, sumw2, stats, entries = self.arrays()
+        histarrays.contents(h)[:] = contents
+        histarrays.sumw2(h)[:]    = sumw2
+        h.SetEntries(entries)
+        h.PutStats(array.array('d',stats))
+        return h
+
+    def Write(self):
+        h = self.histogram()
+        h.Write()
+        ROOT.SetOwnership(h,True)
+        del h
+
+    def Scale(self, factor):
+        # the fixes of the summed ones don't commute with the scale
+        if self._fill is None:
+            for p in self._parts: p[3] *= factor
+            self._summed = None
+        else:
+            self._scale *= factor
+
+    def Reset(self):
+        self._parts  = []
+        self._summed = None
+
+    def Integral(self):
+        return self._sum()[0][1:-1].sum()*self._scale
+
+    def GetEntries(self):
+        return sum([ p[0][3] for p in self._parts ])
+
+    def GetNbinsX(self):
+        return self._template.GetNbinsX()
+
+    def GetDimension(self):
+        return self._template.GetDimension()
+
+    def GetName(self):
+        return self._name
+
+    def SetName(self, name):
+        self._name = name
+
+    def GetTitle(self):
+        return self._title
+
+    def SetTitle(self, title):
+        self._title = title
+
+
 #  __  __ _             
 # |  \/  (_)_ _____ _ _ 
 # | |\/| | \ \ / -_) '_|
@@ -421,40 +659,18 @@ class ShapeMixer:
 
         morphed = {}
         # bin-by-bin morphing
-        # clone the histogram once per bin
+        # one description per bin and shift, all sharing the nominal arrays
+        snapshot = BinVariation.snapshot(h)
         for i in xrange(1,nx+1):
             binName  = '{0}_bin{1}'.format(statName,i) 
             binTitle = '{0}_bin{1}'.format(statTitle,i) 
 
-            binUp   = h.Clone(binName+'Up' )
-            binUp.SetTitle(binTitle+' Up' )
-            binDown = h.Clone(binName+'Down' )
-            binDown.SetTitle(binTitle+' Down' )
+            binUp   = BinVariation(binName+'Up', binTitle+' Up', h, snapshot, i, +1)
+            binDown = BinVariation(binName+'Down', binTitle+' Down', h, snapshot, i, -1)
 
             morphed[binUp.GetTitle()] = binUp
             morphed[binDown.GetTitle()] = binDown
 
-            # the histogram is empty, skip the rest
-            if h.GetEntries() == 0. and h.Integral() == 0.0: continue
-            
-            ShapeMixer._pushbin( binUp,   i, +1)
-            ShapeMixer._pushbin( binDown, i, -1)
-
-            if i == 1:
-                ShapeMixer._pushbin( binUp,   0, +1)
-                ShapeMixer._pushbin( binDown, 0, -1)
-            elif i == nx:
-                ShapeMixer._pushbin( binUp,   nx, +1)
-                ShapeMixer._pushbin( binDown, nx, -1)
-
-            # rescale to the original, shape only
-            if binUp.Integral() != 0.:
-                binUp.Scale(h.Integral()/binUp.Integral())
-
-            # rescale to the original, shape only
-            if binDown.Integral() != 0.:
-                binDown.Scale(h.Integral()/binDown.Integral())
-
         return morphed
 
 
@@ -1269,6 +1485,8 @@ if __name__ == '__main__':
 
     parser.add_option('-n', '--dry',   dest='dry',   help='Dry run', action='store_true' )
     parser.add_option('-r', '--rebin', dest='rebin', help='Rebin by', type='int', default=1)
+    parser.add_option('-j', '--jobs',  dest='jobs',  help='Number of parallel jobs (mass, channel units)', type='int', default=1)
+    parser.add_option('--max-memory',  dest='maxMemory', help='Resident memory ceiling of each parallel job in MB, a job going beyond is killed (default = %default, no limit)', type='int', default=0)
 
     parser.add_option('--no_wwdd_above'     , dest='noWWddAbove'       , help='No WW dd above this mass'         , default=None  , type='int' )
     parser.add_option('--dataset'           , dest='dataset'           , help='Dataset to process'               , default=None)
@@ -1282,6 +1500,7 @@ if __name__ == '__main__':
     parser.add_option('--no-syst',       dest='makeSyst',   help='Do not produce the systematics',        action='store_false',   default=True)
     parser.add_option('--simask'            , dest='simask'            , help='Signal injection mask' , default=None, type='string' , action='callback' , callback=hwwtools.list_maker('simask'))
 
+    parser.add_option('--prune-bbb'         , dest='pruneBBB'          , help='Drop the bin-by-bin variations moving less than this fraction of the nominal yield (default = %default, keep all)', type='float', default=0.)
     parser.add_option('--fillEmptyBins'     , dest='fillEmptyBins'     , help='fillEmptyBins used to fill empty bins' , default=False)
 
     parser.add_option('--jhuMixFrac'        , dest='jhuMixFrac'        , help='gg JHU Faction'             , default=1)
@@ -1363,6 +1582,85 @@ if __name__ == '__main__':
 
     channels =  dict([ (k,v) for k,v in hwwinfo.channels.iteritems() if k in opt.chans])
 
+    def mergeUnit(iCP2, iBRn, mass, chan, cat, fl):
+        flavors = hwwinfo.flavors[fl]
+        # print chan,cat,fl,flavors
+        # open output file
+        m = ShapeMerger( simask = opt.simask, fillEmptyBins = opt.fillEmptyBins, pruneThreshold = opt.pruneBBB)
+        if pool:
+            # one file per unit, appended to ScaleFactors.py in order at the end
+            m.scaleFactorsPath = os.path.join(logDir,unitLabel(iCP2,iBRn,mass,chan)+'.scalefactors.py')
+        print '-'*100
+        print 'ooo Processing',mass, chan
+        print '-'*100
+
+
+        for fl in flavors:
+            print '  o Channel:',fl
+            # configure
+            label = 'mH{0} {1} {2}'.format(mass,cat,fl)
+            ss = ShapeMixer(label)
+            nomPathMass  = nomPath  + str(mass) + '/'
+            systPathMass = systPath + str(mass) + '/'
+            if opt.ewksinglet:
+              ss.nominalsPath   = os.path.join(nomPathMass,nameTmpl.format(mass, cat, fl)+'.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'.root')
+              ss.systSearchPath = os.path.join(systPathMass,nameTmpl.format(mass, cat, fl)+'.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'_*.root')
+            else:
+              ss.nominalsPath   = os.path.join(nomPathMass,nameTmpl.format(mass, cat, fl)+'.root')
+              ss.systSearchPath = os.path.join(systPathMass,nameTmpl.format(mass, cat, fl)+'_*.root')
+            ss.lumiMask = lumiMask
+            ss.lumi     = opt.lumi
+            ss.rebin    = opt.rebin
+            ss.statmode = opt.statmode
+
+            print ss.nominalsPath
+            print ss.systSearchPath 
+
+            # run
+            print '     - mixing histograms'
+            ss.mix(chan, scale2nom , iCP2 , iBRn)
+
+            ss.scale2Nominals( scale2nom )
+
+            ss.jhuMixer(opt.jhuMixFrac) 
+
+            ss.applyScaleFactors()
+            
+            m.add(ss)
+        print '  - summing sets'
+        m.sum()
+
+        
+        if not reader.iszombie:
+            print '  - data driven'
+            # make a filter to remove the dd >= noWWddAbove for WW 
+            wwfilter = datadriven.DDWWFilter(reader, opt.noWWddAbove)
+            (estimates,dummy) = wwfilter.get(mass,chan)
+            print mass,estimates
+            m.applyDataDriven( mass,estimates )
+
+        m.injectSignal()
+        if not opt.dry:
+            if opt.ewksinglet:
+              output = 'hww-{lumi:.2f}fb.mH{mass}.{channel}.EWKSinglet_CP2_{cprimsq}_BRnew_{brnew}_shape.root'.format(lumi=opt.lumi,mass=mass,channel=chan,cprimsq=str(opt.cprimesq[iCP2]).replace('.','d'),brnew=str(opt.brnew[iBRn]).replace('.','d')  )
+            else:
+              output = 'hww-{lumi:.2f}fb.mH{mass}.{channel}_shape.root'.format(lumi=opt.lumi,mass=mass,channel=chan)
+            path = os.path.join(mergedDir,output)
+            print '  - writing to',path
+            m.save(path)
+        return m.scaleFactorsPath
+
+    def unitLabel(iCP2, iBRn, mass, chan):
+        label = 'mH{0}_{1}'.format(mass,chan)
+        if opt.ewksinglet:
+            label += '_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')
+        return label
+
+    # parallel mode: each (model, mass, channel) unit is merged in its own
+    # worker, logging to logDir/<unit>.log
+    logDir = os.path.join(mergedDir,'logs')
+    pool = hwwjobs.JobPool(opt.jobs, logDir, opt.maxMemory) if opt.jobs > 1 else None
+
     nModel = 1
     if opt.ewksinglet : nModel = len(opt.cprimesq)*len(opt.brnew)
     for iModel in xrange(0,nModel):
@@ -1371,68 +1669,23 @@ if __name__ == '__main__':
       for mass in masses:
         if '2011' in opt.dataset and (mass==145 or mass==155): continue
         for chan,(cat,fl) in channels.iteritems():
-            flavors = hwwinfo.flavors[fl]
-            # print chan,cat,fl,flavors
-            # open output file
-            m = ShapeMerger( simask = opt.simask, fillEmptyBins = opt.fillEmptyBins)
-            print '-'*100
-            print 'ooo Processing',mass, chan
-            print '-'*100
-
-
-            for fl in flavors:
-                print '  o Channel:',fl
-                # configure
-                label = 'mH{0} {1} {2}'.format(mass,cat,fl)
-                ss = ShapeMixer(label)
-                nomPathMass  = nomPath  + str(mass) + '/'
-                systPathMass = systPath + str(mass) + '/'
-                if opt.ewksinglet:
-                  ss.nominalsPath   = os.path.join(nomPathMass,nameTmpl.format(mass, cat, fl)+'.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'.root')
-                  ss.systSearchPath = os.path.join(systPathMass,nameTmpl.format(mass, cat, fl)+'.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'_*.root')
-                else:
-                  ss.nominalsPath   = os.path.join(nomPathMass,nameTmpl.format(mass, cat, fl)+'.root')
-                  ss.systSearchPath = os.path.join(systPathMass,nameTmpl.format(mass, cat, fl)+'_*.root')
-                ss.lumiMask = lumiMask
-                ss.lumi     = opt.lumi
-                ss.rebin    = opt.rebin
-                ss.statmode = opt.statmode
-
-                print ss.nominalsPath
-                print ss.systSearchPath 
-
-                # run
-                print '     - mixing histograms'
-                ss.mix(chan, scale2nom , iCP2 , iBRn)
-
-                ss.scale2Nominals( scale2nom )
-
-                ss.jhuMixer(opt.jhuMixFrac) 
-
-                ss.applyScaleFactors()
-                
-                m.add(ss)
-            print '  - summing sets'
-            m.sum()
-
-            
-            if not reader.iszombie:
-                print '  - data driven'
-                # make a filter to remove the dd >= noWWddAbove for WW 
-                wwfilter = datadriven.DDWWFilter(reader, opt.noWWddAbove)
-                (estimates,dummy) = wwfilter.get(mass,chan)
-                print mass,estimates
-                m.applyDataDriven( mass,estimates )
-
-            m.injectSignal()
-            if not opt.dry:
-                if opt.ewksinglet:
-                  output = 'hww-{lumi:.2f}fb.mH{mass}.{channel}.EWKSinglet_CP2_{cprimsq}_BRnew_{brnew}_shape.root'.format(lumi=opt.lumi,mass=mass,channel=chan,cprimsq=str(opt.cprimesq[iCP2]).replace('.','d'),brnew=str(opt.brnew[iBRn]).replace('.','d')  )
-                else:
-                  output = 'hww-{lumi:.2f}fb.mH{mass}.{channel}_shape.root'.format(lumi=opt.lumi,mass=mass,channel=chan)
-                path = os.path.join(mergedDir,output)
-                print '  - writing to',path
-                m.save(path)
+            if pool:
+                pool.add(unitLabel(iCP2,iBRn,mass,chan), mergeUnit, iCP2, iBRn, mass, chan, cat, fl)
+            else:
+                mergeUnit(iCP2, iBRn, mass, chan, cat, fl)
+
+    if pool:
+        results = pool.run()
+        # the outputs of the units are collected in the order of the sequential mode
+        print 'Logs consolidated in',hwwjobs.JobPool.consolidate(results,os.path.join(logDir,'mkMerged.log'))
+        for r in results:
+            if not r.ok or not os.path.exists(r.value): continue
+            with open(ShapeMerger.scaleFactorsPath,'a') as card:
+                card.write(open(r.value).read())
+            os.remove(r.value)
+        failed = [ r.label for r in results if not r.ok ]
+        if failed:
+            raise RuntimeError('%d merging jobs failed: %s' % (len(failed),', '.join(failed)))
 
     print 'Used options'
     print ', '.join([ '{0} = {1}'.format(a,b) for a,b in opt.__dict__.iteritems()])
@@ -7,6 +7,13 @@ import optparse
 import hwwinfo
 import hwwsamples
 import hwwtools
+import shapefill
+import hwwjobs
+import entrycache
+import friendtrees
+import histarrays
+import shapestamps
+import yrtables
 import os.path
 import string
 import logging
@@ -16,47 +23,26 @@ import traceback
 from array import array
 
 pathWght = os.environ['CMSSW_BASE']+"/src/HWWAnalysis/ShapeAnalysis/ewksinglet/"
-ROOT.gROOT.ProcessLineSync('.L '+pathWght+'getCPSWght.C+')
-ROOT.gROOT.ProcessLineSync('.L '+pathWght+'getBWWght.C+')
-ROOT.gROOT.ProcessLineSync('.L '+pathWght+'getIntWght.C+')
+# the compiled weights, part of the code version of the shapes (see shapestamps)
+wghtMacros = [ pathWght+m for m in ['getCPSWght.C','getBWWght.C','getIntWght.C'] ]
+for macro in wghtMacros:
+    ROOT.gROOT.ProcessLineSync('.L '+macro+'+')
 
 # ----------------------------------------------------- Read YR values from combination area --------------
 
-def file2map(x):
-        ret = {}; headers = []
-        for x in open(x,"r"):
-            cols = x.split()
-            if len(cols) < 2: continue
-            if "mH" in x:
-                headers = [i.strip() for i in cols[1:]]
-            else:
-                fields = [ float(i) for i in cols ]
-                ret[fields[0]] = dict(zip(headers,fields[1:]))
-        return ret
-
-# ----------------------------------------------------- Add point if needed to YR ------------------------
+# the YR tables are read once (yrtables.records) and the interpolation splines
+# built once per table and column (yrtables.value)
+file2map = yrtables.records
 
 def GetYRVal(YRDic,iMass,Key):
-
-    if iMass in YRDic :
-       #print iMass,YRDic[iMass][Key]
-       return YRDic[iMass][Key]
-    else:
-       n=len(YRDic.keys())
-       x=[]
-       y=[]
-       for jMass in sorted(YRDic.keys()):
-         x.append(jMass)
-         y.append(YRDic[jMass][Key])
-       gr = ROOT.TGraph(n,array('f',x),array('f',y));
-       sp = ROOT.TSpline3("YR",gr);
-       #print iMass,sp.Eval(iMass)
-       return sp.Eval(iMass)
+    return yrtables.value(YRDic,iMass,Key)
 
 # ----------------------------------------------------- ShapeFactory --------------------------------------
 
 class ShapeFactory:
     _logger = logging.getLogger('ShapeFactory')
+    # compiled weight functions depending on the initCPSWght/initIntWght state
+    _statefulWgts = ['getCPSWght','getIntWght']
  
     # _____________________________________________________________________________
     def __init__(self):
@@ -99,6 +85,7 @@ class ShapeFactory:
         self._mcTag           = '0j1j'
         self._masses          = []
         self._channels        = {}
+        self._flavors         = None
         # paths (to move out)
         self._outFileFmt      = ''
         self._paths           = {}
@@ -117,6 +104,20 @@ class ShapeFactory:
         self._YR3rewght       = False
         self._YRValues        = {}
 
+        # single pass filling: bookings are collected and filled by fill()
+        self._engine          = None
+        self._drawer          = shapefill.ChainDrawer()
+        self._pending         = OrderedDict()
+        self._wgtInits        = []
+        # cache of the selected entries (see entrycache.EntryListCache)
+        self._elcache         = None
+        # friend trees attached to the master trees (see friendtrees.FriendIndex)
+        self._friends         = None
+        # store the 2d/3d shapes as they are, without unrolling them
+        self._keep2d          = False
+        # fingerprints of the shape files, to skip the up to date ones (see shapestamps.ShapeStamps)
+        self._stamps          = None
+
         variables = {}
         variables['2dWithCR']             = self._getMllMth2DSpinWithControlRegion
         variables['2dWithSSmirrorRegion'] = self._getMllMth2DSpinWithSSmirrorRegion
@@ -603,6 +604,7 @@ class ShapeFactory:
             for chan,(category,flavor) in self._channels.iteritems():
 #                 cat = hwwinfo.categories[category]
                 flavors = hwwinfo.flavors[flavor]
+                if self._flavors: flavors = [ f for f in flavors if f in self._flavors ]
                 for flavor in flavors:
                     pars = dict([
                         ('mass',mass),
@@ -659,8 +661,12 @@ class ShapeFactory:
                          self._logger.info('CHI-TOP changed')
                          selections[vsample] = hwwinfo.flavorCuts[flavor]
 
+                    # - keep the unweighted cuts and their mass independent part for the entry lists
+                    cuts    = dict(selections)
+                    # (the CHI regions drop the category cuts, their entry lists must too)
+                    presels = dict([ (proc,hwwinfo.flavorCuts[flavor] if proc.startswith('CHITOP-') else catSel+' && '+hwwinfo.flavorCuts[flavor]) for proc in selections ])
 
-                    self._addweights(mass,var,'nominals',selections,category,sel,flavor)
+                    setups = self._addweights(mass,var,'nominals',selections,category,sel,flavor)
 
                     print '.'*80
                     # - extract the histogram range
@@ -669,8 +675,13 @@ class ShapeFactory:
                     # - extract the histogram variable
                     doalias = self.getvariable(alias,mass,category)
 
-                    # - to finally fill it
-                    self._draw(doalias, rng, selections, output, inputs)
+                    # - to finally fill it (or book it for the single pass), unless up to date
+                    if self._uptodate(doalias, rng, selections, output, inputs, setups):
+                        print 'Up to date, skipped'
+                    elif self._engine is not None:
+                        self._book(doalias, rng, selections, output, inputs, setups)
+                    else:
+                        self._draw(doalias, rng, selections, output, inputs, cuts, presels)
                     # - then disconnect the files
                     self._disconnectInputs(inputs)
 
@@ -709,6 +720,7 @@ class ShapeFactory:
             for chan,(category,flavor) in self._channels.iteritems():
 #                 cat = hwwinfo.categories[category]
                 flavors = hwwinfo.flavors[flavor]
+                if self._flavors: flavors = [ f for f in flavors if f in self._flavors ]
                 for flavor in flavors:
                     print '-'*80
                     print ' Processing channel '+chan+': mass',mass,'category',category,'flavor',flavor
@@ -766,8 +778,12 @@ class ShapeFactory:
                          self._logger.info('CHI-TOP changed')
                          selections[vsample] = hwwinfo.flavorCuts[flavor]
 
+                    # - keep the unweighted cuts and their mass independent part for the entry lists
+                    cuts    = dict(selections)
+                    # (the CHI regions drop the category cuts, their entry lists must too)
+                    presels = dict([ (proc,hwwinfo.flavorCuts[flavor] if proc.startswith('CHITOP-') else catSel+' && '+hwwinfo.flavorCuts[flavor]) for proc in selections ])
 
-                    self._addweights(mass,var,syst,selections, category, sel,flavor)
+                    setups = self._addweights(mass,var,syst,selections, category, sel,flavor)
 
                     print '.'*80
                     # - extract the histogram range
@@ -776,8 +792,13 @@ class ShapeFactory:
                     # - extract the histogram variable
                     doalias = self.getvariable(alias,mass,category) 
 
-                    # - to finally fill it
-                    self._draw(doalias, rng, selections ,output,inputs)
+                    # - to finally fill it (or book it for the single pass), unless up to date
+                    if self._uptodate(doalias, rng, selections, output, inputs, setups):
+                        print 'Up to date, skipped'
+                    elif self._engine is not None:
+                        self._book(doalias, rng, selections, output, inputs, setups)
+                    else:
+                        self._draw(doalias, rng, selections ,output,inputs, cuts, presels)
                     # - then disconnect the files
                     self._disconnectInputs(inputs)
                 shapeFiles.append(output)
@@ -785,12 +806,59 @@ class ShapeFactory:
         return shapeFiles
     
     # _____________________________________________________________________________
-    def _draw(self, var, rng, selections, output, inputs):
+    def split(self, pool, label, method, *args, **kwargs):
+        '''
+        Add to pool one job per (mass, channel, flavor) unit of method
+        (makeNominals or makeSystematics), called with args and kwargs
+        '''
+        for mass in self._masses:
+            for chan,(category,flavor) in self._channels.iteritems():
+                for fl in hwwinfo.flavors[flavor]:
+                    if self._flavors and fl not in self._flavors: continue
+                    name = '{0}_mH{1}_{2}_{3}'.format(label,mass,chan,fl)
+                    pool.add(name, self._runUnit, mass, chan, fl, method, *args, **kwargs)
+
+    # _____________________________________________________________________________
+    def _runUnit(self, mass, chan, flavor, method, *args, **kwargs):
+        # runs in a forked worker: the factory can be restricted in place
+        self._masses   = [mass]
+        self._channels = { chan:self._channels[chan] }
+        self._flavors  = [flavor]
+
+        files = getattr(self,method)(*args, **kwargs)
+        if self._engine is not None:
+            files = self.fill()
+        if self._elcache:
+            self._elcache.report()
+        if self._drawer.draws:
+            self._drawer.report()
+        if self._stamps:
+            self._stamps.report()
+        return files
+
+    # _____________________________________________________________________________
+    def _uptodate(self, var, rng, selections, output, inputs, setups=None):
+        '''
+        True if output was made from the same inputs, selections, weights,
+        binning and code, according to its fingerprint. Always False when
+        not running incrementally.
+        '''
+        if self._stamps is None:
+            return False
+        if setups is None:
+            setups = {}
+        stamp = self._stamps.fingerprint(var, rng, selections, inputs, setups, self._wgtInits, {'keep2d':self._keep2d})
+        return self._stamps.check(output, stamp)
+
+    # _____________________________________________________________________________
+    def _draw(self, var, rng, selections, output, inputs, cuts=None, presels=None):
         '''
         var :       the variable to plot
         selection : the selection to draw
         output :    the output file path
         inputs :    the process-input files map
+        cuts :      the unweighted selections, to restrict the entries to loop on
+        presels :   looser selections used to build the entry lists
         '''
         self._logger.info('Yields by process')
         print output
@@ -836,27 +904,108 @@ class ShapeFactory:
             self._logger.debug('Formula: '+var+'>>'+shapeName)
             self._logger.debug('Cut:     '+cut)
             self._logger.debug('ROOTFiles:'+'\n'.join([f.GetTitle() for f in tree.GetListOfFiles()]))
-            entries = tree.Draw( var+'>>'+shapeName, cut, 'goff')
+            # restrict the loop to the entries passing the cuts
+            if self._elcache and cuts:
+                self._drawer.use(tree, [cuts[process], presels.get(process,'') if presels else ''])
+            elist = self._elcache.get(tree, cuts[process], presels.get(process) if presels else None) if self._elcache and cuts else None
+            # the weight factors are compiled once per chain and reused
+            entries = self._drawer.draw(tree, var, cut, shape, elist)
 #             print ' >> ',entries,':',shape.Integral()
-            shape = outFile.Get(shapeName)
             shape.SetTitle(process+';'+var)
 
-
-            if isinstance(shape,ROOT.TH2):
-                shape2d = shape
-                # puts the over/under flows in
-                self._reshape( shape )
-                # go 1d
-                shape = self._h2toh1(shape2d)
-                # rename the old
-                shape2d.SetName(shape2d.GetName()+'_2d')
-                shape2d.Write()
-                shape.SetDirectory(outFile)
-
+            shape = self._store(outFile, shape)
             print '>> {0:>9} : {1:>9.2f}'.format(entries,shape.Integral())
-            shape.Write()
         outFile.Close()
         del outFile
+        if self._stamps:
+            self._stamps.commit(output)
+
+    # _____________________________________________________________________________
+    def _store(self, outFile, shape):
+        '''
+        Write the shape to outFile, unrolling 2d and 3d shapes (the original
+        is stored as well with the _2d suffix). Returns the written shape.
+        '''
+        if isinstance(shape,(ROOT.TH2,ROOT.TH3)) and not self._keep2d:
+            shape2d = shape
+            # puts the over/under flows in
+            self._reshape( shape )
+            # go 1d
+            shape = self._h2toh1(shape2d)
+            # rename the old
+            shape2d.SetName(shape2d.GetName()+'_2d')
+            shape2d.Write()
+            shape.SetDirectory(outFile)
+
+        shape.Write()
+        return shape
+
+    # _____________________________________________________________________________
+    def _book(self, var, rng, selections, output, inputs, setups=None):
+        '''
+        Single pass version of _draw: the shapes are booked in the fill engine
+        and written to output by fill()
+        '''
+        if setups is None:
+            setups = {}
+        vdim = var.count(':')+1
+        hdim = self._bins2dim( rng )
+
+        if vdim != hdim:
+            raise ValueError('The variable\'s and range number of dimensions are mismatching')
+
+        if output in self._pending:
+            raise RuntimeError('Output file '+output+' booked twice')
+
+        sentry = TH1AddDirSentry()
+        bookings = self._pending[output] = []
+        for process,tree in inputs.iteritems():
+            shapeName = 'histo_'+process
+            shape = self._makeshape(shapeName,rng)
+            shape.SetTitle(process+';'+var)
+
+            self._logger.debug('---'+process+'---')
+            self._logger.debug('Formula: '+var+'>>'+shapeName)
+            self._logger.debug('Cut:     '+selections[process])
+
+            bookings.append( (process, self._engine.book(tree, var, selections[process], shape, setups.get(process,()))) )
+
+        print 'Booked {0} shapes for {1}'.format(len(bookings),output)
+
+    # _____________________________________________________________________________
+    def fill(self):
+        '''
+        Fill all the booked shapes, reading each input chain once, and write
+        them to their output files
+        '''
+        if self._engine is None or not self._pending:
+            return []
+
+        # the engine may be shared with other factories and already run
+        if len(self._engine):
+            print '='*80
+            print ' Filling {0} shapes for {1} files'.format(len(self._engine),len(self._pending))
+            print '='*80
+            self._engine.run()
+
+        shapeFiles = []
+        for output,bookings in self._pending.iteritems():
+            self._logger.info('Yields by process')
+            print output
+            outFile = ROOT.TFile.Open(output,'recreate')
+            for process,booking in bookings:
+                outFile.cd()
+                # bookings can be shared between outputs, keep the filled one untouched
+                shape = self._store(outFile, booking.shape.Clone())
+                print '    {0:<20} >> {1:>9} : {2:>9.2f}'.format(process,booking.entries,shape.Integral())
+            outFile.Close()
+            del outFile
+            if self._stamps:
+                self._stamps.commit(output)
+            shapeFiles.append(output)
+
+        self._pending.clear()
+        return shapeFiles
 
     # _____________________________________________________________________________
     @staticmethod
@@ -896,75 +1045,23 @@ class ShapeFactory:
             # ShapeFactory._moveAddBin(h, (0,),(1,) )
             # ShapeFactory._moveAddBin(h, (nx+1,),(nx,) )
             return
-        elif h.GetDimension() == 2:
-            nx = h.GetNbinsX()
-            ny = h.GetNbinsY()
-
-            for i in xrange(1,nx+1):
-                ShapeFactory._moveAddBin(h,(i,0   ),(i, 1 ) )
-                ShapeFactory._moveAddBin(h,(i,ny+1),(i, ny) )
-
-            for j in xrange(1,ny+1):
-                ShapeFactory._moveAddBin(h,(0,    j),(1, j) )
-                ShapeFactory._moveAddBin(h,(nx+1, j),(nx,j) )
 
-            # 0,0 -> 1,1
-            # 0,ny+1 -> 1,ny
-            # nx+1,0 -> nx,1
-            # nx+1,ny+1 ->nx,ny
-
-            ShapeFactory._moveAddBin(h, (0,0),(1,1) )
-            ShapeFactory._moveAddBin(h, (0,ny+1),(1,ny) )
-            ShapeFactory._moveAddBin(h, (nx+1,0),(nx,1) )
-            ShapeFactory._moveAddBin(h, (nx+1,ny+1),(nx,ny) )
+        # under/overflows of each axis into the edge bins, corners included
+        histarrays.fold(h)
 
     @staticmethod
     def _h2toh1(h):
-        import array
-        
-        if not isinstance(h,ROOT.TH2):
-            raise ValueError('Can flatten only 2d hists')
+        if not isinstance(h,(ROOT.TH2,ROOT.TH3)):
+            raise ValueError('Can flatten only 2d or 3d hists')
 
         sentry = TH1AddDirSentry()
 
-#         H1class = getattr(ROOT,h.__class__.__name__.replace('2','1'))
-
-        nx = h.GetNbinsX()
-        ny = h.GetNbinsY()
-
-        h_flat = ROOT.TH1D(h.GetName(),h.GetTitle(),nx*ny,0,nx*ny)
-
-        
-        sumw2 = h.GetSumw2()
-        sumw2_flat = h_flat.GetSumw2()
-
-        for i in xrange(1,nx+1):
-            for j in xrange(1,ny+1):
-                # i,j must be mapped in 
-                b2d = h.GetBin( i,j )
-#                 b2d = h.GetBin( j,i )
-#                 b1d = ((i-1)+(j-1)*nx)+1
-                b1d = ((j-1)+(i-1)*ny)+1
-
-                h_flat.SetAt( h.At(b2d), b1d )
-                sumw2_flat.SetAt( sumw2.At(b2d), b1d ) 
-
-        h_flat.SetEntries(h.GetEntries())
-        
-        stats2d = array.array('d',[0]*7)
-        h.GetStats(stats2d)
-
-        stats1d = array.array('d',[0]*4)
-        stats1d[0] = stats2d[0]
-        stats1d[1] = stats2d[1]
-        stats1d[2] = stats2d[2]+stats2d[4]
-        stats1d[3] = stats2d[3]+stats2d[5]
-
-        h_flat.PutStats(stats1d)
+        # bin (i,j) goes to (j-1)+(i-1)*ny+1
+        h_flat = histarrays.unroll(h)
 
         xtitle = h.GetXaxis().GetTitle()
-        v1,v2 = xtitle.split(':') # we know it's a 2d filled by an expr like y:x
-        xtitle = '%s #times %s bin' % (v1,v2)
+        # we know it's filled by an expr like y:x (or z:y:x)
+        xtitle = '%s bin' % ' #times '.join(shapefill.Expr.variables(xtitle))
 
         h_flat.GetXaxis().SetTitle(xtitle)
 
@@ -973,8 +1070,11 @@ class ShapeFactory:
 
     # _____________________________________________________________________________
     # add the weights to the selection
+    # returns the weight initialisation commands needed by each process
     def _addweights(self,mass,var,syst,selections,cat='',sel='',flavor='of'):
+        self._wgtInits = []
         sampleWgts =  self._sampleWeights(mass,var,cat,sel,flavor)
+        setups = {}
         print '--',selections.keys()
         for process,cut in selections.iteritems():
             wgt = self._stdWgt
@@ -987,6 +1087,17 @@ class ShapeFactory:
 
             selections[process] = wgt+'*('+cut+')'
 
+            # the compiled weights depend on the last initialisation
+            if any([ f in wgt for f in self._statefulWgts ]):
+                setups[process] = tuple(self._wgtInits)
+        return setups
+
+    # _____________________________________________________________________________
+    # initialise the compiled weight functions, keeping track of the commands
+    def _initWeight(self,cmd):
+        ROOT.gROOT.ProcessLineSync(cmd)
+        self._wgtInits.append(cmd)
+
     def loadYR(self):
         if self._energy == '7TeV' or self._energy == '8TeV' :
           path = os.getenv('CMSSW_BASE')+'/src/HWWAnalysis/ShapeAnalysis/data/' 
@@ -1099,7 +1210,7 @@ class ShapeFactory:
 
 
          fileWght = os.environ['CMSSW_BASE']+"/src/HWWAnalysis/ShapeAnalysis/ewksinglet/data/cpsWght/cpsWght.root"
-         ROOT.gROOT.ProcessLineSync('initCPSWght("'+fileWght+'","'+self._energy+'",'+str(mass)+','+str(int(self._mh_SM))+')')
+         self._initWeight('initCPSWght("'+fileWght+'","'+self._energy+'",'+str(mass)+','+str(int(self._mh_SM))+')')
  
          if prodMode in ['ggH','ggH_ALT'] : hWght += '*getCPSWght(0,MHiggs)' 
          if prodMode in ['qqH','qqH_ALT'] : hWght += '*getCPSWght(1,MHiggs)' 
@@ -1144,7 +1255,7 @@ class ShapeFactory:
          if self._ewksinglet : EWKcase='1' 
          if prodMode in ['ggH'] and mass >= 300 : 
             fileInt = os.environ['CMSSW_BASE']+'/src/HWWAnalysis/ShapeAnalysis/ewksinglet/data/Interference_ggH/1.0SMWidth/h_MWW_IonS_NNLO_'+str(mass)+'.root'
-            ROOT.gROOT.ProcessLineSync('initIntWght("'+fileInt+'",0,'+str(iSystGGH)+','+str(mass)+','+str(self._cprimesq)+','+str(self._brnew)+','+EWKcase+')')
+            self._initWeight('initIntWght("'+fileInt+'",0,'+str(iSystGGH)+','+str(mass)+','+str(self._cprimesq)+','+str(self._brnew)+','+EWKcase+')')
             hWght += '*getIntWght(0,MHiggs,'+str(self._cprimesq)+','+str(self._brnew)+')' 
          if prodMode in ['qqH'] and mass >= 350 : 
             if   flavor in ['of','em','me'] : iFlavor = '0'
@@ -1154,7 +1265,7 @@ class ShapeFactory:
               exit()
             EWKDir = os.environ['CMSSW_BASE']+'/src/HWWAnalysis/ShapeAnalysis/ewksinglet/'
             print EWKDir
-            ROOT.gROOT.ProcessLineSync('initIntWght("'+EWKDir+'" ,1,'+str(iSystVBF)+','+str(mass)+','+str(self._cprimesq)+','+str(self._brnew)+','+EWKcase+')') 
+            self._initWeight('initIntWght("'+EWKDir+'" ,1,'+str(iSystVBF)+','+str(mass)+','+str(self._cprimesq)+','+str(self._brnew)+','+EWKcase+')') 
             if not self._approxewk : hWght += '*getIntWght(1,MHiggs,'+str(self._cprimesq)+','+str(self._brnew)+','+iFlavor+')' 
             else                   : hWght += '*getIntWght(1,MHiggs,1.0,0.0,'+iFlavor+')'
 
@@ -1533,23 +1644,42 @@ class ShapeFactory:
 
     # _____________________________________________________________________________
     def _connectInputs(self, var, samples, dirmap, mask=None):
+        '''
+        The input chain of each process, with its friends. The chains are
+        opened through the drawer, which keeps them open across the mass,
+        channel and flavor loops reading the same files.
+        '''
         inputs = {}
         treeName = 'latino'
         for process,filenames in samples.iteritems():
             if mask and process not in mask:
                 continue
-            tree = self._buildchain(treeName,[ (dirmap['base']+'/'+f) for f in filenames])
+            files = [ (dirmap['base']+'/'+f) for f in filenames]
+            for path in files:
+                self._logger.debug('     '+str(os.path.exists(path))+' '+path)
+                if not os.path.exists(path):
+                    raise RuntimeError('File '+path+' doesn\'t exists')
+
+            # friends as chain keys (see shapefill.chainkey)
+            friends = []
             if 'bdt' in var:
                 bdttreeName = 'latinobdt'
-                bdtdir = self._paths[var]
-                bdttree = self._buildchain(bdttreeName,[ (dirmap[var]+'/'+f) for f in filenames])
-                
-                if tree.GetEntries() != bdttree.GetEntries():
-                    raise RuntimeError('Mismatching number of entries: '
-                                       +tree.GetName()+'('+str(tree.GetEntries())+'), '
-                                       +bdttree.GetName()+'('+str(bdttree.GetEntries())+')')
-                logging.debug('{0:<20} - master: {1:<20} friend {2:<20}'.format(process,tree.GetEntries(), bdttree.GetEntries()))
-                tree.AddFriend(bdttree)
+                friends.append( (bdttreeName,tuple([ (dirmap[var]+'/'+f) for f in filenames]),()) )
+
+            if self._friends:
+                for name,ffiles in self._friends.friends(files).iteritems():
+                    friends.append( (name,tuple(ffiles),()) )
+
+            tree = self._drawer.open( (treeName,tuple(files),tuple(friends)) )
+
+            if tree.GetListOfFriends():
+                for fe in tree.GetListOfFriends():
+                    ftree = fe.GetTree()
+                    if tree.GetEntries() != ftree.GetEntries():
+                        raise RuntimeError('Mismatching number of entries: '
+                                           +tree.GetName()+'('+str(tree.GetEntries())+'), '
+                                           +ftree.GetName()+'('+str(ftree.GetEntries())+')')
+                    logging.debug('{0:<20} - master: {1:<20} friend {2:<20}'.format(process,tree.GetEntries(), ftree.GetEntries()))
 
             inputs[process] = tree
 
@@ -1558,6 +1688,11 @@ class ShapeFactory:
     # _____________________________________________________________________________
     def _disconnectInputs(self,inputs):
         for n in inputs.keys():
+            # the chains kept open by the drawer are left open, but can be closed from now on
+            if inputs[n] in self._drawer:
+                self._drawer.release(inputs[n])
+                del inputs[n]
+                continue
             friends = inputs[n].GetListOfFriends()
             if friends.__nonzero__():
                 for fe in friends:
@@ -1586,9 +1721,11 @@ class ShapeFactory:
         Fixed bin width
         bins = (nx,xmin,xmax)
         bins = (nx,xmin,xmax, ny,ymin,ymax)
+        bins = (nx,xmin,xmax, ny,ymin,ymax, nz,zmin,zmax)
         Variable bin width
         bins = ([x0,...,xn])
         bins = ([x0,...,xn],[y0,...,ym])
+        bins = ([x0,...,xn],[y0,...,ym],[z0,...,zk])
         
         '''
 
@@ -1612,7 +1749,16 @@ class ShapeFactory:
             ybins = bins[1]
             hargs = (len(xbins)-1, array('d',xbins),
                     len(ybins)-1, array('d',ybins))
-        elif l == 3:
+        elif l == 3 and isinstance(bins[0],list) and  isinstance(bins[1],list) and isinstance(bins[2],list):
+            ndim=3
+            hclass = ROOT.TH3D
+            xbins = bins[0]
+            ybins = bins[1]
+            zbins = bins[2]
+            hargs = (len(xbins)-1, array('d',xbins),
+                    len(ybins)-1, array('d',ybins),
+                    len(zbins)-1, array('d',zbins))
+        elif l == 3 and not isinstance(bins[0],list):
             # nx,xmin,xmax
             ndim=1
             hclass = ROOT.TH1D
@@ -1622,8 +1768,13 @@ class ShapeFactory:
             ndim=2
             hclass = ROOT.TH2D
             hargs = bins
+        elif l == 9:
+            # nx,xmin,xmax,ny,ymin,ymax,nz,zmin,zmax
+            ndim=3
+            hclass = ROOT.TH3D
+            hargs = bins
         else:
-            # only 1d or 2 d hist
+            # only 1d, 2d or 3d hist
             raise RuntimeError('What a mess!!! bin malformed!')
         
         return hclass,hargs,ndim
@@ -1690,6 +1841,16 @@ if __name__ == '__main__':
     parser.add_option('--range'          , dest='range'          , help='Range (optional default is var)'            , default=None)
     parser.add_option('--splitmode'      , dest='splitmode'      , help='Split in channels using a second selection' , default=None)
 
+    parser.add_option('-j', '--jobs',    dest='jobs',       help='Number of parallel jobs (mass, channel, flavor units)', type='int', default=1)
+    parser.add_option('--single-pass',   dest='singlePass', help='Fill all shapes reading each input chain once', action='store_true',    default=False)
+    parser.add_option('--elist-cache',   dest='elistCache', help='Directory of the entry lists cache (disabled if not set)', default=None)
+    parser.add_option('--elist-cache-size', dest='elistCacheSize', help='Entry lists cache size in MB (default = %default)', type='int', default=2000)
+    parser.add_option('--max-chains',    dest='maxChains',  help='Number of input chains kept open between the draws (default = %default)', type='int', default=60)
+    parser.add_option('--tree-cache',    dest='treeCache',  help='TTreeCache size in MB per input chain, restricted to the branches drawn (0 = disabled, default = %default)', type='int', default=10)
+    parser.add_option('--all-branches',  dest='allBranches', help='Do not disable the input branches not used by the variables, cuts and weights', action='store_true', default=False)
+    parser.add_option('--friends',       dest='friends',    help='Comma separated directories of the gardener friend trees to attach', default=None)
+    parser.add_option('--incremental',   dest='incremental', help='Rebuild only the shape files whose inputs, selections, weights, binning or code changed', action='store_true', default=False)
+    parser.add_option('--force',         dest='force',      help='With --incremental, rebuild all the shape files (and their fingerprints)', action='store_true', default=False)
     parser.add_option('--keep2d',        dest='keep2d',     help='Keep 2d histograms (no unrolling)',     action='store_true',    default=False)
     parser.add_option('--no-noms',       dest='makeNoms',   help='Do not produce the nominal',            action='store_false',   default=True)
     parser.add_option('--no-syst',       dest='makeSyst',   help='Do not produce the systematics',        action='store_false',   default=True)
@@ -1761,12 +1922,26 @@ if __name__ == '__main__':
         nomInputDir         = ''
         systInputDir        = '{syst}/'
 
+        friends = friendtrees.FriendIndex(opt.friends.split(',')) if opt.friends else None
+
+        # parallel mode: the units are collected here and run at the end
+        pool = hwwjobs.JobPool(opt.jobs, os.path.join(opt.path_shape_raw,'logs')) if opt.jobs > 1 else None
+
         nModel = 1
         if opt.ewksinglet : nModel = len(opt.cprimesq)*len(opt.brnew)
 
+        # single pass: one engine for all the models, the trees are read once
+        # and only the model dependent (signal) shapes are booked per model
+        engine = shapefill.FillEngine(not opt.allBranches) if opt.singlePass else None
+        # incremental mode: the fingerprints are shared by all the models
+        # the code version covers the modules and the macros compiled to fill the shapes
+        stamps = shapestamps.ShapeStamps([__file__,shapefill,histarrays,hwwinfo,hwwsamples,shapefill.FillEngine.macro()]+wghtMacros, opt.force) if opt.incremental else None
+        factories = []
+
         for iModel in xrange(0,nModel):
           iCP2 = iModel%len(opt.cprimesq) 
           iBRn = (int(iModel/len(opt.cprimesq)))
+          modelTag = '' if not opt.ewksinglet else '_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')
 
           if opt.ewksinglet:
             nominalOutFile      = 'shape_Mh{mass}_{category}_'+tag+'_shapePreSel_{flavor}.EWKSinglet_CP2_'+str(opt.cprimesq[iCP2]).replace('.','d')+'_BRnew_'+str(opt.brnew[iBRn]).replace('.','d')+'.root'
@@ -1815,9 +1990,20 @@ if __name__ == '__main__':
           # load YR if needed
           if opt.YR3rewght : factory.loadYR()
 
+          factory._engine = engine
+          factories.append(factory)
+          if opt.elistCache : factory._elcache = entrycache.EntryListCache(opt.elistCache, opt.elistCacheSize)
+          factory._friends = friends
+          factory._keep2d  = opt.keep2d
+          factory._drawer  = shapefill.ChainDrawer(opt.maxChains, opt.treeCache, not opt.allBranches)
+          factory._stamps  = stamps
+
           if opt.makeNoms:
               # nominal shapes
-              print factory.makeNominals(variable,selection,nomInputDir,nomOutDir+nominalOutFile)
+              if pool:
+                  factory.split(pool,'nominals'+modelTag,'makeNominals',variable,selection,nomInputDir,nomOutDir+nominalOutFile)
+              else:
+                  print factory.makeNominals(variable,selection,nomInputDir,nomOutDir+nominalOutFile)
   
           if opt.makeSyst:
               class Systematics:
@@ -1982,11 +2168,38 @@ if __name__ == '__main__':
               for syst,mask in systMasks.iteritems():
                   if opt.doSyst and opt.doSyst != syst:
                       continue
+                  if pool:
+                      factory.split(pool,systematics[syst]+modelTag,'makeSystematics',variable,selection,syst,mask,systDirs[syst],systOutDir+systematicsOutFile, nicks=systematics)
+                      continue
                   print '='*80
                   print ' Processing ',syst,' for samples ',' '.join(mask)
                   print '='*80
                   files = factory.makeSystematics(variable,selection,syst,mask,systDirs[syst],systOutDir+systematicsOutFile, nicks=systematics)
 
+          if factory._elcache and not pool:
+              factory._elcache.report()
+          if factory._drawer.draws and not pool:
+              factory._drawer.report()
+          # close the chains kept open by the drawer
+          factory._drawer.clear()
+
+        # single pass: fill the nominals and systematics of all the models
+        if engine is not None and not pool:
+            print '='*80
+            print ' Filling {0} shapes for {1} models'.format(len(engine),len(factories))
+            print '='*80
+            engine.run()
+            for factory in factories:
+                print factory.fill()
+
+        if pool:
+            results = pool.run()
+            failed = [ r.label for r in results if not r.ok ]
+            if failed:
+                raise RuntimeError('%d shape jobs failed: %s' % (len(failed),', '.join(failed)))
+        elif stamps:
+            stamps.report()
+
 #          factory.Delete() 
 
     except Exception as e:
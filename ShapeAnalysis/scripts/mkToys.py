@@ -6,7 +6,9 @@ import sys
 import hwwinfo
 import hwwsamples
 import hwwtools
-import math
+import histarrays
+import pseudodata
+import logging
 import ROOT
 
 from HWWAnalysis.Misc.ROOTAndUtils import TH1AddDirSentry
@@ -17,6 +19,7 @@ if __name__ == '__main__':
     parser = optparse.OptionParser(usage)
     parser.add_option('-i','--input'     , dest='input'          , help='Input Path for the source histograms'       , default=None)
     parser.add_option('-N','--Ntoys'     , dest='ntoys'          , help='Number of toys'       , type='int', default=1)
+    parser.add_option('-s','--seed'      , dest='seed'           , help='Seed of the toys (default = %default)', type='int', default=4357)
 
     hwwtools.addOptions(parser)
     hwwtools.loadOptDefaults(parser)
@@ -42,10 +45,8 @@ if __name__ == '__main__':
     dcdir = opt.input+'/datacards'
     shdir = dcdir+'/shapes'
 
-    rndm = ROOT.TRandom3()
-
+    toypaths = []
     for k in xrange(opt.ntoys):
-        print '==> Instance',k
         toypath = 'toys/instance_%d/' % k
         toydcpath = toypath+'datacards'
         toyshpath = toypath+'datacards/shapes'
@@ -55,53 +56,41 @@ if __name__ == '__main__':
         if os.path.exists(toyshpath):
             os.unlink(toyshpath)
         os.symlink(os.path.abspath(shdir),toyshpath)
+        toypaths.append(toydcpath)
 
-        for chan in opt.chans:
-
-            # the file for signal injection must be unique for all masses
-            # let's take 125 as a reference
-            refname = siname.format(lumi=opt.lumi, mass=125, channel=chan)
-            refpath = os.path.join(shdir,refname+'.root')
-            reffile = ROOT.TFile.Open(refpath)
-            data_si = reffile.Get('histo_Data')
-            if not data_si.__nonzero__():
-                reffile.Close()
-                raise ValueError('cant\'t find histo_data')
-            print 'histo_Data',data_si.GetEntries(),data_si.Integral()
-            sentry = TH1AddDirSentry()
-
-            # make a new data histogram w/o  
-            data_toy = data_si.Clone('histo_Toy')
-            data_toy.Reset()
-            toyentries = 0
-
-            for i in xrange(data_toy.GetNbinsX()+2):
-                mean = data_si.GetBinContent(i)
-                if mean == 0: continue
-
-                n = rndm.Poisson(mean)
-                data_toy.SetBinContent(i,n)
-                data_toy.SetBinError(i,math.sqrt(n))
-                toyentries += n
-
-                print 'bin',i,':',mean,n,data_toy.GetBinContent(i), data_toy.GetBinError(i), data_toy.GetBinError(i)* data_toy.GetBinError(i)
-
-            data_toy.ResetStats()
-
-#             toyentries = rndm.Poisson(data_si.Integral())
-#             print 'Filling the toy with',toyentries,'entries'
-#             
-#             data_toy.FillRandom(data_si,toyentries)
-#             data_toy.SetEntries(toyentries)
-            print 'histo_Toy stats: ',data_si.Integral(),'-->',toyentries, data_toy.GetEntries(),data_toy.Integral()
+    for chan in opt.chans:
 
-            for mass in masses:
-                print chan, mass
+        # the file for signal injection must be unique for all masses
+        # let's take 125 as a reference
+        refname = siname.format(lumi=opt.lumi, mass=125, channel=chan)
+        refpath = os.path.join(shdir,refname+'.root')
+        reffile = ROOT.TFile.Open(refpath)
+        data_si = reffile.Get('histo_Data')
+        if not data_si.__nonzero__():
+            reffile.Close()
+            raise ValueError('cant\'t find histo_data')
+        print 'histo_Data',data_si.GetEntries(),data_si.Integral()
+        sentry = TH1AddDirSentry()
+
+        # all the toys of the channel at once, toy k of the channel drawn
+        # from its own stream (seed,chan,k)
+        toys = pseudodata.poisson(histarrays.contents(data_si),opt.ntoys,opt.seed,(chan,))
+        toyhists = pseudodata.tohists(data_si,toys,'histo_Toy')
+
+        # the datacards are the same for all the toys
+        cards = {}
+        for mass in masses:
+            basename = siname.format(lumi=opt.lumi, mass=mass, channel=chan)
+            dc = open(os.path.join(dcdir,basename+'.txt'),'r')
+            cards[mass] = dc.readlines()
+            dc.close()
+
+        for k,(toydcpath,data_toy) in enumerate(zip(toypaths,toyhists)):
+            toyentries = int(toys[k].sum())
+            print '==> Instance',k,chan,'histo_Toy stats: ',data_si.Integral(),'-->',toyentries, data_toy.GetEntries(),data_toy.Integral()
 
+            for mass in masses:
                 basename = siname.format(lumi=opt.lumi, mass=mass, channel=chan)
-                dcpath  = os.path.join(dcdir,basename+'.txt')
-    #             print os.path.exists(dcpath),dcpath
-    #             print os.path.exists(shpath),shpath
 
                 newshpath = os.path.join(toydcpath+'/pseudo',basename+'.root')
                 newfsh = ROOT.TFile.Open(newshpath,'recreate')
@@ -114,8 +103,7 @@ if __name__ == '__main__':
                 newdcpath = os.path.join(toydcpath,basename+'.txt')
                 newdc = open(newdcpath,'w')
 
-                dc = open(dcpath,'r')
-                for line in dc:
+                for line in cards[mass]:
                     if line.startswith('shapes  data_obs'):
                         line = line.replace('shapes/','pseudo/')
                         line = line.replace('histo_Data','histo_Toy')
@@ -124,9 +112,7 @@ if __name__ == '__main__':
                         line = 'observation %d\n' % toyentries
                     newdc.write(line)
 
-                dc.close()
                 newdc.close()
 
-            del sentry
-            reffile.Close()
-            
+        del sentry
+        reffile.Close()
@@ -18,6 +18,34 @@ directions = [
     'up',
     ]
 
+## produced together, from one read of each input file, with --onepass
+onepasstag = [
+    'muonScale',
+    'electronScale',
+    'metScale',
+    'jetEnergyScale',
+    ]
+
+def writeJob(subname, title, logdir, command):
+    ## write a batch submssion file
+    print subname
+    subfile = open(subname,'w')
+    subfile.write('#!/bin/bash\n')
+    subfile.write('#$ -N '+title+'.root'+'\n')
+    subfile.write('#$ -q short.q,all.q\n')
+    subfile.write('#$ -cwd\n')
+    subfile.write('#$ -o '+logdir+'/'+title+'.out'+'\n')
+    subfile.write('#$ -e '+logdir+'/'+title+'.err'+'\n')
+    subfile.write('source $VO_CMS_SW_DIR/cmsset_default.sh\n')
+    subfile.write('export SCRAM_ARCH=slc5_amd64_gcc434\n')
+    subfile.write('cd /shome/jueugste/cmssw/CMSSW_4_2_4/src/\n')
+    subfile.write('eval `scramv1 ru -sh`\n')
+    #                subfile.write('source $HOME/bin/rc/dcap.sh\n')
+    subfile.write('cd /shome/jueugste/HWWSystematics/\n')
+    subfile.write(command+'\n')
+    subfile.close()
+    return subname
+
  
 def main():
  
@@ -27,6 +55,8 @@ def main():
     parser.set_defaults(overwrite=False)
     parser.add_option('-i', '--inputDir',   dest='inputDir',   help='Input directory',)
     parser.add_option('-o', '--outputDir',  dest='outputDir',  help='Output directory',)
+    parser.add_option('--onepass',          dest='onepass',    help='One job per file for all the scale variations',default=False, action='store_true')
+    parser.add_option('--friend',           dest='friend',     help='Write the scale variations as friend trees (<name>.friend.root), the other systematics as full trees',default=False, action='store_true')
   
     (opt, args) = parser.parse_args()
   
@@ -73,9 +103,25 @@ def main():
 
 
             
+    onepass = [ tag for tag in fulltag if tag in onepasstag ] if opt.onepass else []
+    if onepass:
+        os.system('mkdir -p '+outputDir+'/onepass')
+    if opt.friend:
+        print 'Written as full trees (no friend version): '+', '.join([ tag for tag in fulltag if tag not in onepasstag ])
+
     jobs = []
     for file in files:
+        title = file.replace('.root','')
+        if onepass:
+            ## all the scale variations from one read of the file
+            command = './scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o '+outputDir+' -t latino -A '+','.join(onepass)
+            if opt.friend:
+                command += ' --friend'
+            jobs.append(writeJob(outputDir+'/onepass/sub_'+file.replace('.root','.sh'), title, outputDir+'/onepass', command))
+
         for tag in fulltag:
+            if tag in onepass:
+                continue
             for dir in directions:
                   ## FIXME: change to resolution
                 if 'Resolution' in tag and dir is 'up':
@@ -84,42 +130,16 @@ def main():
                 
 #                print './scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o blu/bla/'+file.replace('.root','_eRes.root')+' -t latino -a electronResolution -d down'
                     
-                title = file.replace('.root','')
-                
-                ## write a batch submssion file
-                print 'sub_'+title+'.sh'
-##                     subfile = open(outputDir+'/'+tag+'_'+dir+'/sub_'+file.replace('.root','_')+tag+'_'+dir+'.sh','w')
-                if 'Resolution' in tag:
-                    subfile = open(outputDir+'/'+tag+'/sub_'+file.replace('.root','.sh'),'w')
-                else:
-                    subfile = open(outputDir+'/'+tag+'_'+dir+'/sub_'+file.replace('.root','.sh'),'w')
-                subfile.write('#!/bin/bash\n')
-                subfile.write('#$ -N '+title+'.root'+'\n')
-                subfile.write('#$ -q short.q,all.q\n')
-                subfile.write('#$ -cwd\n')
                 if 'Resolution' in tag:
-                    subfile.write('#$ -o '+outputDir+'/'+tag+'/'+title+'.out'+'\n')
-                    subfile.write('#$ -e '+outputDir+'/'+tag+'/'+title+'.err'+'\n')
+                    logdir = outputDir+'/'+tag
                 else:
-                    subfile.write('#$ -o '+outputDir+'/'+tag+'_'+dir+'/'+title+'.out'+'\n')
-                    subfile.write('#$ -e '+outputDir+'/'+tag+'_'+dir+'/'+title+'.err'+'\n')
-                subfile.write('source $VO_CMS_SW_DIR/cmsset_default.sh\n')
-                subfile.write('export SCRAM_ARCH=slc5_amd64_gcc434\n')
-                subfile.write('cd /shome/jueugste/cmssw/CMSSW_4_2_4/src/\n')
-                subfile.write('eval `scramv1 ru -sh`\n')
-                #                subfile.write('source $HOME/bin/rc/dcap.sh\n')
-                subfile.write('cd /shome/jueugste/HWWSystematics/\n')
-                if 'Resolution' in tag:
-                    subfile.write('./scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o '+outputDir+'/'+tag+'/'+file+' -t latino -a '+tag+' -d '+dir+'\n')
-                    #subfile.write('mv '+outputDir+'/'+tag+'/'+file+' /scratch/jueugste/syst_scenario1/'+tag+'/'+file+'\n')
-                else:
-                    subfile.write('./scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o '+outputDir+'/'+tag+'_'+dir+'/'+file+' -t latino -a '+tag+' -d '+dir+'\n')
-                    #subfile.write('mv '+outputDir+'/'+tag+'_'+dir+'/'+file+' /scratch/jueugste/syst_scenario1/'+tag+'_'+dir+'/'+file+'\n')
-                subfile.close()
-                if 'Resolution' in tag:
-                    jobs.append(outputDir+'/'+tag+'/sub_'+file.replace('.root','.sh'))
+                    logdir = outputDir+'/'+tag+'_'+dir
+                if opt.friend and tag in onepasstag:
+                    ## only the recomputed branches, by the vectorised engine
+                    command = './scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o '+logdir+'/'+file.replace('.root','.friend.root')+' -t latino -a '+tag+' -v '+dir+' -C --friend'
                 else:
-                    jobs.append(outputDir+'/'+tag+'_'+dir+'/sub_'+file.replace('.root','.sh'))
+                    command = './scaleAndSmearTree.py -i '+inputDir+'/'+file+' -o '+logdir+'/'+file+' -t latino -a '+tag+' -v '+dir
+                jobs.append(writeJob(logdir+'/sub_'+file.replace('.root','.sh'), title, logdir, command))
                  
 ## submit the jobs
     for job in jobs:
@@ -31,6 +31,9 @@ import ROOT
 import numpy
 from math import *
 import math
+import friendtrees
+from tree.gardening import readColumns, ColumnWriter
+from tmvabdt import DYMVA
 # from ROOT import *
  
 from math import sqrt, cos
@@ -84,6 +87,28 @@ weightNamePU = "puW"
 mZ = 91.1876
 to = ' -> '
 
+## branches dropped from all the systematics ntuples
+droppedBranches = ['puWsmurf','puWABtrue','puWCtrue','puWABCtrue','puW120AB','puW600AB','puW120C','puW600C','puW120ABC','puW600ABC']
+
+## branches recomputed by the kinematic variations (name, type)
+recomputedBranches = [
+    ('pt1','F'), ('pt2','F'), ('pt3','F'), ('pt4','F'),
+    ('mll','F'), ('ptll','F'), ('dphilljet','F'), ('gammaMRStar','F'), ('zveto','I'),
+    ('jetpt1','F'), ('jetpt2','F'), ('jetpt3','F'), ('jetpt4','F'),
+    ('njet','F'), ('mjj','F'), ('dphilljetjet','F'),
+    ('cjetpt1','F'), ('cjetpt2','F'), ('njetvbf','F'),
+    ('dphillmet','F'), ('dphilmet','F'), ('dphilmet1','F'), ('dphilmet2','F'),
+    ('mth','F'), ('mtw1','F'), ('mtw2','F'),
+    ('pfmet','F'), ('pfmetphi','F'), ('chmet','F'), ('chmetphi','F'),
+    ('ppfmet','F'), ('pchmet','F'), ('mpmet','F'),
+    ('pfmetSignificance','F'), ('pfmetMEtSig','F'),
+    ('dphimetjet1','F'), ('dphilljet1','F'), ('recoil','F'),
+    ('dymva0','F'), ('dymva1','F'),
+]
+
+## not defined in a previous version of the ntuples, default values needed
+optionalBranches = {'dphimetjet1':-999., 'dphilljet1':-999., 'recoil':-999.}
+
 def openTFile(path, option=''):
     f =  ROOT.TFile.Open(path,option)
     if not f.__nonzero__() or not f.IsOpen():
@@ -264,6 +289,31 @@ def getJEUFactor(pt, eta, jeuList):
     ##scale = 0.
     return scale
 
+# read the jet energy uncertainty table of the dataset
+def readJEU(dataset):
+    base_path = os.path.join(os.getenv('CMSSW_BASE'),'src/HWWAnalysis/ShapeAnalysis/data/')
+    #file = open(base_path+'START38_V13_AK5PF_Uncertainty.txt')
+    #file = open(base_path+'Fall12_V7_DATA_AK5PF_Uncertainty.txt')
+    print dataset
+    if   (dataset=='2012rereco') :
+        file = open(base_path+'FT_53_V21_AN3_Uncertainty_AK5PF.txt')
+    elif (dataset=='2012') :
+        file = open(base_path+'START53_V15_Uncertainty_AK5PF.txt')
+    elif (dataset=='2011') :
+        file = open(base_path+'GR_R_42_V19_AK5PF_Uncertainty.txt')
+    else :
+        return None
+
+    jeu = []
+    for line in file:
+        if (line[0] == '#' or line[0] == '{'):
+            continue
+        s = line.split(None)
+        #print s[0],s[1],s[2],s[3]
+        #print s
+        jeu.append(s)
+    return jeu
+
 # calculate projected MET
 def projectMET(lep1, lep2, met):
     dphi1 = abs(lep1.DeltaPhi(met))
@@ -455,16 +505,8 @@ class scaleAndSmear:
         #oldTree.SetBranchStatus('bveto_nj05'     ,0)
         #oldTree.SetBranchStatus('bveto_nj30'     ,0)
         #oldTree.SetBranchStatus('bveto_nj3005'   ,0)
-        oldTree.SetBranchStatus('puWsmurf'       ,0)
-        oldTree.SetBranchStatus('puWABtrue'      ,0)
-        oldTree.SetBranchStatus('puWCtrue'       ,0)
-        oldTree.SetBranchStatus('puWABCtrue'     ,0)
-        oldTree.SetBranchStatus('puW120AB'       ,0)
-        oldTree.SetBranchStatus('puW600AB'       ,0)
-        oldTree.SetBranchStatus('puW120C'        ,0)
-        oldTree.SetBranchStatus('puW600C'        ,0)
-        oldTree.SetBranchStatus('puW120ABC'      ,0)
-        oldTree.SetBranchStatus('puW600ABC'      ,0)
+        for b in droppedBranches:
+            oldTree.SetBranchStatus(b ,0)
 
         ## do not clone the branches which should be scaled
         ## i.e. set status to 0
@@ -483,53 +525,8 @@ class scaleAndSmear:
         else:
         ## by default, re-assign all these variables
         ## currently not needed for JEC, but for everything else
-            oldTree.SetBranchStatus('pt1'       ,0)
-            oldTree.SetBranchStatus('pt2'       ,0)
-            oldTree.SetBranchStatus('pt3'       ,0)
-            oldTree.SetBranchStatus('pt4'       ,0)
-            oldTree.SetBranchStatus('mll'       ,0)
-            oldTree.SetBranchStatus('ptll'      ,0)
-            ## oldTree.SetBranchStatus('dphill'    ,0)
-            oldTree.SetBranchStatus('dphilljet' ,0)
-            oldTree.SetBranchStatus('gammaMRStar',0)
-            oldTree.SetBranchStatus('zveto'     ,0)
-
-            oldTree.SetBranchStatus('jetpt1'    ,0)
-            oldTree.SetBranchStatus('jetpt2'    ,0)
-            oldTree.SetBranchStatus('njet'      ,0)
-            oldTree.SetBranchStatus('mjj'       ,0)
-            oldTree.SetBranchStatus('dphilljetjet' ,0)
-            oldTree.SetBranchStatus('jetpt3'    ,0)
-            oldTree.SetBranchStatus('jetpt4'    ,0)
-            oldTree.SetBranchStatus('cjetpt1'   ,0)
-            oldTree.SetBranchStatus('cjetpt2'   ,0)
-            oldTree.SetBranchStatus('njetvbf'   ,0)
-                                                                                                                        
-            oldTree.SetBranchStatus('pfmet'     ,0)
-            oldTree.SetBranchStatus('pfmetphi'  ,0)
-            oldTree.SetBranchStatus('chmet'     ,0)
-            oldTree.SetBranchStatus('chmetphi'  ,0)
-            ## oldTree.SetBranchStatus('tcmet'     ,0)
-            ## oldTree.SetBranchStatus('tcmetphi'  ,0)
-            oldTree.SetBranchStatus('dphillmet' ,0)
-            oldTree.SetBranchStatus('dphilmet'  ,0)
-            oldTree.SetBranchStatus('dphilmet1' ,0)
-            oldTree.SetBranchStatus('dphilmet2' ,0)
-            oldTree.SetBranchStatus('mth'       ,0)
-            oldTree.SetBranchStatus('mtw1'      ,0)
-            oldTree.SetBranchStatus('mtw2'      ,0)
-            oldTree.SetBranchStatus('ppfmet'    ,0)
-            oldTree.SetBranchStatus('pchmet'    ,0)
-            ## oldTree.SetBranchStatus('ptcmet'    ,0)
-            oldTree.SetBranchStatus('mpmet'     ,0)
-            oldTree.SetBranchStatus('pfmetSignificance', 0)
-            oldTree.SetBranchStatus('pfmetMEtSig',0)
-            oldTree.SetBranchStatus('dphilljet1',0)
-            oldTree.SetBranchStatus('dphimetjet1',0)
-            oldTree.SetBranchStatus('recoil'    ,0)
-            oldTree.SetBranchStatus('dymva0'    ,0)
-            oldTree.SetBranchStatus('dymva1'    ,0)
-                        
+            for b,t in recomputedBranches:
+                oldTree.SetBranchStatus(b ,0)
 
         newTree = oldTree.CloneTree(0)
         nentries = oldTree.GetEntriesFast()
@@ -1325,29 +1322,11 @@ class scaleAndSmear:
             direction = self.strength
 
         ## read the JES corrections
-        jeu = []
-        base_path = os.path.join(os.getenv('CMSSW_BASE'),'src/HWWAnalysis/ShapeAnalysis/data/')
-        #file = open(base_path+'START38_V13_AK5PF_Uncertainty.txt')
-        #file = open(base_path+'Fall12_V7_DATA_AK5PF_Uncertainty.txt')
-        print self.dataset
-        if   (self.dataset=='2012rereco') :
-            file = open(base_path+'FT_53_V21_AN3_Uncertainty_AK5PF.txt')
-        elif (self.dataset=='2012') :
-            file = open(base_path+'START53_V15_Uncertainty_AK5PF.txt')
-        elif (self.dataset=='2011') :
-            file = open(base_path+'GR_R_42_V19_AK5PF_Uncertainty.txt')
-        else :
+        jeu = readJEU(self.dataset)
+        if jeu is None:
             print 'dataset option has to be 2011, 2012 or 2012rereco'
             return  
 
-        for line in file:
-            if (line[0] == '#' or line[0] == '{'):
-                continue
-            s = line.split(None)
-            #print s[0],s[1],s[2],s[3]
-            #print s
-            jeu.append(s)
-
         ## define a new branch
         self.defineVariables()
         
@@ -2572,6 +2551,387 @@ class scaleAndSmear:
 
 
 
+###############################################################################################
+##  _   _           _             _             _ 
+## | | | |___ __ __| |_ ___ _ _ (_)___ ___  __| |
+## | |_| / -_) _/ _|  _/ _ \ '_|| (_-</ -_)/ _` |
+##  \___/\___\__\__|\__\___/_|  |_/__/\___|\__,_|
+##
+## vectorised version of the kinematic variations (muonScale, electronScale,
+## metScale and jetEnergyScale): the recomputation is done on numpy columns of
+## events instead of TLorentzVectors event by event. The random smearings and
+## the weight variations keep the event loop.
+
+class vp4:
+    '''arrays of four-vectors, the bits of TLorentzVector used here'''
+
+    def __init__(self, px, py, pz, e):
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.e  = e
+
+    @staticmethod
+    def ptetaphi(pt, eta, phi):
+        ## massless, as SetPtEtaPhiM(pt, eta, phi, 0)
+        pt = numpy.abs(pt)
+        px = pt*numpy.cos(phi)
+        py = pt*numpy.sin(phi)
+        pz = pt*numpy.sinh(eta)
+        return vp4(px, py, pz, numpy.sqrt(px*px+py*py+pz*pz))
+
+    def __add__(self, o):
+        return vp4(self.px+o.px, self.py+o.py, self.pz+o.pz, self.e+o.e)
+
+    def __sub__(self, o):
+        return vp4(self.px-o.px, self.py-o.py, self.pz-o.pz, self.e-o.e)
+
+    def Pt(self):
+        return numpy.sqrt(self.px*self.px+self.py*self.py)
+
+    def Phi(self):
+        return numpy.arctan2(self.py, self.px)
+
+    def P(self):
+        return numpy.sqrt(self.px*self.px+self.py*self.py+self.pz*self.pz)
+
+    def M(self):
+        mm = self.e*self.e-self.P()**2
+        return numpy.where(mm < 0, -numpy.sqrt(numpy.abs(mm)), numpy.sqrt(numpy.abs(mm)))
+
+def vdeltaPhi(a, b):
+    ## |TVector2::Phi_mpi_pi(a-b)|
+    return numpy.abs(numpy.mod(a.Phi()-b.Phi()+math.pi, 2*math.pi)-math.pi)
+
+def vtransverseMass(p, m):
+    return numpy.sqrt( 2* p.Pt() * m.Pt() * (1 - numpy.cos(p.Phi()-m.Phi())))
+
+def vprojectMET(lep1, lep2, met):
+    dphimin = numpy.minimum( vdeltaPhi(lep1, met), vdeltaPhi(lep2, met) )
+    pmet = met.Pt()
+    return numpy.where(dphimin < 0.5*math.pi, pmet*numpy.sin(dphimin), pmet)
+
+def vcalculateGammaMRStar(ja, jb):
+    A = ja.P()
+    B = jb.P()
+    az = ja.pz
+    bz = jb.pz
+    jaT2 = ja.px*ja.px+ja.py*ja.py
+    jbT2 = jb.px*jb.px+jb.py*jb.py
+    ATBT = (ja.px+jb.px)**2+(ja.py+jb.py)**2
+
+    temp = numpy.sqrt((A+B)*(A+B)-(az+bz)*(az+bz)-(jbT2-jaT2)*(jbT2-jaT2)/ATBT)
+    mybeta = (jbT2-jaT2)/numpy.sqrt(ATBT*((A+B)*(A+B)-(az+bz)*(az+bz)))
+    mygamma = 1./numpy.sqrt(1.-mybeta*mybeta)
+    ## gamma times MRstar
+    return temp*mygamma
+
+def vcheckZveto(mll, channel):
+    return ((numpy.abs(mll - mZ) > 15) | (channel > 1)).astype(numpy.int32)
+
+def velectronPtScale(pt, eta, dataset):
+    if dataset != '2012':
+        return numpy.zeros(len(pt))
+    aeta = numpy.abs(eta)
+    par0 = numpy.where(aeta < 0.8, -2.27e-02, numpy.where(aeta < 1.5, -2.92e-02, -2.27e-02))
+    par1 = numpy.where(aeta < 0.8, -7.01e-02, numpy.where(aeta < 1.5, -6.59e-02, -7.01e-02))
+    par2 = numpy.where(aeta < 0.8, -3.71e-04, numpy.where(aeta < 1.5, -7.22e-04, -3.71e-04))
+    return numpy.abs(par0 * numpy.exp(par1 * pt) + par2)
+
+def vgetJEUFactor(pt, eta, jeuList):
+    scale = numpy.empty(len(pt))
+    scale.fill(-1.)
+    ## later lines of the table win, as in getJEUFactor
+    for s in jeuList:
+        inbin = (eta > float(s[0])) & (eta <= float(s[1]))
+        uncs  = numpy.array([ float(x) for x in s[4::3] ])
+        pts   = numpy.array([ float(x) for x in s[3::3] ])[:len(uncs)]
+        ## last pt point below the jet pt, the lowest one if the pt is too small
+        k = numpy.maximum(numpy.searchsorted(pts, pt, side='left')-1, 0)
+        scale = numpy.where(inbin, uncs[k], scale)
+    ## if there is no jet there is also no uncertainty defined...
+    scale[pt < 0] = 0
+    return scale
+
+def f32(x):
+    ## the values as read back from the float buffers
+    return numpy.asarray(x, dtype=numpy.float32).astype(numpy.float64)
+
+class vectorScaleAndSmear:
+    '''
+    Kinematic variations of the latino trees on numpy columns.
+    Several variations can be produced from a single read of the input tree,
+    each one in its own output file.
+    '''
+
+    variations = ['muonScale','electronScale','metScale','jetEnergyScale']
+
+    ## branches needed on top of the recomputed ones
+    extraBranches = ['channel','eta1','phi1','eta2','phi2','nvtx',
+                     'jeteta1','jetphi1','jeteta2','jetphi2','jeteta3','jetphi3','jeteta4','jetphi4']
+
+    def __init__(self, dataset='2012', chunksize=100000):
+        self.dataset = dataset
+        self.chunksize = chunksize
+        self.correctMETwithJES = False
+        self.dymva = None
+        self._jeu = None
+
+    def jeu(self):
+        if self._jeu is None:
+            self._jeu = readJEU(self.dataset)
+            if self._jeu is None:
+                raise ValueError('dataset option has to be 2011, 2012 or 2012rereco')
+        return self._jeu
+
+## the variations: c are the original columns, o the output ones (initialised to c)
+    def muonScale(self, c, o, strength):
+        uncertaintyMB = muonUncertainty
+        uncertaintyME = muonUncertainty
+        boundaryMBME = 1.5
+        if self.dataset == '2012' :
+            uncertaintyMB = muonUncertaintyMB2012
+            uncertaintyME = muonUncertaintyME2012
+            boundaryMBME = 2.2
+
+        channel = c['channel']
+        mu1 = (channel == 0) | (channel == 3)
+        mu2 = (channel == 0) | (channel == 2)
+        scale1 = numpy.where(numpy.abs(c['eta1']) < boundaryMBME, uncertaintyMB, uncertaintyME) * strength
+        scale2 = numpy.where(numpy.abs(c['eta2']) < boundaryMBME, uncertaintyMB, uncertaintyME) * strength
+
+        pt1 = numpy.where(mu1, c['pt1'] + c['pt1'] * scale1, c['pt1'])
+        pt2 = numpy.where(mu2, c['pt2'] + c['pt2'] * scale2, c['pt2'])
+        self.leptonScale(c, o, pt1, pt2)
+
+    def electronScale(self, c, o, strength):
+        uncertaintyEB = electronUncertaintyEB
+        uncertaintyEE = electronUncertaintyEE
+        boundaryEBEE = 1.5
+        if self.dataset == '2012' :
+            uncertaintyEB = electronUncertaintyEB2012
+            uncertaintyEE = electronUncertaintyEE2012
+            boundaryEBEE = 2.0
+
+        channel = c['channel']
+        el1 = (channel == 1) | (channel == 2)
+        el2 = (channel == 1) | (channel == 3)
+        scale1 = strength * velectronPtScale(c['pt1'], c['eta1'], self.dataset)
+        scale1 += numpy.where(numpy.abs(c['eta1']) < boundaryEBEE, uncertaintyEB, uncertaintyEE) * strength
+        scale2 = strength * velectronPtScale(c['pt2'], c['eta2'], self.dataset)
+        scale2 += numpy.where(numpy.abs(c['eta2']) < boundaryEBEE, uncertaintyEB, uncertaintyEE) * strength
+
+        pt1 = numpy.where(el1, c['pt1'] + c['pt1'] * scale1, c['pt1'])
+        pt2 = numpy.where(el2, c['pt2'] + c['pt2'] * scale2, c['pt2'])
+        self.leptonScale(c, o, pt1, pt2)
+
+    def metScale(self, c, o, strength):
+        # offset seen at ~1 GeV at MET = 20GeV and ~0.5 GeV at MET = 40 GeV
+        metUncertainty = 1.0 # GeV
+        scale = strength*metUncertainty
+
+        met    = vp4.ptetaphi(c['pfmet']+scale, 0., c['pfmetphi'])
+        chmet4 = vp4.ptetaphi(c['chmet']+scale, 0., c['chmetphi'])
+        o['pfmet']    = met.Pt()
+        o['pfmetphi'] = met.Phi()
+        o['chmet']    = chmet4.Pt()
+        o['chmetphi'] = chmet4.Phi()
+
+        l1 = vp4.ptetaphi(c['pt1'], c['eta1'], c['phi1'])
+        l2 = vp4.ptetaphi(c['pt2'], c['eta2'], c['phi2'])
+        self.computeMETVariables(c, o, l1, l2, met, chmet4)
+
+    def jetEnergyScale(self, c, o, strength):
+        jetthreshold = 30.
+        jeu = self.jeu()
+
+        ## get the scale factor - i.e. this is the relative uncertainty!
+        scales = [ vgetJEUFactor(c['jetpt%d' % i], c['jeteta%d' % i], jeu) * strength for i in xrange(1,5) ]
+
+        ## do not scale "no jet"
+        scales[0][c['jetpt1'] < 0] = 0
+        scales[1][c['jetpt2'] < 0] = 0
+
+        # scale the jet pt (the central jets with the leading jets factors, as in jetEnergyScale)
+        for i in xrange(1,5):
+            o['jetpt%d' % i] = f32(c['jetpt%d' % i] + c['jetpt%d' % i] * scales[i-1])
+        o['cjetpt1'] = f32(c['cjetpt1'] + c['cjetpt1'] * scales[0])
+        o['cjetpt2'] = f32(c['cjetpt2'] + c['cjetpt2'] * scales[1])
+
+        o['njet']    = sum([ o['jetpt%d' % i] > jetthreshold for i in xrange(1,5) ]).astype(numpy.float64)
+        # calculate the number of jets between tag jets (NB: no jet order inversion is considered!)
+        o['njetvbf'] = sum([ o['cjetpt%d' % i] > jetthreshold for i in xrange(1,3) ]).astype(numpy.float64)
+
+        ## get "old" and "new" jets, no jet is no jet
+        jets_hold = []
+        jets      = []
+        for i in xrange(1,5):
+            eta, phi = c['jeteta%d' % i], c['jetphi%d' % i]
+            jets_hold.append( vp4.ptetaphi(numpy.maximum(c['jetpt%d' % i], 0.), eta, phi) )
+            jets.append( vp4.ptetaphi(numpy.maximum(o['jetpt%d' % i], 0.), eta, phi) )
+
+        l1 = vp4.ptetaphi(c['pt1'], c['eta1'], c['phi1'])
+        l2 = vp4.ptetaphi(c['pt2'], c['eta2'], c['phi2'])
+
+        o['dphilljet']    = vdeltaPhi(l1+l2, jets[0])
+        o['dphilljetjet'] = vdeltaPhi(l1+l2, jets[0]+jets[1])
+        o['mjj']          = (jets[0]+jets[1]).M()
+
+        if self.correctMETwithJES :
+            met    = vp4.ptetaphi(c['pfmet'], 0., c['pfmetphi'])
+            chmet4 = vp4.ptetaphi(c['chmet'], 0., c['chmetphi'])
+            for j_hold,j in zip(jets_hold,jets):
+                met    = met + j_hold - j
+                chmet4 = chmet4 + j_hold - j
+            o['pfmet']    = met.Pt()
+            o['pfmetphi'] = met.Phi()
+            o['chmet']    = chmet4.Pt()
+            o['chmetphi'] = chmet4.Phi()
+            self.computeMETVariables(c, o, l1, l2, met, chmet4)
+
+## lepton scale: new lepton variables, lepton change propagated to the met
+    def leptonScale(self, c, o, pt1, pt2):
+        o['pt1'] = f32(pt1)
+        o['pt2'] = f32(pt2)
+
+        l1_hold = vp4.ptetaphi(c['pt1'], c['eta1'], c['phi1'])
+        l2_hold = vp4.ptetaphi(c['pt2'], c['eta2'], c['phi2'])
+        l1 = vp4.ptetaphi(o['pt1'], c['eta1'], c['phi1'])
+        l2 = vp4.ptetaphi(o['pt2'], c['eta2'], c['phi2'])
+
+        self.computeLeptonVariables(c, o, l1, l2)
+
+        met    = vp4.ptetaphi(c['pfmet'], 0., c['pfmetphi']) + l1_hold - l1 + l2_hold - l2
+        chmet4 = vp4.ptetaphi(c['chmet'], 0., c['chmetphi']) + l1_hold - l1 + l2_hold - l2
+        o['pfmet']    = met.Pt()
+        o['pfmetphi'] = met.Phi()
+        o['chmet']    = chmet4.Pt()
+        o['chmetphi'] = chmet4.Phi()
+
+        self.computeMETVariables(c, o, l1, l2, met, chmet4)
+
+## as scaleAndSmear.computeLeptonVariables
+    def computeLeptonVariables(self, c, o, l1, l2):
+        o['mll']  = f32((l1+l2).M())
+        o['ptll'] = (l1+l2).Pt()
+        o['gammaMRStar'] = vcalculateGammaMRStar(l1, l2)
+        o['zveto'] = vcheckZveto(numpy.asarray(o['mll'], dtype=numpy.float32), c['channel'])
+
+        j1 = vp4.ptetaphi(o['jetpt1'], c['jeteta1'], c['jetphi1'])
+        o['dphilljet'] = vdeltaPhi(l1+l2, j1)
+
+## as scaleAndSmear.computeMETVariables
+    def computeMETVariables(self, c, o, l1, l2, pf, ch):
+        o['ppfmet'] = f32(vprojectMET(l1, l2, pf))
+        o['pchmet'] = f32(vprojectMET(l1, l2, ch))
+        o['mpmet']  = numpy.minimum(o['ppfmet'], o['pchmet'])
+
+        o['dphillmet'] = vdeltaPhi(l1+l2, pf)
+        o['dphilmet1'] = f32(vdeltaPhi(l1, pf))
+        o['dphilmet2'] = f32(vdeltaPhi(l2, pf))
+        o['dphilmet']  = numpy.minimum(o['dphilmet1'], o['dphilmet2'])
+
+        o['mth']  = vtransverseMass(l1+l2, pf)
+        o['mtw1'] = vtransverseMass(l1, pf)
+        o['mtw2'] = vtransverseMass(l2, pf)
+
+        jet1 = vp4.ptetaphi(o['jetpt1'], c['jeteta1'], c['jetphi1'])
+        nojet = f32(o['jetpt1']) < 15
+        o['dphilljet1']  = numpy.where(nojet, -0.1, vdeltaPhi(l1+l2, jet1))
+        o['dphimetjet1'] = numpy.where(nojet, -0.1, vdeltaPhi(pf, jet1))
+
+        o['pfmetMEtSig'] = f32(o['pfmet']) / c['pfmet'] * c['pfmetMEtSig']
+
+        px_rec = pf.Pt() * numpy.cos(pf.Phi()) + (l1+l2).px
+        py_rec = pf.Pt() * numpy.sin(pf.Phi()) + (l1+l2).py
+        o['recoil'] = numpy.sqrt(px_rec*px_rec + py_rec*py_rec)
+
+        if self.dymva is None:
+            self.dymva = DYMVA()
+        mva = dict(o)
+        mva['nvtx'] = c['nvtx']
+        o['dymva0'] = self.dymva.evaluate(0, mva)
+        o['dymva1'] = self.dymva.evaluate(1, mva)
+
+## columns of the variation, starting from the original values
+    def compute(self, systArgument, strength, c, n):
+        o = {}
+        for b,t in recomputedBranches:
+            if b in c:
+                o[b] = c[b]
+            else:
+                o[b] = numpy.empty(n)
+                o[b].fill(optionalBranches[b])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            getattr(self, systArgument)(c, o, strength)
+        return o
+
+    def run(self, inputFileName, treeDir, outputs, friend=False):
+        '''
+        outputs: list of (systArgument, direction, strength, outputFileName)
+        With friend, only the recomputed branches are written, in a tree
+        <tree>_<systArgument>_<direction> to be used as friend of the input.
+        '''
+        for systArgument,direction,strength,outputFileName in outputs:
+            if systArgument not in self.variations:
+                raise ValueError('No vectorised version of '+systArgument)
+
+        print 'opening file: '+inputFileName
+        inFile = openTFile(inputFileName)
+        oldTree = inFile.Get(treeDir)
+        nentries = oldTree.GetEntries()
+
+        for b in droppedBranches:
+            oldTree.SetBranchStatus(b ,0)
+        for b,t in recomputedBranches:
+            oldTree.SetBranchStatus(b ,0)
+
+        ## one output file per variation, all the other branches fast-copied
+        clones = []
+        for systArgument,direction,strength,outputFileName in outputs:
+            dir = os.path.dirname(outputFileName)
+            if dir and not os.path.exists(dir):
+                print 'creating output directory: '+dir
+                os.system('mkdir -p '+dir)
+            print 'creating output file: '+outputFileName
+            outFile = openTFile(outputFileName,'recreate')
+            if friend:
+                newTree = ROOT.TTree(self.friendname(oldTree, systArgument, direction), oldTree.GetTitle())
+            else:
+                newTree = oldTree.CloneTree(-1,'fast')
+            writer = ColumnWriter(newTree, recomputedBranches)
+            clones.append( (systArgument,strength,outFile,newTree,writer) )
+        print 'Tree with '+str(nentries)+' entries cloned...'
+
+        oldTree.SetBranchStatus('*'  ,1)
+        names = [ b for b,t in recomputedBranches if oldTree.GetBranch(b) ]
+        names += [ b for b in self.extraBranches if b not in names ]
+
+        for first in xrange(0,nentries,self.chunksize):
+            n = min(self.chunksize,nentries-first)
+            c = readColumns(oldTree, names, first, n)
+            for b in names:
+                c[b] = numpy.asarray(c[b], dtype=numpy.float64)
+            for systArgument,strength,outFile,newTree,writer in clones:
+                writer.fill(self.compute(systArgument, strength, c, n), n)
+            print str(first+n)+' events processed.'
+
+        for systArgument,strength,outFile,newTree,writer in clones:
+            outFile.cd()
+            if friend:
+                ## the branches were filled one by one
+                newTree.SetEntries(-1)
+            newTree.Write()
+            if friend:
+                friendtrees.record(inputFileName, outFile.GetName(), newTree.GetName(), newTree.GetEntries(), systArgument)
+            outFile.Close()
+        inFile.Close()
+
+    @staticmethod
+    def friendname(tree, systArgument, direction):
+        return '_'.join([tree.GetName(), systArgument, direction])
+
+
 ###############################################################################################
 ##                  _       
 ##                 (_)      
@@ -2580,6 +2940,30 @@ class scaleAndSmear:
 ## | | | | | | (_| | | | | |
 ## |_| |_| |_|\__,_|_|_| |_|
 ##                         
+def allVariations(opt, parser):
+    ## -A: all the variations from one read of the input, down being the
+    ## opposite of up (the sign of the strength is kept, as in the scalar engine)
+    strength = opt.strength if opt.strength != -99. else 1.
+    ## friend trees are named apart, not to be taken for full trees
+    name = os.path.basename(opt.inputFileName)
+    if opt.friend:
+        name = os.path.splitext(name)[0]+'.friend.root'
+    outputs = []
+    for v in opt.variations.split(','):
+        systArgument,sep,direction = v.partition(':')
+        if systArgument not in vectorScaleAndSmear.variations:
+            parser.error('No vectorised version of '+systArgument)
+        if direction not in ['','up','down']:
+            parser.error('Wrong direction '+direction+' for '+systArgument)
+        for d in [direction] if direction else ['up','down']:
+            outputFileName = os.path.join(opt.outputFileName, systArgument+'_'+d, name)
+            outputs.append( (systArgument, d, strength if d == 'up' else -strength, outputFileName) )
+
+    print 'Variations: '+', '.join([ '%s:%s (%g)' % (a,d,st) for a,d,st,o in outputs ])
+    v = vectorScaleAndSmear(opt.dataset, opt.chunksize)
+    v.run(opt.inputFileName, opt.treeDir, outputs, opt.friend)
+    print 'Job finished...'
+
 def main():
     usage = 'usage: %prog [options]'
     parser = optparse.OptionParser(usage)
@@ -2595,6 +2979,10 @@ def main():
 #    parser.add_option('-n', '--nEvents',           dest='nEvents',         help='Number of events to run over',)
     parser.add_option('-y', '--dataset',            dest='dataset',         help='dataset: 2011, 2012 or 2012rereco', default='2012')
     parser.add_option('-d', '--debug',              dest='debug',           help='Switch to debug mode',default=False, action='store_true')
+    parser.add_option('-C', '--columnar',           dest='columnar',        help='Use the vectorised engine (muonScale, electronScale, metScale and jetEnergyScale only)',default=False, action='store_true')
+    parser.add_option('-A', '--all',                dest='variations',      help='Produce all these variations (comma separated, e.g. "muonScale,jetEnergyScale:up") in one pass of the vectorised engine, both directions if not given. The outputs are written in <output dir>/<variation>_<direction>/<input file name>, <name>.friend.root with --friend',)
+    parser.add_option('--friend',                   dest='friend',          help='Write only the recomputed branches, to be used as friend trees of the input',default=False, action='store_true')
+    parser.add_option('--chunksize',                dest='chunksize',       help='Number of entries processed at once by the vectorised engine',default=100000, type='int')
 
 
     (opt, args) = parser.parse_args()
@@ -2603,6 +2991,9 @@ def main():
         parser.error('No input file defined')
     if opt.outputFileName is None:
         parser.error('No output file defined')
+    if opt.variations:
+        allVariations(opt, parser)
+        return
     if opt.systArgument is None:
         parser.error('No systematic argument given')
     possibleSystArguments = ['muonScale','electronScale','leptonEfficiency','jetEnergyScale','jetEnergyResolution','metScale','metResolution','muonResolution','electronResolution','dyTemplate','puVariation','chargeResolution']
@@ -2643,6 +3034,15 @@ def main():
     print s.systArgument
     print s.strength
 
+    if opt.columnar or opt.friend:
+        if s.systArgument not in vectorScaleAndSmear.variations:
+            parser.error('No vectorised version of '+s.systArgument)
+        v = vectorScaleAndSmear(s.dataset, opt.chunksize)
+        v.correctMETwithJES = s.correctMETwithJES
+        v.run(s.inputFileName, s.treeDir, [(s.systArgument, s.direction, s.strength, s.outputFileName)], opt.friend)
+        print 'Job finished...'
+        return
+
     s.openOriginalTFile()
     s.openOutputTFile()
     s.cloneTree()
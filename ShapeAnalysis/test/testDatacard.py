@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Round trips of the datacards through HWWAnalysis.ShapeAnalysis.datacard:
+#   python test/testDatacard.py
+#
+
+import unittest
+import os.path
+import shutil
+import tempfile
+from HWWAnalysis.ShapeAnalysis.datacard import Datacard
+
+# as written by combineCards.py, with the directives of combine
+_combined = '''Combination of of_0j=hww-19.47fb.mH125.of_0j_shape.txt  of_1j=hww-19.47fb.mH125.of_1j_shape.txt
+imax 2 number of bins
+jmax 2 number of processes minus 1
+kmax 5 number of nuisance parameters
+----------------------------------------------------------------------------------------------------------------------------------
+shapes *         of_0j     shapes/hww-19.47fb.mH125.of_0j_shape.root histo_$PROCESS histo_$PROCESS_$SYSTEMATIC
+shapes *         of_1j     shapes/hww-19.47fb.mH125.of_1j_shape.root histo_$PROCESS histo_$PROCESS_$SYSTEMATIC
+shapes data_obs  of_0j     shapes/hww-19.47fb.mH125.of_0j_shape.root histo_Data
+shapes data_obs  of_1j     shapes/hww-19.47fb.mH125.of_1j_shape.root histo_Data
+----------------------------------------------------------------------------------------------------------------------------------
+bin          of_0j        of_1j
+observation  5729         3204
+----------------------------------------------------------------------------------------------------------------------------------
+bin                          of_0j        of_0j        of_0j        of_1j        of_1j        of_1j
+process                      ggH          WW           Top          ggH          WW           Top
+process                      0            1            2            0            1            2
+rate                         231.1234     3674.2210    512.0000     102.5000     1201.3300    1520.0100
+----------------------------------------------------------------------------------------------------------------------------------
+lumi_8TeV               lnN  1.026        -            1.026        1.026        -            1.026
+CMS_hww_Top_0j_stat     gmN 120  -        -            4.26667      -            -            -
+CMS_scale_e             shape 1           1            -            1            1            -
+QCDscale_ggH            lnN  0.92/1.08    -            -            0.95/1.06    -            -
+CMS_hww_WW_norm    rateParam of_* WW 1.0
+CMS_hww_Top_norm   param 1.0 0.2
+theory group = QCDscale_ggH
+'''
+
+class TestDatacard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def roundtrip(self, card):
+        path = os.path.join(self.tmp,'card.txt')
+        card.write(path)
+        return Datacard.parse(path)
+
+    def assertSameCard(self, a, b):
+        self.assertEqual(a.header,       b.header)
+        self.assertEqual(a.bins,         b.bins)
+        self.assertEqual(a.observations, b.observations)
+        self.assertEqual(a.columns,      b.columns)
+        self.assertEqual(a.directives,   b.directives)
+        self.assertEqual(a.nuisances.keys(), b.nuisances.keys())
+        for x,y in zip(a.rates,b.rates):
+            self.assertAlmostEqual(x,y,places=4)
+        for name,(pdf,effects) in a.nuisances.iteritems():
+            self.assertEqual(pdf,b.nuisances[name][0])
+            for x,y in zip(effects,b.nuisances[name][1]):
+                if isinstance(x,tuple): self.assertEqual(x,y)
+                elif x is None:         self.assertEqual(y,None)
+                else:                   self.assertAlmostEqual(x,y,places=3)
+
+    def build(self, bin, scale=1.):
+        yields    = {'Data':100., 'ggH':2.5*scale, 'WW':40.*scale, 'Top':12.*scale}
+        nuisances = {'lumi_8TeV':(['lnN'],{'ggH':1.026,'Top':1.026}),
+                     'QCDscale_ggH':(['lnN'],{'ggH':(0.92,1.08)}),
+                     'CMS_hww_Top_stat':(['gmN',120],{'Top':0.1}),
+                     'CMS_scale_e':(['shape'],{'ggH':1,'WW':1}),
+                     'CMS_none':(['lnN'],{'ZH':1.1})}
+        return Datacard.build(bin,yields,nuisances,shapes='shapes/'+bin+'.root',signals=['ggH'])
+
+    def testBuild(self):
+        card = self.build('of_0j')
+        self.assertEqual(card.processes(), ['ggH','WW','Top'])
+        self.assertTrue('CMS_none' not in card.nuisances)
+        self.assertSameCard(card,self.roundtrip(card))
+
+    def testMerge(self):
+        card = Datacard.merge([self.build('of_0j'),self.build('of_1j',0.5)])
+        self.assertEqual(card.bins, ['of_0j','of_1j'])
+        parsed = self.roundtrip(card)
+        self.assertSameCard(card,parsed)
+        self.assertEqual(parsed.exp['of_1j']['WW'],20.)
+
+    def testCombined(self):
+        card = Datacard.loads(_combined)
+        self.assertEqual(card.header[0].split()[0], 'Combination')
+        self.assertEqual(card.bins, ['of_0j','of_1j'])
+        self.assertEqual(card.obs['of_1j'], 3204.)
+        self.assertEqual(len(card.shapes), 4)
+        self.assertEqual(card.nuisances.keys(), ['lumi_8TeV','CMS_hww_Top_0j_stat','CMS_scale_e','QCDscale_ggH'])
+        self.assertEqual(card.nuisances['CMS_hww_Top_0j_stat'][0], ['gmN',120])
+        self.assertEqual(card.nuisances['QCDscale_ggH'][1][3], (0.95,1.06))
+        self.assertEqual([ d.split()[1] for d in card.directives ], ['rateParam','param','group'])
+        self.assertSameCard(card,self.roundtrip(card))
+
+    def testFilter(self):
+        card = Datacard.loads(_combined).filter(nuisFlags=[('CMS_*',False)])
+        self.assertEqual(card.nuisances.keys(), ['lumi_8TeV','QCDscale_ggH'])
+        self.assertSameCard(card,self.roundtrip(card))
+
+    def testInconsistent(self):
+        text = _combined.replace('rate                         231.1234','rate                         ')
+        self.assertRaises(ValueError,Datacard.loads,text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# The index of the data driven estimates of HWWAnalysis.ShapeAnalysis.datadriven:
+# built from the cards, reused while they are unchanged, written atomically:
+#   python test/testDatadriven.py
+#
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from HWWAnalysis.ShapeAnalysis import datadriven
+from HWWAnalysis.ShapeAnalysis.datadriven import DDCardReader, DDWWFilter
+
+# <mass> <events in ctrl region> <scale factor> <unc scale factor> [<corr> <uncorr>]
+_cards = {
+    'TopCard_of_0j.txt'  : '# mass Nctr alpha delta\n120 100 0.50 0.05\n160 80 0.40 0.04 0.01 0.02\n',
+    'TopCard_sf_0j.txt'  : '120 90 0.45 0.05\n160 70 0.35 0.04\n',
+    'WWCard_of_0j.txt'   : '120 300 1.10 0.10\n160 250 1.00 0.10\n',
+    'ggWWCard_of_0j.txt' : '120 300 0.05 0.01\n160 250 0.04 0.01\n',
+}
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name,text in _cards.iteritems():
+            self.write(name,text)
+        DDCardReader._stores.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        DDCardReader._stores.clear()
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.path,name)
+        with open(path,'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path,(mtime,mtime))
+
+    def index(self):
+        return os.path.join(self.path,DDCardReader._indexName)
+
+    def reader(self, parsed):
+        '''A new reader (no shared store), parsed is set if the cards were read'''
+        DDCardReader._stores.clear()
+        parse = DDCardReader._parse
+        def tracked(reader, readmap):
+            parsed.append(True)
+            return parse(reader, readmap)
+        DDCardReader._parse = tracked
+        try:
+            return DDCardReader(self.path)
+        finally:
+            DDCardReader._parse = parse
+
+    def testBuilt(self):
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertTrue(parsed)
+        self.assertTrue(os.path.exists(self.index()))
+        # nothing left aside by the atomic write
+        self.assertEqual(sorted([ f for f in os.listdir(self.path) if f.startswith(DDCardReader._indexName) ]), [DDCardReader._indexName])
+        e = reader.entry(160,'of_0j','Top')
+        self.assertEqual( (e.Nctr,e.alpha,e.delta,e.deltaCorr,e.deltaUnCorr), (80,0.40,0.04,0.01,0.02) )
+        self.assertEqual(sorted(reader.processes(120,'of_0j')), ['Top','WW','ggWW'])
+
+    def testReused(self):
+        self.reader([])
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertFalse(parsed)
+        self.assertEqual(reader.entry(120,'sf_0j','Top').Nctr, 90)
+
+    def testShared(self):
+        a = DDCardReader(self.path)
+        b = DDCardReader(self.path)
+        self.assertTrue(a.estimates is b.estimates)
+
+    def testModified(self):
+        self.reader([])
+        st = os.stat(os.path.join(self.path,'TopCard_sf_0j.txt'))
+        # same size, other modification time
+        self.write('TopCard_sf_0j.txt', _cards['TopCard_sf_0j.txt'].replace('90','91'), st.st_mtime+10)
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertTrue(parsed)
+        self.assertEqual(reader.entry(120,'sf_0j','Top').Nctr, 91)
+
+    def testResized(self):
+        self.reader([])
+        st = os.stat(os.path.join(self.path,'WWCard_of_0j.txt'))
+        # other size, same modification time
+        self.write('WWCard_of_0j.txt', _cards['WWCard_of_0j.txt']+'200 200 0.90 0.10\n', st.st_mtime)
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertTrue(parsed)
+        self.assertEqual(reader.entry(200,'of_0j','WW').Nctr, 200)
+
+    def testAddedCard(self):
+        self.reader([])
+        self.write('DYLLCard_sf_0j.txt', '120 10 0.2 0.1\n160 12 0.2 0.1\n')
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertTrue(parsed)
+        self.assertEqual(reader.entry(160,'sf_0j','DYLL').Nctr, 12)
+
+    def testCorrupted(self):
+        self.reader([])
+        with open(self.index(),'w') as f:
+            f.write('{"version": 1, "fil')
+        parsed = []
+        reader = self.reader(parsed)
+        self.assertTrue(parsed)
+        self.assertEqual(json.load(open(self.index()))['version'], DDCardReader._indexVersion)
+
+    def testFailedWrite(self):
+        reader = self.reader([])
+        before = open(self.index()).read()
+        # an estimate that cannot be serialised: the write fails half way
+        broken = datadriven.AlienDict()
+        broken[120]['of_0j']['Top'] = datadriven.DDEntry(object(),1.,0.1)
+        self.assertRaises(TypeError, reader._saveIndex, {}, broken)
+        # the previous index untouched, nothing left aside
+        self.assertEqual(open(self.index()).read(), before)
+        self.assertEqual([ f for f in os.listdir(self.path) if f.startswith(DDCardReader._indexName) ], [DDCardReader._indexName])
+
+class TestWWFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name,text in _cards.iteritems():
+            with open(os.path.join(self.path,name),'w') as f:
+                f.write(text)
+        DDCardReader._stores.clear()
+        self.reader = DDCardReader(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        DDCardReader._stores.clear()
+
+    def testEntry(self):
+        ddfilter = DDWWFilter(self.reader, 150)
+        self.assertEqual(ddfilter.entry(120,'of_0j','WW').Nctr, 300)
+        self.assertEqual(ddfilter.entry(160,'of_0j','WW'), None)
+        self.assertEqual(ddfilter.entry(160,'of_0j','Top').Nctr, 80)
+        self.assertEqual(ddfilter.entry(160,'of_0j','DYLL'), None)
+        self.assertRaises(KeyError, ddfilter.entry, 130, 'of_0j', 'Top')
+
+    def testCopies(self):
+        ddfilter = DDWWFilter(self.reader, None)
+        ddfilter.entry(120,'of_0j','Top').alphaPrime = 1.
+        self.assertEqual(self.reader.entry(120,'of_0j','Top').alphaPrime, -1)
+
+    def testGet(self):
+        estimates,key = DDWWFilter(self.reader, 150).get(160,'of_0j')
+        self.assertEqual(key, (160,'of_0j'))
+        self.assertEqual(estimates.keys(), ['Top'])
+        estimates,key = DDWWFilter(self.reader, None).get(160,'of_0j')
+        self.assertEqual(sorted(estimates), ['Top','WW','ggWW'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# The pseudo-data arrays of HWWAnalysis.ShapeAnalysis.pseudodata: Asimov
+# rounding and reproducibility of the Poisson toys:
+#   python test/testPseudodata.py
+#
+
+import unittest
+import numpy
+from HWWAnalysis.ShapeAnalysis import pseudodata
+
+class TestAsimov(unittest.TestCase):
+
+    def testRounding(self):
+        expected = numpy.array([0.4, 0.5, 1.5, 2.5, 2.51, 3.49, -0.7, -3., 0.])
+        # half to even, as TMath::Nint, negatives to 0
+        self.assertEqual(pseudodata.asimov(expected).tolist(), [0., 0., 2., 2., 3., 3., 0., 0., 0.])
+
+    def testShape(self):
+        expected = numpy.arange(12.).reshape(3,4)-2.
+        self.assertEqual(pseudodata.asimov(expected).shape, (3,4))
+
+class TestPoisson(unittest.TestCase):
+
+    expected = numpy.array([0., 0.3, 4.2, 17.5, 120., -1.])
+
+    def testShape(self):
+        toys = pseudodata.poisson(self.expected, 5, 7, ('of_0j',))
+        self.assertEqual(toys.shape, (5,)+self.expected.shape)
+        # the empty and negative bins stay empty
+        self.assertTrue((toys[:,0] == 0).all() and (toys[:,-1] == 0).all())
+        self.assertTrue((toys == numpy.rint(toys)).all())
+
+    def testReproducible(self):
+        a = pseudodata.poisson(self.expected, 10, 1234, ('of_0j',))
+        b = pseudodata.poisson(self.expected, 10, 1234, ('of_0j',))
+        self.assertTrue((a == b).all())
+
+    def testNumberOfToys(self):
+        # toy k does not depend on the number of toys generated with it
+        few  = pseudodata.poisson(self.expected, 3, 1234, ('of_0j',))
+        many = pseudodata.poisson(self.expected, 20, 1234, ('of_0j',))
+        self.assertTrue((few == many[:3]).all())
+
+    def testChannelOrder(self):
+        # the toys of a channel do not depend on the other channels, nor on their order
+        channels = ['of_0j','of_1j','sf_0j','sf_1j']
+        forward  = dict([ (c,pseudodata.poisson(self.expected, 5, 99, (c,))) for c in channels ])
+        backward = dict([ (c,pseudodata.poisson(self.expected, 5, 99, (c,))) for c in reversed(channels) ])
+        for c in channels:
+            self.assertTrue((forward[c] == backward[c]).all())
+
+    def testIndependent(self):
+        a = pseudodata.poisson(self.expected, 10, 99, ('of_0j',))
+        self.assertFalse((a == pseudodata.poisson(self.expected, 10, 99, ('of_1j',))).all())
+        self.assertFalse((a == pseudodata.poisson(self.expected, 10, 100, ('of_0j',))).all())
+        self.assertFalse((a[0] == a[1]).all())
+
+    def testStream(self):
+        self.assertEqual(pseudodata.stream('seed','of_0j',3).randint(1<<30), pseudodata.stream('seed','of_0j',3).randint(1<<30))
+        self.assertNotEqual(pseudodata.stream('seed','of_0j',3).randint(1<<30), pseudodata.stream('seed','of_0j',4).randint(1<<30))
+
+    def testInRange(self):
+        mask = pseudodata.inrange((4,5))
+        self.assertEqual(mask.sum(), 2*3)
+        self.assertFalse(mask[0].any() or mask[-1].any() or mask[:,0].any() or mask[:,-1].any())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# The expressions of HWWAnalysis.ShapeAnalysis.shapefill (factors, variables,
+# equivalence), the branches they use, and the bookings of the FillEngine:
+#   python test/testShapefill.py
+#
+
+import unittest
+import ROOT
+from HWWAnalysis.ShapeAnalysis.shapefill import Expr, FillEngine
+from HWWAnalysis.ShapeAnalysis import branchusage
+
+class TestExpr(unittest.TestCase):
+
+    def assertFactors(self, expr, factors):
+        self.assertEqual(Expr(expr).factors, tuple(factors))
+
+    def testProduct(self):
+        self.assertFactors('baseW*puW*effW', ['baseW','puW','effW'])
+        self.assertFactors(' ( baseW ) * ( puW ) ', ['baseW','puW'])
+        self.assertFactors('((baseW*puW))', ['baseW','puW'])
+        self.assertFactors('abs(x)*y', ['abs(x)','y'])
+        self.assertFactors('jetpt[0]*y', ['jetpt[0]','y'])
+        self.assertFactors('pow(a,2)*b', ['pow(a,2)','b'])
+        self.assertFactors('', [])
+        self.assertFactors('1', [])
+
+    def testSelectionsFirst(self):
+        self.assertFactors('w*(x>1)*(y<2)', ['x>1','y<2','w'])
+        self.assertFactors('baseW*puW*(mll>12 && zveto)', ['mll>12&&zveto','baseW','puW'])
+        self.assertFactors('(mll>12 || ptll>20)*w', ['mll>12||ptll>20','w'])
+
+    def testLogical(self):
+        # && and || at the top level are not products
+        self.assertFactors('mll>12 && ptll>20', ['mll>12&&ptll>20'])
+        self.assertFactors('mll>12 || w*x', ['mll>12||w*x'])
+        self.assertFactors('a?b:c', ['a?b:c'])
+        self.assertFactors('!(a)*b', ['!(a)*b'])
+
+    def testOperators(self):
+        self.assertFactors('a+b*c', ['a+b*c'])
+        self.assertFactors('a-b*c', ['a-b*c'])
+        self.assertFactors('a*-b', ['a*-b'])
+        self.assertFactors('a**2*b', ['a**2*b'])
+        # product and division associate
+        self.assertFactors('a/b*c', ['a/b','c'])
+        self.assertFactors('a*b/c', ['a','b/c'])
+        # the modulo has the precedence of the product
+        self.assertFactors('a*b%c', ['a*b%c'])
+        self.assertFactors('a%2*b', ['a%2*b'])
+        self.assertFactors('a*(b%2)', ['a','b%2'])
+        # exponents of numbers are not sums
+        self.assertFactors('x*1e-3*y', ['x','1e-3','y'])
+        self.assertFactors('x*e-3', ['x*e-3'])
+
+    def testEquivalence(self):
+        self.assertEqual(Expr('a*b'), Expr('b*a'))
+        self.assertEqual(Expr('baseW*(mll>12)'), Expr('( mll>12 ) * baseW'))
+        self.assertEqual(hash(Expr('a*(b)')), hash(Expr('b * a')))
+        self.assertNotEqual(Expr('a*b'), Expr('a*c'))
+        self.assertNotEqual(Expr('a*b%c'), Expr('a*(b%c)'))
+        self.assertEqual(len(set([Expr('a*b'),Expr('b*a'),Expr('(a)*b'),Expr('a')])), 2)
+
+    def testVariables(self):
+        self.assertEqual(Expr.variables('x'), ['x'])
+        self.assertEqual(Expr.variables('y:x'), ['y','x'])
+        self.assertEqual(Expr.variables('f(a:b):x'), ['f(a:b)','x'])
+        self.assertEqual(Expr.variables('TMath::Abs(x):y'), ['TMath::Abs(x)','y'])
+
+class TestBranchUsage(unittest.TestCase):
+
+    def testIdentifiers(self):
+        self.assertEqual(branchusage.identifiers('x>1 && name=="abc" && TMath::Abs(y)'), set(['x','y','name','TMath','Abs']))
+        self.assertEqual(branchusage.identifiers('bdt.output*jetpt1'), set(['bdt.output','jetpt1']))
+
+    def testAliases(self):
+        aliases = {'sel':'mll>12 && zveto', 'zveto':'abs(mll-91)>15'}
+        self.assertEqual(branchusage.expand(['sel*w'],aliases), set(['sel','zveto','mll','abs','w']))
+        # cyclic aliases terminate
+        self.assertEqual(branchusage.expand(['a'],{'a':'b','b':'a'}), set(['a','b']))
+
+class TestFillEngine(unittest.TestCase):
+
+    def setUp(self):
+        ROOT.TH1.AddDirectory(False)
+        self.files = ['/nonexistent/latino_000_WW.root','/nonexistent/latino_001_WW.root']
+
+    def chain(self, files=None):
+        # the files are not opened before looping
+        chain = ROOT.TChain('latino')
+        for f in (files or self.files):
+            chain.Add(f)
+        return chain
+
+    def testShared(self):
+        engine = FillEngine()
+        h = ROOT.TH1D('histo_WW','',10,0.,100.)
+        b = engine.book(self.chain(),'mll','baseW*puW*(mll>12)',h)
+        # same content, equivalent cut: one booking
+        self.assertTrue(engine.book(self.chain(),'mll','(mll>12) * puW*baseW',h) is b)
+        self.assertEqual(len(engine), 1)
+        self.assertEqual(engine.shared, 1)
+
+    def testDistinct(self):
+        engine = FillEngine()
+        h = ROOT.TH1D('histo_WW','',10,0.,100.)
+        g = ROOT.TH1D('histo_WW','',20,0.,100.)
+        bookings = [
+            engine.book(self.chain(),'mll','baseW*(mll>12)',h),
+            engine.book(self.chain(),'mll','baseW*(mll>20)',h),
+            engine.book(self.chain(),'mth','baseW*(mll>12)',h),
+            engine.book(self.chain(),'mll','baseW*(mll>12)',g),
+            engine.book(self.chain(),'mll','baseW*(mll>12)',h,setup=['initCPSWght()']),
+            engine.book(self.chain(self.files[:1]),'mll','baseW*(mll>12)',h),
+        ]
+        self.assertEqual(len(set([ id(b) for b in bookings ])), len(bookings))
+        self.assertEqual(len(engine), len(bookings))
+        self.assertEqual(engine.shared, 0)
+
+if __name__ == '__main__':
+    unittest.main()